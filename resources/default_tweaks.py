@@ -543,3 +543,12 @@ exclude_fields_on_paste = []
 # Useful if for some reason your operating systems network checking
 # facilities are not reliable (for example NetworkManager on Linux).
 skip_network_check = False
+
+#: Cache the input of conversions
+# The result of reading and parsing the book being converted can be kept in a
+# cache, so that converting the same book again, to a different format or with
+# different output settings, is faster. This is the maximum size of the cache,
+# in MB. When the cache becomes larger than this, the least recently used books
+# are removed from it. The default of zero means no cache is used. For example:
+#    conversion_input_cache_size = 512
+conversion_input_cache_size = 0
@@ -141,6 +141,26 @@ def find_tests(which_tests=None, exclude_tests=None):
         a(find_tests())
         from calibre.gui2.viewer.convert_book import find_tests
         a(find_tests())
+        from calibre.ebooks.conversion.cache import find_tests
+        a(find_tests())
+        from calibre.ebooks.conversion.batch import find_tests
+        a(find_tests())
+        from calibre.ebooks.conversion.profile import find_tests
+        a(find_tests())
+        from calibre.ebooks.conversion.images import find_tests
+        a(find_tests())
+        from calibre.ebooks.comic.input import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.spill import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.transforms.subset import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.transforms.split import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.transforms.parallel import find_tests
+        a(find_tests())
+        from calibre.srv.hpack import find_tests
+        a(find_tests())
         from calibre.utils.hyphenation.test_hyphenation import find_tests
         a(find_tests())
         if iswindows:
@@ -183,6 +203,20 @@ class Test(Command):
         run_cli(tests, verbosity=opts.test_verbosity)
 
 
+class BenchmarkServer(Command):
+
+    description = 'Measure the throughput and latency of the Content server under load'
+
+    def add_options(self, parser):
+        from calibre.srv.benchmark import add_benchmark_options
+        add_benchmark_options(parser.add_option)
+
+    def run(self, opts):
+        from calibre.srv.benchmark import run_benchmark
+        if run_benchmark(opts) != 0:
+            raise SystemExit(1)
+
+
 class TestRS(Command):
 
     description = 'Run tests for RapydScript code'
@@ -241,6 +241,11 @@ class Cache(object):
     def last_modified(self):
         return self.backend.last_modified()
 
+    def lock_wait_stats(self):
+        ''' Return the number of times threads had to wait to acquire the
+        database lock and the total time spent waiting, in seconds. '''
+        return self.read_lock.wait_stats
+
     @write_api
     def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if template_cache:
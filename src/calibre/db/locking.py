@@ -9,6 +9,7 @@ __docformat__ = 'restructuredtext en'
 import traceback, sys
 from threading import Lock, Condition, current_thread
 from calibre.utils.config_base import tweaks
+from calibre.utils.monotonic import monotonic
 
 
 class LockingError(RuntimeError):
@@ -78,6 +79,10 @@ class SHLock(object):  # {{{
         self._exclusive_queue = []
         #  This is for recycling waiter objects.
         self._free_waiters = []
+        #  Number of times and total time threads had to wait for the lock,
+        #  only updated when there is contention.
+        self.wait_count = 0
+        self.wait_time = 0.0
 
     def acquire(self, blocking=True, shared=False):
         '''
@@ -162,12 +167,15 @@ class SHLock(object):  # {{{
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            st = monotonic()
             try:
                 self._shared_queue.append((me, waiter))
                 waiter.wait()
                 assert not self.is_exclusive
             finally:
                 self._return_waiter(waiter)
+                self.wait_count += 1
+                self.wait_time += monotonic() - st
         else:
             self.is_shared += 1
             self._shared_owners[me] = 1
@@ -189,11 +197,14 @@ class SHLock(object):  # {{{
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            st = monotonic()
             try:
                 self._exclusive_queue.append((me, waiter))
                 waiter.wait()
             finally:
                 self._return_waiter(waiter)
+                self.wait_count += 1
+                self.wait_time += monotonic() - st
         else:
             self._exclusive_owner = me
             self.is_exclusive += 1
@@ -229,6 +240,11 @@ class RWLockWrapper(object):
     def owns_lock(self):
         return self._shlock.owns_lock()
 
+    @property
+    def wait_stats(self):
+        ' The number of times threads had to wait for this lock and the total time spent waiting, in seconds '
+        return self._shlock.wait_count, self._shlock.wait_time
+
 
 class DebugRWLockWrapper(RWLockWrapper):
 
@@ -8,16 +8,13 @@ __docformat__ = 'restructuredtext en'
 Based on ideas from comiclrf created by FangornUK.
 '''
 
-import os, traceback, time
+import os
 
 from calibre import extract, prints, walk
 from calibre.constants import filesystem_encoding
 from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.utils.icu import numeric_sort_key
-from calibre.utils.ipc.server import Server
-from calibre.utils.ipc.job import ParallelJob
 from polyglot.builtins import unicode_type, map
-from polyglot.queue import Empty
 
 # If the specified screen has either dimension larger than this value, no image
 # rescaling is done (we assume that it is a tablet output profile)
@@ -81,16 +78,17 @@ class PageProcessor(list):  # {{{
 
     '''
     Contains the actual image rendering logic. See :method:`render` and
-    :method:`process_pages`.
+    :method:`process_pages`. The rendered pages are stored in this list as
+    encoded image data.
     '''
 
-    def __init__(self, path_to_page, dest, opts, num):
+    def __init__(self, path_to_page, opts, num):
         list.__init__(self)
         self.path_to_page = path_to_page
         self.opts         = opts
         self.num          = num
-        self.dest         = dest
         self.rotate       = False
+        self.thumbnail    = None
         self.render()
 
     def render(self):
@@ -99,8 +97,7 @@ class PageProcessor(list):  # {{{
             img = image_from_data(f.read())
         width, height = img.width(), img.height()
         if self.num == 0:  # First image so create a thumbnail from it
-            with lopen(os.path.join(self.dest, 'thumbnail.png'), 'wb') as f:
-                f.write(scale_image(img, as_png=True)[-1])
+            self.thumbnail = scale_image(img, as_png=True)[-1]
         self.pages = [img]
         if width > height:
             if self.opts.landscape:
@@ -118,7 +115,7 @@ class PageProcessor(list):  # {{{
             add_borders_to_image, resize_image, gaussian_sharpen_image, grayscale_image,
             despeckle_image, quantize_image
         )
-        for i, img in enumerate(self.pages):
+        for img in self.pages:
             if self.rotate:
                 img = rotate_image(img, -90)
 
@@ -195,32 +192,17 @@ class PageProcessor(list):  # {{{
 
             if self.opts.output_format.lower() == 'png' and self.opts.colors:
                 img = quantize_image(img, max_colors=min(256, self.opts.colors))
-            dest = '%d_%d.%s'%(self.num, i, self.opts.output_format)
-            dest = os.path.join(self.dest, dest)
-            with lopen(dest, 'wb') as f:
-                f.write(image_to_data(img, fmt=self.opts.output_format))
-            self.append(dest)
+            self.append(image_to_data(img, fmt=self.opts.output_format))
 # }}}
 
 
-def render_pages(tasks, dest, opts, notification=lambda x, y: x):
+def render_page(path, num, common_data=None):
     '''
-    Entry point for the job server.
+    Entry point for the worker processes. Returns the rendered pages and the
+    thumbnail for the page at path.
     '''
-    failures, pages = [], []
-    for num, path in tasks:
-        try:
-            pages.extend(PageProcessor(path, dest, opts, num))
-            msg = _('Rendered %s')%path
-        except:
-            failures.append(path)
-            msg = _('Failed %s')%path
-            if opts.verbose:
-                msg += '\n' + traceback.format_exc()
-        prints(msg)
-        notification(0.5, msg)
-
-    return pages, failures
+    pp = PageProcessor(path, common_data, num)
+    return list(pp), pp.thumbnail
 
 
 class Progress(object):
@@ -236,42 +218,93 @@ class Progress(object):
         self.update(float(self.done)/self.total, msg)
 
 
-def process_pages(pages, opts, update, tdir):
+def process_pages(pages, opts, update, tdir, max_workers=None):
     '''
-    Render all identified comic pages.
+    Render all identified comic pages. By default, they are rendered in as
+    many worker processes as is sensible for the number of pages.
     '''
+    from calibre.ebooks.conversion.images import num_workers, process_images, timing_summary
     progress = Progress(len(pages), update)
-    server = Server()
-    jobs = []
-    tasks = [(p, os.path.join(tdir, os.path.basename(p))) for p in pages]
-    tasks = server.split(pages)
-    for task in tasks:
-        jobs.append(ParallelJob('render_pages', '', progress,
-                                args=[task, tdir, opts]))
-        server.add_job(jobs[-1])
-    while True:
-        time.sleep(1)
-        running = False
-        for job in jobs:
-            while True:
-                try:
-                    x = job.notifications.get_nowait()
-                    progress(*x)
-                except Empty:
-                    break
-            job.update()
-            if not job.is_finished:
-                running = True
-        if not running:
-            break
-    server.close()
-    ans, failures = [], []
-
-    for job in jobs:
-        if job.failed or job.result is None:
-            raise Exception(_('Failed to process comic: \n\n%s')%
-                    job.log_file.read())
-        pages, failures_ = job.result
-        ans += pages
-        failures += failures_
+    ans, failures, results = [], [], []
+    jobs = ((path, (path, num)) for num, path in enumerate(pages))
+    if max_workers is None:
+        max_workers = num_workers(len(pages))
+    for result in process_images(jobs, __name__, 'render_page', opts, max_workers, 'RenderComic'):
+        results.append(result)
+        if result.error is None:
+            rendered, thumbnail = result.value
+            num = len(results) - 1
+            if thumbnail is not None:
+                with lopen(os.path.join(tdir, 'thumbnail.png'), 'wb') as f:
+                    f.write(thumbnail)
+            for i, data in enumerate(rendered):
+                dest = os.path.join(tdir, '%d_%d.%s'%(num, i, opts.output_format))
+                with lopen(dest, 'wb') as f:
+                    f.write(data)
+                ans.append(dest)
+            msg = _('Rendered %s')%result.id
+        else:
+            failures.append(result.id)
+            msg = _('Failed %s')%result.id
+        if opts.verbose:
+            prints(msg, '(%.2f seconds)' % result.time)
+            if result.error is not None:
+                prints(result.error)
+        progress(0.5, msg)
+    if opts.verbose:
+        prints(timing_summary(results, 'pages'))
     return ans, failures
+
+
+def find_tests():
+    import shutil
+    import tempfile
+    import unittest
+    from io import BytesIO
+    from optparse import Values
+
+    class TestComicInput(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def test_process_pages(self):
+            from PIL import Image
+            from calibre.customize.ui import output_profiles
+            profile = [x for x in output_profiles() if x.short_name == 'default'][0]
+            opts = Values(dict(
+                landscape=False, right2left=False, disable_trim=True, dont_normalize=True, output_profile=profile,
+                comic_image_size='30x40', keep_aspect_ratio=False, wide=False, dont_sharpen=True, dont_grayscale=True,
+                despeckle=False, output_format='png', colors=0, verbose=False))
+            src = os.path.join(self.tdir, 'src')
+            os.mkdir(src)
+            pages = []
+            for i, size in enumerate(((60, 80), (160, 80), (60, 80), (60, 80))):
+                pages.append(os.path.join(src, '%d.png' % i))
+                Image.new('RGB', size, 'red').save(pages[-1], 'PNG')
+            bad = os.path.join(src, 'bad.png')
+            with open(bad, 'wb') as f:
+                f.write(b'not an image')
+            pages.insert(2, bad)
+
+            for max_workers in (1, 2):
+                tdir = os.path.join(self.tdir, 'out%d' % max_workers)
+                os.mkdir(tdir)
+                progress = []
+                rendered, failures = process_pages(pages, opts, lambda frac, msg: progress.append(frac), tdir, max_workers)
+                self.assertEqual(failures, [bad])
+                self.assertEqual(len(progress), len(pages))
+                self.assertEqual(progress[-1], 1)
+                # The landscape page is split into two
+                self.assertEqual([os.path.basename(x) for x in rendered], ['0_0.png', '1_0.png', '1_1.png', '3_0.png', '4_0.png'])
+                for path in rendered:
+                    with open(path, 'rb') as f:
+                        img = Image.open(BytesIO(f.read()))
+                    self.assertEqual(img.size, (30, 40))
+                with open(os.path.join(tdir, 'thumbnail.png'), 'rb') as f:
+                    self.assertEqual(Image.open(BytesIO(f.read())).format, 'PNG')
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestComicInput)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run many conversions in one process, or in a small pool of worker processes,
+so that the plugins, profiles and parsers are loaded only once, rather than
+once for every conversion.
+'''
+
+import gc
+import json
+import os
+import tempfile
+import traceback
+from collections import namedtuple
+
+from calibre import ptempfile
+from calibre.ptempfile import remove_dir
+from calibre.utils.logging import Log, Stream
+from polyglot.builtins import as_unicode, string_or_bytes
+from polyglot.queue import Empty
+
+# How often, in seconds, to check if the worker pool has failed while waiting
+# for the results of conversions
+RESULT_POLL_INTERVAL = 0.1
+
+ConversionJob = namedtuple('ConversionJob', 'input output args')
+ConversionResult = namedtuple('ConversionResult', 'job ok output')
+
+
+class InvalidJobs(ValueError):
+    pass
+
+
+def read_jobs(raw, base=None):
+    '''
+    Read a list of conversion jobs from JSON. It must be a list of objects of
+    the form: {"input": "book.epub", "output": "book.azw3", "args":
+    ["--output-profile", "kindle"]}, where args are ebook-convert command line
+    options and are optional. Relative paths are resolved relative to base, if
+    specified, otherwise relative to the current directory.
+    '''
+    try:
+        data = json.loads(raw)
+    except ValueError as err:
+        raise InvalidJobs('Invalid JSON: %s' % as_unicode(err))
+    if not isinstance(data, list):
+        raise InvalidJobs('The conversion jobs must be a list')
+    ans = []
+    for i, job in enumerate(data):
+        if not isinstance(job, dict) or not isinstance(job.get('input'), string_or_bytes) or not isinstance(job.get('output'), string_or_bytes):
+            raise InvalidJobs('Conversion job number %d does not specify input and output files' % (i + 1))
+        args = job.get('args', [])
+        if not isinstance(args, list) or not all(isinstance(x, string_or_bytes) for x in args):
+            raise InvalidJobs('The args of conversion job number %d must be a list of strings' % (i + 1))
+        inp, out = job['input'], job['output']
+        if base is not None:
+            inp, out = os.path.join(base, inp), os.path.join(base, out)
+        ans.append(ConversionJob(os.path.abspath(inp), os.path.abspath(out), tuple(args)))
+    return ans
+
+
+def convert_book(job, log):
+    ''' Convert a single book, exactly as ebook-convert would. Every
+    conversion uses its own temporary directory, which is deleted once it is
+    done, so that no files are left behind by one conversion for the next.
+    Returns True if the conversion succeeded. '''
+    from calibre.ebooks.conversion.cli import main
+    tdir = tempfile.mkdtemp(prefix='batch_', dir=ptempfile.base_dir())
+    prev, ptempfile._base_dir = ptempfile._base_dir, tdir
+    try:
+        ret = main(['ebook-convert', job.input, job.output] + list(job.args), log=log)
+    except SystemExit as err:
+        ret = err.code
+    except Exception:
+        log.error('Conversion of %s failed with error:' % job.input)
+        log.error(traceback.format_exc())
+        ret = 1
+    finally:
+        ptempfile._base_dir = prev
+        remove_dir(tdir)
+        # Break the reference cycles in the OEBBook of the conversion, so that
+        # memory usage does not grow with the number of conversions
+        gc.collect()
+    return not ret
+
+
+def job_log(log):
+    ''' A log for a single conversion that writes to the outputs of log. Every
+    conversion gets its own, so that the log level set by one conversion, for
+    example with --verbose, does not apply to the conversions after it. '''
+    ans = Log(level=log.filter_level)
+    ans.outputs = log.outputs
+    return ans
+
+
+def convert_in_worker(job):
+    log = Log()
+    log.outputs = [Stream()]
+    ok = convert_book(ConversionJob(*job), log)
+    return ok, log.outputs[0].stream.getvalue()
+
+
+def convert_books(jobs, log, num_workers=1, notify=None):
+    '''
+    Convert all the specified jobs. When num_workers is one, the conversions
+    are run in this process, one after another, otherwise in that many worker
+    processes, each of which runs many conversions. notify, if specified, is
+    called with a :class:`ConversionResult` as every conversion finishes.
+    Returns the list of results, in the order of jobs.
+    '''
+    results = {}
+
+    def finished(i, ok, output=''):
+        results[i] = r = ConversionResult(jobs[i], ok, output)
+        if notify is not None:
+            notify(r)
+
+    if num_workers < 2 or len(jobs) < 2:
+        for i, job in enumerate(jobs):
+            finished(i, convert_book(job, job_log(log)))
+        return [results[i] for i in range(len(jobs))]
+
+    from calibre.utils.ipc.pool import Failure, Pool
+
+    def handle_result(r):
+        # The jobs that were failed because of a crash in some other job are
+        # run again below
+        if not r.is_terminal_failure:
+            if r.result.err:
+                finished(r.id, False, r.result.traceback)
+            else:
+                finished(r.id, *r.result.value)
+
+    pool = Pool(max_workers=min(num_workers, len(jobs)), name='BatchConvert')
+    try:
+        for i, job in enumerate(jobs):
+            pool(i, __name__, 'convert_in_worker', tuple(job))
+        # The result of a job whose worker crashed is never queued, so wait
+        # for results only as long as the pool has not failed
+        while len(results) < len(jobs) and not pool.failed:
+            try:
+                handle_result(pool.results.get(timeout=RESULT_POLL_INTERVAL))
+            except Empty:
+                pass
+    except Failure:
+        pass
+    finally:
+        pool.shutdown()
+    while True:
+        try:
+            handle_result(pool.results.get_nowait())
+        except Empty:
+            break
+    tf = pool.terminal_failure
+    if tf is not None and tf.job_id is not None and tf.job_id not in results:
+        finished(tf.job_id, False, '%s\n%s' % (tf.message, tf.tb or ''))
+    remaining = [i for i in range(len(jobs)) if i not in results]
+    if remaining:
+        log.warn('The worker processes failed, converting the remaining %d books in this process' % len(remaining))
+        for i in remaining:
+            finished(i, convert_book(jobs[i], job_log(log)))
+    return [results[i] for i in range(len(jobs))]
+
+
+def main(args, log):
+    from calibre.ebooks.conversion.cli import option_parser
+    opts, leftover_args = option_parser().parse_args(list(args))
+    try:
+        with open(opts.batch, 'rb') as f:
+            jobs = read_jobs(f.read())
+    except (EnvironmentError, InvalidJobs) as err:
+        log.error('Failed to read conversion jobs from %s with error: %s' % (opts.batch, as_unicode(err)))
+        return 1
+    count = {'done': 0}
+
+    def notify(result):
+        count['done'] += 1
+        if result.output:
+            log(result.output)
+        msg = '[%d/%d] %s: %s -> %s' % (count['done'], len(jobs), 'OK' if result.ok else 'FAILED', result.job.input, result.job.output)
+        (log if result.ok else log.error)(msg)
+
+    results = convert_books(jobs, log, max(1, opts.batch_workers), notify)
+    failed = [r for r in results if not r.ok]
+    log('Converted %d of %d books' % (len(results) - len(failed), len(results)))
+    for r in failed:
+        log.error('Failed to convert:', r.job.input)
+    return 1 if failed else 0
+
+
+def find_tests():
+    import shutil
+    import unittest
+
+    class TestBatch(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def create_jobs(self, count):
+            ans = []
+            for i in range(count):
+                path = os.path.join(self.tdir, 'book%d.txt' % i)
+                with open(path, 'w') as f:
+                    f.write('Book %d\n\nSome text in book %d\n' % (i, i))
+                ans.append(ConversionJob(path, os.path.join(self.tdir, 'out%d.txt' % i), ()))
+            return ans
+
+        def convert(self, jobs, num_workers, check_tempfiles=True):
+            notified = []
+            log = Log()
+            log.outputs = [Stream()]
+            base_dir = ptempfile.base_dir()
+            before = set(os.listdir(base_dir))
+            results = convert_books(jobs, log, num_workers, notified.append)
+            self.assertEqual(ptempfile.base_dir(), base_dir)
+            if check_tempfiles:
+                self.assertEqual(set(os.listdir(base_dir)), before, 'Temporary files were left behind')
+            self.assertEqual([r.job for r in results], jobs)
+            self.assertEqual(sorted(notified, key=lambda r: jobs.index(r.job)), results)
+            return results
+
+        def test_convert_books(self):
+            for num_workers in (1, 2):
+                jobs = self.create_jobs(3)
+                jobs.append(ConversionJob(os.path.join(self.tdir, 'missing.txt'), os.path.join(self.tdir, 'missing.epub'), ()))
+                results = self.convert(jobs, num_workers)
+                self.assertEqual([r.ok for r in results], [True, True, True, False])
+                for i, job in enumerate(jobs[:3]):
+                    with open(job.output) as f:
+                        self.assertIn('Some text in book %d' % i, f.read())
+                    os.remove(job.output)
+                self.assertFalse(os.path.exists(jobs[-1].output))
+
+        def test_worker_crash(self):
+            crash = os.path.join(self.tdir, 'crash.recipe')
+            with open(crash, 'w') as f:
+                # Conversions are run in this process if the workers cannot
+                # be started, so only exit if running in a worker
+                f.write('import os\nif os.getpid() != %d:\n    os._exit(1)\nraise Exception("crash")\n' % os.getpid())
+            jobs = self.create_jobs(3)
+            jobs.insert(1, ConversionJob(crash, os.path.join(self.tdir, 'crash.epub'), ()))
+            # A worker that crashes cannot clean up after itself
+            results = self.convert(jobs, 2, check_tempfiles=False)
+            self.assertEqual([r.ok for r in results], [True, False, True, True])
+            for job in jobs[:1] + jobs[2:]:
+                self.assertTrue(os.path.exists(job.output))
+
+        def test_read_jobs(self):
+            jobs = read_jobs(json.dumps([
+                {'input': 'a.epub', 'output': 'a.azw3', 'args': ['--output-profile', 'kindle']},
+                {'input': '/b.epub', 'output': '/b.mobi'}]), base='/base')
+            self.assertEqual(jobs, [
+                ConversionJob(os.path.abspath('/base/a.epub'), os.path.abspath('/base/a.azw3'), ('--output-profile', 'kindle')),
+                ConversionJob(os.path.abspath('/b.epub'), os.path.abspath('/b.mobi'), ())])
+            for raw in ('{', '{}', '[{"input": "a.epub"}]', '[{"input": "a", "output": "b", "args": "--verbose"}]'):
+                self.assertRaises(InvalidJobs, read_jobs, raw)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBatch)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+from functools import partial
+from hashlib import sha1
+from threading import Lock
+
+from calibre.constants import cache_dir, numeric_version
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.lock import ExclusiveFile
+from polyglot.builtins import as_unicode
+
+CACHE_VERSION = 1
+DAY = 24 * 3600
+# Options that have no effect on the result of a conversion
+IGNORED_OPTIONS = frozenset((
+    'verbose', 'debug_pipeline', 'profile_pipeline', 'profile_pipeline_cprofile', 'parallel_transforms', 'memory_limit',
+    'input_cache_size'))
+# Options whose values are paths to files, the contents of the files, not
+# their paths, affect the result of a conversion
+FILE_OPTIONS = frozenset(('read_metadata_from_opf', 'cover', 'extra_css'))
+# Options of the pipeline, rather than of the input plugin, that affect the
+# result of reading and parsing the input, see :func:`input_stage_key`
+INPUT_STAGE_OPTIONS = frozenset((
+    'input_profile', 'output_profile', 'keep_ligatures', 'asciiize', 'smarten_punctuation',
+    'enable_heuristics', 'markup_chapter_headings', 'italicize_common_cases', 'fix_indents',
+    'html_unwrap_factor', 'unwrap_lines', 'delete_blank_paragraphs', 'format_scene_breaks',
+    'replace_scene_breaks', 'dehyphenate', 'renumber_headings', 'sr1_search', 'sr1_replace',
+    'sr2_search', 'sr2_replace', 'sr3_search', 'sr3_replace', 'search_replace'))
+# Input formats whose result is not cached, either because it is downloaded
+# or because the input file links to other files, such as images and
+# stylesheets, that are read with it, so that the contents of the input file
+# alone do not identify the result of reading it
+UNCACHED_INPUT_FORMATS = frozenset((
+    'recipe', 'downloaded_recipe', 'opf', 'html', 'htm', 'xhtml', 'xhtm', 'shtm', 'shtml',
+    'txt', 'text', 'md', 'textile', 'markdown', 'pml'))
+# Options that input plugins set to a parsed document of the book, mapped to
+# the option that is the href of that document. They are not stored in the
+# input cache, but re-created from the book read from the cache.
+PARSED_INPUT_OPTIONS = {'epub3_nav_parsed': 'epub3_nav_href'}
+
+
+def file_hash(path):
+    ans = sha1()
+    with lopen(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 64 * 1024), b''):
+            ans.update(chunk)
+    return ans.hexdigest()
+
+
+def normalized_options(recs):
+    ''' Convert a list of (name, value, level) recommendations into a dict that
+    is the same for all conversions that produce the same output. '''
+    ans = {}
+    for name, val, level in recs:
+        if name in IGNORED_OPTIONS:
+            continue
+        if name in FILE_OPTIONS and val and os.path.isfile(val):
+            val = file_hash(val)
+        ans[name] = val
+    return ans
+
+
+def conversion_key(input_path, output_fmt, recs):
+    ''' A key that identifies the result of converting the book at input_path
+    to output_fmt using the specified recommendations. It depends only on the
+    contents of the input files, not on where they are stored. '''
+    ext = os.path.splitext(input_path)[1].lower()
+    raw = json.dumps((
+        file_hash(input_path), ext, output_fmt.lower(), normalized_options(recs),
+        numeric_version, CACHE_VERSION), sort_keys=True, default=repr)
+    return as_unicode(sha1(raw.encode('utf-8')).hexdigest())
+
+
+def input_stage_key(input_path, input_fmt, opts, input_options):
+    ''' A key that identifies the result of reading and parsing the book at
+    input_path, which depends only on its contents, the input format and the
+    values in opts of the options of the input plugin, input_options, and of
+    the pipeline options that are used for parsing. It does not depend on the
+    output format or on the options used by the rest of the pipeline, so that
+    the result can be re-used when only those are changed. '''
+    names = sorted(INPUT_STAGE_OPTIONS | frozenset(input_options))
+    recs = [(name, getattr(opts, name, None), None) for name in names]
+    raw = json.dumps((
+        'input', file_hash(input_path), input_fmt.lower(), normalized_options(recs),
+        numeric_version, CACHE_VERSION), sort_keys=True, default=repr)
+    return as_unicode(sha1(raw.encode('utf-8')).hexdigest())
+
+
+def is_input_cacheable(input_fmt):
+    ' Whether the result of reading and parsing input files of the specified format can be cached '
+    return input_fmt.lower() not in UNCACHED_INPUT_FORMATS
+
+
+def input_cache(max_size):
+    ''' The cache of the results of reading and parsing the input of
+    conversions, used by :class:`calibre.ebooks.conversion.plumber.Plumber`. '''
+    return ConversionCache(os.path.join(cache_dir(), 'ic'), max_size=max_size)
+
+
+class ConversionCache(object):
+
+    '''
+    A cache of the results of conversions, on disk, keyed by
+    :func:`conversion_key`. The cache can be shared by several processes. When
+    it becomes larger than max_size bytes, the least recently used results are
+    removed from it. '''
+
+    def __init__(self, path=None, max_size=256 * 1024 * 1024):
+        self.path = path or os.path.join(cache_dir(), 'cc')
+        self.max_size = max_size
+        self.stats_lock = Lock()
+        self.hits = self.misses = 0
+
+    def ensure_dir(self):
+        try:
+            os.makedirs(self.path)
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def lock(self):
+        self.ensure_dir()
+        return ExclusiveFile(os.path.join(self.path, 'lock'))
+
+    def result_path(self, key, fmt):
+        return os.path.join(self.path, key + '.' + fmt.lower())
+
+    def get(self, key, fmt, dest):
+        ''' Copy the cached result of the conversion identified by key to the
+        file dest. Returns True if the result was found in the cache. '''
+        path = self.result_path(key, fmt)
+        src = None
+        with self.lock():
+            try:
+                src = lopen(path, 'rb')
+            except EnvironmentError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            else:
+                # Mark the result as recently used
+                os.utime(path, None)
+        with self.stats_lock:
+            if src is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if src is None:
+            return False
+        with src, lopen(dest, 'wb') as f:
+            shutil.copyfileobj(src, f)
+        return True
+
+    def put(self, key, fmt, src):
+        ''' Store a copy of the file src as the result of the conversion
+        identified by key. '''
+        self.ensure_dir()
+        fd, tpath = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f, lopen(src, 'rb') as s:
+                shutil.copyfileobj(s, f)
+            with self.lock():
+                atomic_rename(tpath, self.result_path(key, fmt))
+                self.prune()
+        except Exception:
+            try:
+                os.remove(tpath)
+            except EnvironmentError:
+                pass
+            raise
+
+    def entries(self):
+        # Must be called with the lock held
+        ans = []
+        for x in os.listdir(self.path):
+            if x == 'lock':
+                continue
+            path = os.path.join(self.path, x)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            ans.append((st.st_mtime, st.st_size, path))
+        return ans
+
+    def prune(self):
+        # Must be called with the lock held
+        now = time.time()
+        entries = []
+        for mtime, size, path in self.entries():
+            if path.endswith('.tmp'):
+                # Left behind by a process that crashed while storing a result
+                if now - mtime > DAY:
+                    self.remove(path)
+            else:
+                entries.append((mtime, size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if self.remove(path):
+                total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            return False
+        return True
+
+    @property
+    def stats(self):
+        with self.lock():
+            entries = [e for e in self.entries() if not e[2].endswith('.tmp')]
+        with self.stats_lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'cached_results': len(entries), 'cache_size': sum(e[1] for e in entries)
+            }
+
+
+def find_tests():
+    import unittest
+    from calibre.utils.filenames import rmtree
+
+    class TestConversionCache(unittest.TestCase):
+
+        ae = unittest.TestCase.assertEqual
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            rmtree(self.tdir)
+
+        def write(self, name, data):
+            path = os.path.join(self.tdir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return path
+
+        def read(self, path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        def test_conversion_key(self):
+            book = self.write('book.epub', b'book')
+            opf1, opf2 = self.write('1.opf', b'opf'), self.write('2.opf', b'opf')
+            k = conversion_key(book, 'MOBI', [('read_metadata_from_opf', opf1, 1), ('verbose', 2, 1)])
+            self.ae(k, conversion_key(book, 'mobi', [('read_metadata_from_opf', opf2, 1)]))
+            self.assertNotEqual(k, conversion_key(book, 'azw3', [('read_metadata_from_opf', opf1, 1)]))
+            self.assertNotEqual(k, conversion_key(book, 'mobi', [('read_metadata_from_opf', opf1, 1), ('base_font_size', 12, 1)]))
+            self.write('2.opf', b'changed metadata')
+            self.assertNotEqual(k, conversion_key(book, 'mobi', [('read_metadata_from_opf', opf2, 1)]))
+            self.write('book.epub', b'changed book')
+            self.assertNotEqual(k, conversion_key(book, 'mobi', [('read_metadata_from_opf', opf1, 1)]))
+
+        def test_input_stage_key(self):
+            class Options(object):
+                pass
+            book = self.write('book.docx', b'book')
+            opts = Options()
+            opts.docx_no_cover, opts.enable_heuristics, opts.base_font_size, opts.verbose = False, False, 12, 0
+            k = input_stage_key(book, 'docx', opts, ('docx_no_cover',))
+            opts.base_font_size, opts.verbose = 15, 2
+            self.ae(k, input_stage_key(book, 'docx', opts, ('docx_no_cover',)))
+            opts.enable_heuristics = True
+            self.assertNotEqual(k, input_stage_key(book, 'docx', opts, ('docx_no_cover',)))
+            opts.enable_heuristics = False
+            opts.docx_no_cover = True
+            self.assertNotEqual(k, input_stage_key(book, 'docx', opts, ('docx_no_cover',)))
+            opts.docx_no_cover = False
+            self.assertNotEqual(k, conversion_key(book, 'docx', []))
+            self.assertTrue(is_input_cacheable('DOCX'))
+            for fmt in ('html', 'OPF', 'txt', 'md', 'recipe'):
+                self.assertFalse(is_input_cacheable(fmt))
+
+        def test_conversion_cache(self):
+            cache = ConversionCache(os.path.join(self.tdir, 'cache'), max_size=10)
+            dest = os.path.join(self.tdir, 'dest')
+            self.assertFalse(cache.get('a', 'epub', dest))
+            cache.put('a', 'epub', self.write('a', b'aaaa'))
+            self.assertTrue(cache.get('a', 'epub', dest))
+            self.ae(self.read(dest), b'aaaa')
+            self.assertFalse(cache.get('a', 'mobi', dest))
+            self.ae(cache.stats, {'hits': 1, 'misses': 2, 'cached_results': 1, 'cache_size': 4})
+            cache.put('b', 'epub', self.write('b', b'bbbb'))
+            os.utime(cache.result_path('a', 'epub'), (time.time() + 10,) * 2)
+            # b is now the least recently used result and is removed
+            cache.put('c', 'epub', self.write('c', b'cccc'))
+            self.assertFalse(cache.get('b', 'epub', dest))
+            self.assertTrue(cache.get('a', 'epub', dest))
+            self.assertTrue(cache.get('c', 'epub', dest))
+            self.ae(self.read(dest), b'cccc')
+            self.ae(cache.stats['cache_size'], 8)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestConversionCache)
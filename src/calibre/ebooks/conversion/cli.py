@@ -185,6 +185,9 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'parallel_transforms',
+                     'memory_limit',
+                     'input_cache_size',
                      ]
                     )),
               (_('LOOK AND FEEL') , (
@@ -252,6 +255,8 @@ def add_pipeline_options(parser, plumber):
                         [
                          'verbose',
                          'debug_pipeline',
+                         'profile_pipeline',
+                         'profile_pipeline_cprofile',
                          ])),
 
               ))
@@ -274,6 +279,19 @@ def option_parser():
             help=_('List builtin recipe names. You can create an e-book from '
                 'a builtin recipe like this: ebook-convert "Recipe Name.recipe" '
                 'output.epub'))
+    parser.add_option('--batch', default=None,
+            help=_('Run all the conversions in the specified JSON file, one '
+                'after another, in a single process, which is much faster '
+                'than running ebook-convert once per conversion. The file '
+                'must contain a list of conversions, of the form: '
+                '[{"input": "book.epub", "output": "book.azw3", "args": '
+                '["--output-profile", "kindle"]}], where args are '
+                'ebook-convert options and are optional. For example: '
+                'ebook-convert --batch jobs.json'))
+    parser.add_option('--batch-workers', default=1, type='int',
+            help=_('The number of worker processes to use for the '
+                'conversions in the file specified with --batch. Each worker '
+                'process runs many conversions. Default is %default.'))
     return parser
 
 
@@ -367,8 +385,12 @@ def read_sr_patterns(path, log=None):
     return json.dumps(pats)
 
 
-def main(args=sys.argv):
-    log = Log()
+def main(args=sys.argv, log=None):
+    if log is None:
+        log = Log()
+    if any(x == '--batch' or x.startswith('--batch=') for x in args):
+        from calibre.ebooks.conversion.batch import main
+        return main(args, log)
     parser, plumber = create_option_parser(args, log)
     opts, leftover_args = parser.parse_args(args)
     if len(leftover_args) > 3:
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Process many images, such as the pages of comics or the images of a book that
+have to be rescaled, in a pool of worker processes. The image data is sent to
+and received from the workers in memory, not via temporary files, and the time
+taken to process every image is recorded, so that slow images can be found.
+'''
+
+import traceback
+from collections import deque, namedtuple
+from importlib import import_module
+
+from calibre import detect_ncpus
+from calibre.utils.monotonic import monotonic
+from polyglot.queue import Empty
+
+# Starting the worker processes takes a few seconds, so fewer images than this
+# are processed in this process
+MIN_PARALLEL_IMAGES = 8
+# The number of images queued for every worker, more images are queued only
+# as they are done, so that the data of all the images is not in memory at once
+QUEUED_PER_WORKER = 2
+# How often, in seconds, to check if the worker pool has failed while waiting
+# for the results of images
+RESULT_POLL_INTERVAL = 0.1
+
+ImageResult = namedtuple('ImageResult', 'id value error time')
+
+
+def num_workers(count):
+    ' The number of worker processes to use for count images '
+    return min(detect_ncpus(), count) if count >= MIN_PARALLEL_IMAGES else 1
+
+
+def process_image(module, func, args, common_data=None):
+    ''' Call func from module with args, returning its result, the traceback
+    if it failed and the time it took. Errors are returned rather than raised
+    so that a bad image does not cause the whole pool to be considered failed. '''
+    start = monotonic()
+    try:
+        value, error = getattr(import_module(module), func)(*args, common_data=common_data), None
+    except Exception:
+        value, error = None, traceback.format_exc()
+    return value, error, monotonic() - start
+
+
+def process_images(jobs, module, func, common_data=None, max_workers=1, name='ProcessImages'):
+    '''
+    Process images by calling func from module, with the arguments of every
+    job in jobs, an iterable of (id, args) and common_data as a keyword
+    argument. The arguments and the return value must be picklable, typically
+    the image data as bytes. Yields an :class:`ImageResult` for every job, in
+    the order of jobs. When max_workers is more than one, the images are
+    processed in that many worker processes, the jobs are consumed as workers
+    become free. If the workers fail, the images whose results were not
+    received are processed in this process.
+    '''
+    jobs = iter(jobs)
+    if max_workers > 1:
+        from calibre.utils.ipc.pool import Failure, Pool
+        pool = Pool(max_workers=max_workers, name=name)
+        pending, results, count = deque(), {}, 0
+
+        def add_result(r):
+            # An error here means the job could not be run in the worker at
+            # all, so it is run in this process instead
+            results[r.id] = None if r.result.err else r.result.value
+
+        try:
+            if common_data is not None:
+                pool.set_common_data(common_data)
+            while True:
+                while len(pending) < max_workers * QUEUED_PER_WORKER:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    pending.append((count, job))
+                    pool(count, __name__, 'process_image', module, func, job[1])
+                    count += 1
+                if not pending:
+                    break
+                while pending and pending[0][0] in results:
+                    i, (job_id, args) = pending.popleft()
+                    yield ImageResult(job_id, *(results.pop(i) or process_image(module, func, args, common_data)))
+                if pending:
+                    try:
+                        r = pool.results.get(timeout=RESULT_POLL_INTERVAL)
+                    except Empty:
+                        # The result of an image whose worker crashed is
+                        # never queued
+                        if pool.failed:
+                            break
+                        continue
+                    if r.is_terminal_failure:
+                        break
+                    add_result(r)
+        except Failure:
+            pass
+        finally:
+            pool.shutdown()
+        while True:
+            try:
+                r = pool.results.get_nowait()
+            except Empty:
+                break
+            if not r.is_terminal_failure:
+                add_result(r)
+        for i, (job_id, args) in pending:
+            yield ImageResult(job_id, *(results.get(i) or process_image(module, func, args, common_data)))
+    for job_id, args in jobs:
+        yield ImageResult(job_id, *process_image(module, func, args, common_data))
+
+
+def timing_summary(results, what='images'):
+    ' A message summarizing the time taken to process the images in results '
+    if not results:
+        return 'No %s were processed' % what
+    slowest = max(results, key=lambda r: r.time)
+    total = sum(r.time for r in results)
+    return 'Processed %d %s in %.2f seconds (%.3f seconds per image), the slowest was %s in %.2f seconds' % (
+        len(results), what, total, total / len(results), slowest.id, slowest.time)
+
+
+def find_tests():
+    import unittest
+
+    class TestImages(unittest.TestCase):
+
+        def test_process_images(self):
+            from io import BytesIO
+            from PIL import Image
+
+            def image(width, height):
+                buf = BytesIO()
+                Image.new('RGB', (width, height), 'red').save(buf, 'PNG')
+                return buf.getvalue()
+
+            module = 'calibre.ebooks.oeb.transforms.rescale'
+            jobs = [(i, (image(10 + i, 20), 'PNG', 5 + i, 10, False)) for i in range(3)]
+            jobs.insert(1, ('bad', (b'not an image', 'PNG', 5, 10, False)))
+            results = list(process_images(jobs, module, 'rescale_image'))
+            self.assertEqual([r.id for r in results], [0, 'bad', 1, 2])
+            self.assertIsNotNone(results[1].error)
+            for r in results[:1] + results[2:]:
+                self.assertIsNone(r.error)
+                self.assertEqual(Image.open(BytesIO(r.value)).size, (5 + r.id, 10))
+            self.assertIn('Processed 4 images', timing_summary(results))
+            self.assertEqual(num_workers(MIN_PARALLEL_IMAGES - 1), 1)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestImages)
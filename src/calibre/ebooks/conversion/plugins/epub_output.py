@@ -197,14 +197,17 @@ class EPUBOutput(OutputFormatPlugin):
         self.workaround_ade_quirks()
         self.workaround_webkit_quirks()
         self.upshift_markup()
+        from calibre.ebooks.conversion.profile import profile_stage
         from calibre.ebooks.oeb.transforms.rescale import RescaleImages
-        RescaleImages(check_colorspaces=True)(oeb, opts)
+        with profile_stage('RescaleImages'):
+            RescaleImages(check_colorspaces=True)(oeb, opts)
 
         from calibre.ebooks.oeb.transforms.split import Split
         split = Split(not self.opts.dont_split_on_page_breaks,
                 max_flow_size=self.opts.flow_size*1024
                 )
-        split(self.oeb, self.opts)
+        with profile_stage('Split'):
+            split(self.oeb, self.opts)
 
         from calibre.ebooks.oeb.transforms.cover import CoverManager
         cm = CoverManager(
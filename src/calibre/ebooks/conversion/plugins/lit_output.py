@@ -23,10 +23,12 @@ class LITOutput(OutputFormatPlugin):
         from calibre.ebooks.oeb.transforms.rasterize import SVGRasterizer
         from calibre.ebooks.oeb.transforms.htmltoc import HTMLTOCAdder
         from calibre.ebooks.lit.writer import LitWriter
+        from calibre.ebooks.conversion.profile import profile_stage
         from calibre.ebooks.oeb.transforms.split import Split
         split = Split(split_on_page_breaks=True, max_flow_size=0,
                 remove_css_pagebreaks=False)
-        split(self.oeb, self.opts)
+        with profile_stage('Split'):
+            split(self.oeb, self.opts)
 
         tocadder = HTMLTOCAdder()
         tocadder(oeb, opts)
@@ -200,8 +200,10 @@ class MOBIOutput(OutputFormatPlugin):
             from calibre.ebooks.mobi.writer8.cleanup import remove_duplicate_anchors
             remove_duplicate_anchors(self.oeb)
             # Split on pagebreaks so that the resulting KF8 is faster to load
+            from calibre.ebooks.conversion.profile import profile_stage
             from calibre.ebooks.oeb.transforms.split import Split
-            Split()(self.oeb, self.opts)
+            with profile_stage('Split'):
+                Split()(self.oeb, self.opts)
 
         kf8 = self.create_kf8(resources, for_joint=mobi_type=='both'
                 ) if create_kf8 else None
@@ -324,8 +326,10 @@ class AZW3Output(OutputFormatPlugin):
             remove_html_cover(self.oeb, self.log)
 
             # Split on pagebreaks so that the resulting KF8 is faster to load
+            from calibre.ebooks.conversion.profile import profile_stage
             from calibre.ebooks.oeb.transforms.split import Split
-            Split()(self.oeb, self.opts)
+            with profile_stage('Split'):
+                Split()(self.oeb, self.opts)
 
         kf8 = create_kf8_book(self.oeb, self.opts, resources, for_joint=False)
 
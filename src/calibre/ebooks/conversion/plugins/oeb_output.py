@@ -68,6 +68,7 @@ class OEBOutput(OutputFormatPlugin):
                 with lopen(path, 'wb') as f:
                     f.write(item.bytes_representation)
                 item.unload_data_from_memory(memory=path)
+                oeb_book.manifest.enforce_memory_limit()
 
     def workaround_nook_cover_bug(self, root):  # {{{
         cov = root.xpath('//*[local-name() = "meta" and @name="cover" and'
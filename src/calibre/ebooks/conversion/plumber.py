@@ -5,7 +5,8 @@ __license__ = 'GPL 3'
 __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, re, sys, shutil, pprint, json
+import os, re, sys, shutil, pprint, json, gc
+from contextlib import contextmanager
 from functools import partial
 
 from calibre.customize.conversion import OptionRecommendation, DummyReporter
@@ -14,13 +15,14 @@ from calibre.customize.ui import input_profiles, output_profiles, \
         available_input_formats, available_output_formats, \
         run_plugins_on_preprocess, run_plugins_on_postprocess
 from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+from calibre.ebooks.conversion.profile import PipelineProfiler, profile_stage, report_path
 from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.utils.date import parse_date
 from calibre.utils.zipfile import ZipFile
 from calibre import (extract, walk, isbytestring, filesystem_encoding,
         get_types_map)
 from calibre.constants import __version__
-from polyglot.builtins import unicode_type, string_or_bytes, map
+from polyglot.builtins import iteritems, unicode_type, string_or_bytes, map
 
 DEBUG_README=b'''
 This debug directory contains snapshots of the e-book as it passes through the
@@ -127,6 +129,51 @@ OptionRecommendation(name='debug_pipeline',
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='profile_pipeline',
+            recommended_value=None, level=OptionRecommendation.LOW,
+            help=_('Record the time and memory used by the different stages '
+                   'of the conversion pipeline and by the transforms run in them, '
+                   'and save it as a JSON report in the specified directory. Use '
+                   'the same directory for many conversions to find out where '
+                   'they spend their time.')
+        ),
+
+OptionRecommendation(name='profile_pipeline_cprofile',
+            recommended_value=False, level=OptionRecommendation.LOW,
+            help=_('When using --profile-pipeline, also save the statistics '
+                   'from the Python profiler for every stage of the conversion '
+                   'pipeline, next to the report.')
+        ),
+
+OptionRecommendation(name='memory_limit',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Limit the memory used to hold the contents of the files in '
+                   'the book to approximately this many megabytes. When the limit '
+                   'is exceeded, the least recently used files are written to '
+                   'disk and read back when needed. Useful for converting very '
+                   'large books, such as comics, at the cost of slower '
+                   'conversion. The default of zero means no limit.')
+        ),
+
+OptionRecommendation(name='parallel_transforms',
+            recommended_value=False, level=OptionRecommendation.LOW,
+            help=_('Run the transforms that process each HTML file in the book '
+                   'separately, such as CSS flattening, in several worker '
+                   'processes at once. This makes converting books with many '
+                   'files faster on computers with several CPU cores, at the '
+                   'cost of using more memory.')
+        ),
+
+OptionRecommendation(name='input_cache_size',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Keep the result of reading and parsing the input file in a '
+                   'cache of up to this many megabytes, so that converting '
+                   'the same book again with different output options does not '
+                   'have to read it again. The least recently used books are '
+                   'removed from the cache when it becomes larger than this. The '
+                   'default of zero means no cache is used.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1041,6 +1088,77 @@ OptionRecommendation(name='search_replace',
 
         self.log.info('Input debug saved to:', out_dir)
 
+    def cache_input(self, cache, key, opts_before, attrs_before):
+        ''' Store the OEBBook created from the input, and the changes the input
+        plugin made to the options and to itself, which are needed to process the
+        book further, in the input cache. '''
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.ebooks.conversion.cache import PARSED_INPUT_OPTIONS
+        from calibre.ebooks.oeb.writer import OEBWriter
+        state = {'options': {}, 'plugin': {}}
+        for which, obj, before in (('options', self.opts, opts_before), ('plugin', self.input_plugin, attrs_before)):
+            for k, v in iteritems(vars(obj)):
+                if (k in before and before[k] == v) or (which == 'options' and k in PARSED_INPUT_OPTIONS):
+                    continue
+                try:
+                    json.dumps(v)
+                except (TypeError, ValueError):
+                    if which == 'options':
+                        self.log.warn('Not caching the input as the option %s cannot be stored' % k)
+                        return
+                    # Attributes of input plugins used after the input stage
+                    # are simple values, the others are not needed
+                    continue
+                state[which][k] = v
+        # Attributes of the book that are not stored in its OPF
+        state['book'] = {k: getattr(self.oeb, k) for k in ('auto_generated_toc', 'version') if hasattr(self.oeb, k)}
+        try:
+            with TemporaryDirectory('_input_cache') as tdir:
+                OEBWriter(page_map=True)(self.oeb, os.path.join(tdir, 'book'))
+                with lopen(os.path.join(tdir, 'state.json'), 'wb') as f:
+                    f.write(json.dumps(state).encode('utf-8'))
+                zpath = os.path.join(tdir, 'input.zip')
+                with ZipFile(zpath, 'w') as zf:
+                    zf.add_dir(os.path.join(tdir, 'book'), prefix='book')
+                    zf.write(os.path.join(tdir, 'state.json'), 'state.json')
+                cache.put(key, 'zip', zpath)
+        except Exception:
+            self.log.exception('Failed to cache the result of reading the input file')
+
+    def read_cached_input(self, cache, key, tdir):
+        ''' Create the OEBBook from the input cache, returning False if the input
+        is not in it. '''
+        zpath = os.path.join(tdir, 'input_cache.zip')
+        try:
+            if not cache.get(key, 'zip', zpath):
+                return False
+            out_dir = os.path.join(tdir, 'input_cache')
+            with ZipFile(zpath) as zf:
+                zf.extractall(out_dir)
+            os.remove(zpath)
+            with lopen(os.path.join(out_dir, 'state.json'), 'rb') as f:
+                state = json.loads(f.read())
+        except Exception:
+            self.log.exception('Failed to read the cached result of reading the input file, ignoring it')
+            return False
+        for k, v in iteritems(state['options']):
+            setattr(self.opts, k, v)
+        for k, v in iteritems(state['plugin']):
+            setattr(self.input_plugin, k, v)
+        with profile_stage('parse'):
+            self.oeb = create_oebbook(
+                self.log, os.path.join(out_dir, 'book', 'content.opf'), self.opts,
+                html_preprocessor=NullPreprocessor(),
+                removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
+        for k, v in iteritems(state['book']):
+            setattr(self.oeb, k, v)
+        from calibre.ebooks.conversion.cache import PARSED_INPUT_OPTIONS
+        for k, href_option in iteritems(PARSED_INPUT_OPTIONS):
+            item = self.oeb.manifest.hrefs.get(getattr(self.opts, href_option, None))
+            if item is not None:
+                setattr(self.opts, k, item.data)
+        return True
+
     def run(self):
         '''
         Run the conversion pipeline
@@ -1071,6 +1189,25 @@ OptionRecommendation(name='search_replace',
                 if os.path.exists(x):
                     shutil.rmtree(x)
 
+        if not self.opts.profile_pipeline:
+            return self.run_pipeline()
+        out_dir = os.path.abspath(self.opts.profile_pipeline)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        report = report_path(out_dir, self.input, self.output_fmt)
+        profiler = PipelineProfiler(cprofile=self.opts.profile_pipeline_cprofile, cprofile_dir=report.rpartition('.')[0])
+        failed = True
+        try:
+            with profiler.activated():
+                ret = self.run_pipeline()
+            failed = False
+            return ret
+        finally:
+            profiler.write_report(report, input=self.input, output=self.output, input_format=self.input_fmt,
+                                  output_format=self.output_fmt, failed=failed)
+            self.log('Pipeline profile written to:', report)
+
+    def run_pipeline(self):
         # Run any preprocess plugins
         from calibre.customize.ui import run_plugins_on_preprocess
         self.input = run_plugins_on_preprocess(self.input)
@@ -1104,24 +1241,39 @@ OptionRecommendation(name='search_replace',
         if self.for_regex_wizard:
             self.input_plugin.for_viewer = True
         self.output_plugin.specialize_options(self.log, self.opts, self.input_fmt)
+        cache = key = None
+        if self.opts.input_cache_size > 0 and self.opts.debug_pipeline is None and not self.for_regex_wizard:
+            from calibre.ebooks.conversion.cache import input_cache, input_stage_key, is_input_cacheable
+            if is_input_cacheable(self.input_fmt):
+                cache = input_cache(self.opts.input_cache_size * 1024 * 1024)
+                key = input_stage_key(self.input, self.input_fmt, self.opts, (x.option.name for x in self.input_options))
         with self.input_plugin:
-            self.oeb = self.input_plugin(stream, self.opts,
-                                        self.input_fmt, self.log,
-                                        accelerators, tdir)
-            if self.opts.debug_pipeline is not None:
-                self.dump_input(self.oeb, tdir)
-                if self.abort_after_input_dump:
+            if cache is not None and self.read_cached_input(cache, key, tdir):
+                self.log('Using the cached result of reading the input file')
+            else:
+                opts_before, attrs_before = dict(vars(self.opts)), dict(vars(self.input_plugin))
+                with profile_stage('input'):
+                    self.oeb = self.input_plugin(stream, self.opts,
+                                                self.input_fmt, self.log,
+                                                accelerators, tdir)
+                if self.opts.debug_pipeline is not None:
+                    self.dump_input(self.oeb, tdir)
+                    if self.abort_after_input_dump:
+                        return
+                if self.input_fmt in ('recipe', 'downloaded_recipe'):
+                    self.opts_to_mi(self.user_metadata)
+                if not hasattr(self.oeb, 'manifest'):
+                    with profile_stage('parse'):
+                        self.oeb = create_oebbook(
+                            self.log, self.oeb, self.opts,
+                            encoding=self.input_plugin.output_encoding,
+                            for_regex_wizard=self.for_regex_wizard, removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
+                if self.for_regex_wizard:
                     return
-            if self.input_fmt in ('recipe', 'downloaded_recipe'):
-                self.opts_to_mi(self.user_metadata)
-            if not hasattr(self.oeb, 'manifest'):
-                self.oeb = create_oebbook(
-                    self.log, self.oeb, self.opts,
-                    encoding=self.input_plugin.output_encoding,
-                    for_regex_wizard=self.for_regex_wizard, removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
-            if self.for_regex_wizard:
-                return
-            self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
+                if cache is not None:
+                    self.cache_input(cache, key, opts_before, attrs_before)
+            with profile_stage('postprocess'):
+                self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
             pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
             self.flush()
@@ -1129,17 +1281,60 @@ OptionRecommendation(name='search_replace',
                 out_dir = os.path.join(self.opts.debug_pipeline, 'parsed')
                 self.dump_oeb(self.oeb, out_dir)
                 self.log('Parsed HTML written to:', out_dir)
-            self.input_plugin.specialize(self.oeb, self.opts, self.log,
-                    self.output_fmt)
+            with profile_stage('specialize'):
+                self.input_plugin.specialize(self.oeb, self.opts, self.log,
+                        self.output_fmt)
+            if self.opts.memory_limit > 0 and self.oeb.manifest.memory is None:
+                # The book was created by the input plugin
+                self.oeb.manifest.set_memory_limit(self.opts.memory_limit * 1024 * 1024)
+            self.oeb.manifest.enforce_memory_limit()
+
+        with profile_stage('transforms'):
+            self.run_transforms(pr)
+
+        if self.opts.debug_pipeline is not None:
+            out_dir = os.path.join(self.opts.debug_pipeline, 'processed')
+            self.dump_oeb(self.oeb, out_dir)
+            self.log('Processed HTML written to:', out_dir)
+
+        self.log.info('Creating %s...'%self.output_plugin.name)
+        our = CompositeProgressReporter(0.67, 1., self.ui_reporter)
+        self.output_plugin.report_progress = our
+        our(0., _('Running %s plugin')%self.output_plugin.name)
+        with self.output_plugin, profile_stage('output'):
+            self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
+                self.opts, self.log)
+        self.oeb.clean_temp_files()
+        self.ui_reporter(1.)
+        run_plugins_on_postprocess(self.output, self.output_fmt)
 
+        self.log(self.output_fmt.upper(), 'output written to', self.output)
+        self.flush()
+
+    @contextmanager
+    def stage(self, name):
+        ''' Run a stage of the pipeline that transforms the OEBBook. It is
+        profiled, if requested, and once it is done the data of the items in the
+        manifest is spilled to disk, if the memory limit is exceeded. '''
+        with profile_stage(name):
+            yield
+        if self.oeb.manifest.memory is not None:
+            # Free parsed data referenced only from reference cycles, such as
+            # those in a Stylizer, so that spilling it actually frees memory
+            gc.collect()
+            self.oeb.manifest.enforce_memory_limit()
+
+    def run_transforms(self, pr):
         pr(0., _('Running transforms on e-book...'))
 
         self.oeb.plumber_output_format = self.output_fmt or ''
 
         from calibre.ebooks.oeb.transforms.data_url import DataURL
-        DataURL()(self.oeb, self.opts)
+        with self.stage('DataURL'):
+            DataURL()(self.oeb, self.opts)
         from calibre.ebooks.oeb.transforms.guide import Clean
-        Clean()(self.oeb, self.opts)
+        with self.stage('Clean'):
+            Clean()(self.oeb, self.opts)
         pr(0.1)
         self.flush()
 
@@ -1147,15 +1342,18 @@ OptionRecommendation(name='search_replace',
         self.opts.dest = self.opts.output_profile
 
         from calibre.ebooks.oeb.transforms.jacket import RemoveFirstImage
-        RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
+        with self.stage('RemoveFirstImage'):
+            RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
         from calibre.ebooks.oeb.transforms.metadata import MergeMetadata
-        MergeMetadata()(self.oeb, self.user_metadata, self.opts,
-                override_input_metadata=self.override_input_metadata)
+        with self.stage('MergeMetadata'):
+            MergeMetadata()(self.oeb, self.user_metadata, self.opts,
+                    override_input_metadata=self.override_input_metadata)
         pr(0.2)
         self.flush()
 
         from calibre.ebooks.oeb.transforms.structure import DetectStructure
-        DetectStructure()(self.oeb, self.opts)
+        with self.stage('DetectStructure'):
+            DetectStructure()(self.oeb, self.opts)
         pr(0.35)
         self.flush()
 
@@ -1181,7 +1379,8 @@ OptionRecommendation(name='search_replace',
                 fkey = self.opts.dest.fkey
 
         from calibre.ebooks.oeb.transforms.jacket import Jacket
-        Jacket()(self.oeb, self.opts, self.user_metadata)
+        with self.stage('Jacket'):
+            Jacket()(self.oeb, self.opts, self.user_metadata)
         pr(0.4)
         self.flush()
 
@@ -1206,11 +1405,13 @@ OptionRecommendation(name='search_replace',
         if self.opts.linearize_tables and \
                 self.output_plugin.file_type not in ('mobi', 'lrf'):
             from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
-            LinearizeTables()(self.oeb, self.opts)
+            with self.stage('LinearizeTables'):
+                LinearizeTables()(self.oeb, self.opts)
 
         if self.opts.unsmarten_punctuation:
             from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
-            UnsmartenPunctuation()(self.oeb, self.opts)
+            with self.stage('UnsmartenPunctuation'):
+                UnsmartenPunctuation()(self.oeb, self.opts)
 
         mobi_file_type = getattr(self.opts, 'mobi_file_type', 'old')
         needs_old_markup = (self.output_plugin.file_type == 'lit' or (
@@ -1228,8 +1429,13 @@ OptionRecommendation(name='search_replace',
                     'lit'),
                 transform_css_rules=transform_css_rules,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
-                    self.log, self.opts))
-        flattener(self.oeb, self.opts)
+                    self.log, self.opts),
+                parallel=self.opts.parallel_transforms)
+        with self.stage('CSSFlattener'):
+            flattener(self.oeb, self.opts)
+            # Release the stylizers, which reference the parsed data of all
+            # items, before it is spilled to disk
+            del flattener
         self.opts._final_base_font_size = fbase
 
         self.opts.insert_blank_line = oibl
@@ -1237,16 +1443,20 @@ OptionRecommendation(name='search_replace',
 
         from calibre.ebooks.oeb.transforms.page_margin import \
             RemoveFakeMargins, RemoveAdobeMargins
-        RemoveFakeMargins()(self.oeb, self.log, self.opts)
-        RemoveAdobeMargins()(self.oeb, self.log, self.opts)
+        with self.stage('RemoveFakeMargins'):
+            RemoveFakeMargins()(self.oeb, self.log, self.opts)
+        with self.stage('RemoveAdobeMargins'):
+            RemoveAdobeMargins()(self.oeb, self.log, self.opts)
 
         if self.opts.embed_all_fonts:
             from calibre.ebooks.oeb.transforms.embed_fonts import EmbedFonts
-            EmbedFonts()(self.oeb, self.log, self.opts)
+            with self.stage('EmbedFonts'):
+                EmbedFonts()(self.oeb, self.log, self.opts)
 
         if self.opts.subset_embedded_fonts and self.output_plugin.file_type != 'pdf':
             from calibre.ebooks.oeb.transforms.subset import SubsetFonts
-            SubsetFonts()(self.oeb, self.log, self.opts)
+            with self.stage('SubsetFonts'):
+                SubsetFonts()(self.oeb, self.log, self.opts)
 
         pr(0.9)
         self.flush()
@@ -1255,31 +1465,13 @@ OptionRecommendation(name='search_replace',
 
         self.log.info('Cleaning up manifest...')
         trimmer = ManifestTrimmer()
-        trimmer(self.oeb, self.opts)
+        with self.stage('ManifestTrimmer'):
+            trimmer(self.oeb, self.opts)
 
         self.oeb.toc.rationalize_play_orders()
         pr(1.)
         self.flush()
 
-        if self.opts.debug_pipeline is not None:
-            out_dir = os.path.join(self.opts.debug_pipeline, 'processed')
-            self.dump_oeb(self.oeb, out_dir)
-            self.log('Processed HTML written to:', out_dir)
-
-        self.log.info('Creating %s...'%self.output_plugin.name)
-        our = CompositeProgressReporter(0.67, 1., self.ui_reporter)
-        self.output_plugin.report_progress = our
-        our(0., _('Running %s plugin')%self.output_plugin.name)
-        with self.output_plugin:
-            self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
-                self.opts, self.log)
-        self.oeb.clean_temp_files()
-        self.ui_reporter(1.)
-        run_plugins_on_postprocess(self.output, self.output_fmt)
-
-        self.log(self.output_fmt.upper(), 'output written to', self.output)
-        self.flush()
-
 
 # This has to be global as create_oebbook can be called from other locations
 # (for example in the html input plugin)
@@ -1291,17 +1483,32 @@ def set_regex_wizard_callback(f):
     regex_wizard_callback = f
 
 
+class NullPreprocessor(object):
+
+    ''' Used for HTML that has already been preprocessed, such as that in the
+    input cache. '''
+
+    current_href = None
+
+    def __call__(self, html, remove_special_chars=None, get_preprocess_html=False):
+        return html
+
+
 def create_oebbook(log, path_or_stream, opts, reader=None,
-        encoding='utf-8', populate=True, for_regex_wizard=False, specialize=None, removed_items=()):
+        encoding='utf-8', populate=True, for_regex_wizard=False, specialize=None, removed_items=(),
+        html_preprocessor=None):
     '''
     Create an OEBBook.
     '''
     from calibre.ebooks.oeb.base import OEBBook
-    html_preprocessor = HTMLPreProcessor(log, opts, regex_wizard_callback=regex_wizard_callback)
+    if html_preprocessor is None:
+        html_preprocessor = HTMLPreProcessor(log, opts, regex_wizard_callback=regex_wizard_callback)
     if not encoding:
         encoding = None
     oeb = OEBBook(log, html_preprocessor,
             pretty_print=opts.pretty_print, input_encoding=encoding)
+    if getattr(opts, 'memory_limit', 0) > 0:
+        oeb.manifest.set_memory_limit(opts.memory_limit * 1024 * 1024)
     if not populate:
         return oeb
     if specialize is not None:
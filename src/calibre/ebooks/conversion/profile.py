@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Measure the wall time, CPU time and peak memory usage of the stages of the
+conversion pipeline and of the transforms run in them. Reports are written as
+JSON and many of them can be aggregated to find out where conversions spend
+their time. To aggregate reports, use::
+
+    calibre-debug -c "from calibre.ebooks.conversion.profile import main; main()" report_dir_or_files
+'''
+
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from calibre.constants import ismacos, iswindows
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import itervalues
+
+REPORT_VERSION = 1
+active_profiler = None
+
+
+def peak_rss():
+    ' The largest amount of memory used by this process so far, in bytes '
+    if iswindows:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().peak_wset
+    import resource
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return ans if ismacos else ans * 1024
+
+
+class PipelineProfiler(object):
+
+    '''
+    Records the resources used by the stages of a conversion. Stages are
+    nested, so the transforms run in the transforms stage are recorded as its
+    children. If cprofile is True, the top level stages are also run under
+    cProfile and the profile statistics of each are saved in cprofile_dir.
+    '''
+
+    def __init__(self, cprofile=False, cprofile_dir=None):
+        self.cprofile, self.cprofile_dir = cprofile, cprofile_dir
+        self.stages = []
+        self.current = []
+        self.start_wall, self.start_cpu = monotonic(), time.process_time()
+        self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        path = '/'.join(self.current + [name])
+        self.current.append(name)
+        profile = None
+        if self.cprofile and len(self.current) == 1:
+            import cProfile
+            profile = cProfile.Profile()
+        before_peak = peak_rss()
+        wall, cpu = monotonic(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall, cpu = monotonic() - wall, time.process_time() - cpu
+            self.current.pop()
+            after_peak = peak_rss()
+            self.stages.append({
+                'name': name, 'path': path, 'depth': path.count('/'),
+                'wall_time': wall, 'cpu_time': cpu,
+                'peak_rss': after_peak, 'peak_rss_increase': after_peak - before_peak,
+            })
+            if profile is not None and self.cprofile_dir:
+                if not os.path.exists(self.cprofile_dir):
+                    os.makedirs(self.cprofile_dir)
+                profile.dump_stats(os.path.join(self.cprofile_dir, sanitize_name(name) + '.prof'))
+
+    @contextmanager
+    def activated(self):
+        ' Make this the profiler used by :func:`profile_stage` '
+        global active_profiler
+        prev, active_profiler = active_profiler, self
+        try:
+            yield self
+        finally:
+            active_profiler = prev
+
+    def report(self, **metadata):
+        ans = OrderedDict((('version', REPORT_VERSION), ('started_at', self.started_at)))
+        ans.update(metadata)
+        ans['total'] = {
+            'wall_time': monotonic() - self.start_wall, 'cpu_time': time.process_time() - self.start_cpu,
+            'peak_rss': peak_rss()}
+        # Stages are recorded as they finish, sort them so that parents come
+        # before their children, in the order they were run
+        siblings = defaultdict(list)
+        for s in self.stages:
+            siblings[s['path'].rpartition('/')[0]].append(s['path'])
+        positions = {path: i for paths in itervalues(siblings) for i, path in enumerate(paths)}
+
+        def key(s):
+            parts = s['path'].split('/')
+            return [positions['/'.join(parts[:i+1])] for i in range(len(parts))]
+        ans['stages'] = sorted(self.stages, key=key)
+        return ans
+
+    def write_report(self, path, **metadata):
+        with open(path, 'wb') as f:
+            f.write(json.dumps(self.report(**metadata), indent=2).encode('utf-8'))
+
+
+@contextmanager
+def profile_stage(name):
+    ''' Record the resources used by the code in the with block, as a stage
+    named name, if the conversion is being profiled. Used for the transforms
+    run in output plugins. '''
+    if active_profiler is None:
+        yield
+    else:
+        with active_profiler.stage(name):
+            yield
+
+
+def sanitize_name(name):
+    return re.sub(r'[^-\w.]+', '_', name).strip('_') or 'stage'
+
+
+def report_path(output_dir, input_path, output_format):
+    ''' A path in output_dir for the report of the conversion of input_path
+    that does not overwrite the reports of other conversions. '''
+    base = '%s_to_%s' % (sanitize_name(os.path.basename(input_path or '')), sanitize_name(output_format or ''))
+    ans, num = os.path.join(output_dir, base + '.json'), 1
+    while os.path.exists(ans):
+        num += 1
+        ans = os.path.join(output_dir, '%s-%d.json' % (base, num))
+    return ans
+
+
+def iter_report_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in sorted(filenames):
+                    if name.endswith('.json'):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield path
+
+
+def aggregate_reports(reports):
+    '''
+    Aggregate the reports of many conversions. Returns the number of reports
+    and a mapping of stage path to the number of conversions in which the
+    stage was run, the total and maximum wall and CPU times and the maximum
+    peak RSS and increase in peak RSS.
+    '''
+    ans = defaultdict(lambda: {
+        'count': 0, 'wall_time': 0., 'max_wall_time': 0., 'cpu_time': 0., 'max_cpu_time': 0.,
+        'peak_rss': 0, 'peak_rss_increase': 0})
+    count = 0
+    for report in reports:
+        if report.get('version') != REPORT_VERSION:
+            continue
+        count += 1
+        for stage in [dict(report['total'], path='total')] + report['stages']:
+            a = ans[stage['path']]
+            a['count'] += 1
+            for k in ('wall_time', 'cpu_time'):
+                a[k] += stage[k]
+                a['max_' + k] = max(a['max_' + k], stage[k])
+            for k in ('peak_rss', 'peak_rss_increase'):
+                a[k] = max(a[k], stage.get(k, 0))
+    return count, dict(ans)
+
+
+def format_aggregate(count, stages):
+    total = stages.get('total', {}).get('wall_time') or 1
+    lines = ['Aggregated from %d conversion reports' % count, '']
+    fmt = '%-45s %6s %10s %10s %10s %7s %10s'
+    lines.append(fmt % ('Stage', 'Runs', 'Wall (s)', 'Max (s)', 'CPU (s)', 'Wall %', 'Peak (MB)'))
+    children = defaultdict(list)
+    for path in stages:
+        if path != 'total':
+            children[path.rpartition('/')[0]].append(path)
+
+    def walk(parent):
+        # Children are listed after their parent, slowest first
+        for path in sorted(children[parent], key=lambda p: -stages[p]['wall_time']):
+            yield path
+            for x in walk(path):
+                yield x
+
+    for path in (['total'] if 'total' in stages else []) + list(walk('')):
+        s = stages[path]
+        lines.append(fmt % (
+            '  ' * path.count('/') + path.rpartition('/')[-1], s['count'], '%.3f' % s['wall_time'],
+            '%.3f' % s['max_wall_time'], '%.3f' % s['cpu_time'], '%.1f' % (100 * s['wall_time'] / total),
+            '%.1f' % (s['peak_rss'] / 1024**2)))
+    return '\n'.join(lines)
+
+
+def main(args=sys.argv):
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage='%prog [options] report_dir_or_files...\n\n'
+                          'Aggregate the reports created with the --profile-pipeline option of ebook-convert')
+    parser.add_option('--json', default=False, action='store_true', help='Output the aggregate as JSON')
+    opts, args = parser.parse_args(args)
+    paths = args[1:]
+    if not paths:
+        parser.print_help()
+        raise SystemExit(1)
+    reports = []
+    for path in iter_report_files(paths):
+        try:
+            with open(path, 'rb') as f:
+                reports.append(json.loads(f.read()))
+        except (EnvironmentError, ValueError) as err:
+            print('Ignoring invalid report:', path, 'with error:', err, file=sys.stderr)
+    count, stages = aggregate_reports(reports)
+    if opts.json:
+        print(json.dumps({'count': count, 'stages': stages}, indent=2, sort_keys=True))
+    else:
+        print(format_aggregate(count, stages))
+
+
+def find_tests():
+    import unittest
+
+    class TestProfile(unittest.TestCase):
+
+        def test_profile_stages(self):
+            p = PipelineProfiler()
+            with p.activated():
+                with p.stage('input'):
+                    pass
+                with p.stage('transforms'):
+                    with profile_stage('b'):
+                        pass
+                    with profile_stage('a'):
+                        pass
+            self.assertIsNone(active_profiler)
+            r = p.report(input='x.epub')
+            self.assertEqual([s['path'] for s in r['stages']], ['input', 'transforms', 'transforms/b', 'transforms/a'])
+            count, stages = aggregate_reports([r, json.loads(json.dumps(r)), {'version': -1}])
+            self.assertEqual(count, 2)
+            self.assertEqual(stages['transforms/a']['count'], 2)
+            self.assertEqual(stages['total']['count'], 2)
+            self.assertIn('transforms', format_aggregate(count, stages))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestProfile)
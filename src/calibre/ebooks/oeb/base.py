@@ -927,6 +927,11 @@ class Manifest(object):
                 loader = oeb.container.read
             self._loader = loader
             self._data = data
+            # Used when the data is spilled to disk to save memory, see
+            # calibre.ebooks.oeb.spill. _spill_is_current is True if the data
+            # in memory can be re-read unchanged, so it need not be written.
+            self._spill_path = None
+            self._spill_parsed = self._spill_is_current = False
 
         def __repr__(self):
             return 'Item(id=%r, href=%r, media_type=%r)' \
@@ -1020,18 +1025,30 @@ class Manifest(object):
               object with no special parsing.
             """
             data = self._data
+            memory = self.oeb.manifest.memory
             if data is None:
+                if self._spill_path is not None:
+                    return self._unspill()
                 if self._loader is None:
                     return None
                 data = self._loader(getattr(self, 'html_input_href',
                     self.href))
+                self._spill_is_current = True
             try:
                 mt = self.media_type.lower()
             except Exception:
                 mt = 'application/octet-stream'
             if not isinstance(data, string_or_bytes):
-                pass  # already parsed
-            elif mt in OEB_DOCS:
+                # already parsed
+                if self._data is None:
+                    self._data = data
+                    if memory is not None:
+                        memory.loaded(self, data)
+                elif memory is not None:
+                    memory.touch(self)
+                return data
+            raw_size = len(data)
+            if mt in OEB_DOCS:
                 data = self._parse_xhtml(data)
             elif mt[-4:] in ('+xml', '/xml'):
                 data = self._parse_xml(data)
@@ -1043,18 +1060,60 @@ class Manifest(object):
                 data = self._parse_txt(data)
                 self.media_type = XHTML_MIME
             self._data = data
+            if memory is not None:
+                memory.loaded(self, data, raw_size)
             return data
 
         @data.setter
         def data(self, value):
             self._data = value
+            self._spill_path, self._spill_is_current = None, False
+            if self.oeb.manifest.memory is not None:
+                self.oeb.manifest.memory.loaded(self, value)
 
         @data.deleter
         def data(self):
+            self._data = self._spill_path = None
+            if self.oeb.manifest.memory is not None:
+                self.oeb.manifest.memory.discard(self)
+
+        def spill(self):
+            ''' Write the data of this item to disk and remove it from memory,
+            it is re-read when next accessed. Returns True if the data was
+            removed from memory. Must only be called when no code holds
+            references to the parsed data of this item. '''
+            from calibre.ebooks.oeb.spill import spill_to_disk
+            data = self._data
+            if isinstance(data, bytes):
+                if not self._spill_is_current:
+                    self._spill_path = spill_to_disk(self.oeb, data, self._spill_path)
+                    self._spill_parsed = False
+            elif isinstance(data, etree._Element):
+                self._spill_path = spill_to_disk(self.oeb, etree.tostring(data, encoding='utf-8'), self._spill_path)
+                self._spill_parsed = True
+            else:
+                return False
             self._data = None
+            if self.oeb.manifest.memory is not None:
+                self.oeb.manifest.memory.discard(self)
+            return True
+
+        def _unspill(self):
+            with open(self._spill_path, 'rb') as f:
+                raw = f.read()
+            self._data = data = safe_xml_fromstring(raw) if self._spill_parsed else raw
+            self._spill_is_current = not self._spill_parsed
+            if self.oeb.manifest.memory is not None:
+                self.oeb.manifest.memory.loaded(self, data, len(raw))
+            return data
 
         def unload_data_from_memory(self, memory=None):
             if isinstance(self._data, bytes):
+                self._spill_path = None
+                keep_file = self.oeb.manifest.memory is not None
+                if keep_file:
+                    # The data may be re-read many times when spilling
+                    self.oeb.manifest.memory.discard(self)
                 if memory is None:
                     from calibre.ptempfile import PersistentTemporaryFile
                     pt = PersistentTemporaryFile(suffix='_oeb_base_mem_unloader.img')
@@ -1065,7 +1124,8 @@ class Manifest(object):
                     def loader(*args):
                         with open(pt.name, 'rb') as f:
                             ans = f.read()
-                        os.remove(pt.name)
+                        if not keep_file:
+                            os.remove(pt.name)
                         return ans
                     self._loader = loader
                 else:
@@ -1149,6 +1209,32 @@ class Manifest(object):
         self.items = set()
         self.ids = {}
         self.hrefs = {}
+        self.memory = None
+
+    def set_memory_limit(self, limit):
+        '''
+        Limit the memory used by the data of the items in this manifest to
+        approximately limit bytes, by writing it to disk and re-reading it when
+        needed, see :mod:`calibre.ebooks.oeb.spill`. Use a limit of None
+        for no limit.
+        '''
+        if limit is None:
+            self.memory = None
+            return
+        from calibre.ebooks.oeb.spill import ItemMemory
+        self.memory = ItemMemory(limit)
+        for item in self.items:
+            if item._data is not None:
+                # The loader of the item may not be able to re-read its data
+                item._spill_is_current = False
+                self.memory.loaded(item, item._data)
+
+    def enforce_memory_limit(self):
+        ''' Write the data of items to disk until the memory limit is
+        satisfied. Must only be called when no code holds references to
+        the parsed data of items. '''
+        if self.memory is not None:
+            self.memory.enforce()
 
     def add(self, id, href, media_type, fallback=None, loader=None, data=None):
         """Add a new item to the book manifest.
@@ -1175,6 +1261,8 @@ class Manifest(object):
         if item.href in self.hrefs:
             del self.hrefs[item.href]
         self.items.remove(item)
+        if self.memory is not None:
+            self.memory.discard(item)
         if item in self.oeb.spine:
             self.oeb.spine.remove(item)
 
@@ -1899,6 +1987,7 @@ class OEBBook(object):
                         added = True
                 if added:
                     next += 1
+            self.manifest.enforce_memory_limit()
         selector = XPath('ncx:content/@src')
         for i, elem in enumerate(xpath(ncx, '//*[@playOrder and ./ncx:content[@src]]')):
             href = urlnormalize(selector(elem)[0])
@@ -176,6 +176,7 @@ class OEBReader(object):
                             item.href)
                     bad.append(item)
                     self.oeb.manifest.remove(item)
+                self.oeb.manifest.enforce_memory_limit()
         return bad
 
     def _manifest_add_missing(self, invalid):
@@ -228,6 +229,8 @@ class OEBReader(object):
                         scheme = urlparse(href).scheme
                         if not scheme and href not in known:
                             new.add(href)
+                data = None
+                manifest.enforce_memory_limit()
             unchecked.clear()
             warned = set()
             for href in new:
@@ -310,6 +313,7 @@ class OEBReader(object):
                        found in spine or found in extras:
                         continue
                     new.add(found)
+                manifest.enforce_memory_limit()
             extras.update(new)
             unchecked = new
         version = int(self.oeb.version[0])
@@ -340,6 +344,7 @@ class OEBReader(object):
                 else:
                     self.oeb.log.warn('The item %s is not a XML document.'
                         ' Removing it from spine.'%item.href)
+            manifest.enforce_memory_limit()
         if len(spine) == 0:
             raise OEBError("Spine is empty")
         self._spine_add_extra()
@@ -532,6 +537,7 @@ class OEBReader(object):
                 if header:
                     headers[-1] = header
                     break
+            self.oeb.manifest.enforce_memory_limit()
         use = titles
         if len(titles) > len(set(titles)):
             use = headers
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Keep the memory used by the data of the items in the manifest of an OEBBook
+below a limit, by writing the least recently used data to disk and removing it
+from memory. The data is re-read, and re-parsed, transparently when it is next
+accessed.
+
+Binary data such as images and fonts cannot be modified in place, so it is
+spilled as soon as the limit is exceeded. Parsed XML can be modified in place
+by any code that has a reference to it, so it is spilled only when
+:meth:`ItemMemory.enforce` is called, at points where no code holds
+references to the parsed data of items, such as between transforms.
+'''
+
+import os
+import sys
+from collections import OrderedDict
+
+from lxml import etree
+
+# Approximate number of bytes of memory used by an lxml tree per byte of the
+# XML it was parsed from and per element, respectively
+TREE_SIZE_FACTOR = 6
+ELEMENT_SIZE = 400
+
+
+def estimated_size(data, raw_size=None):
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, etree._Element):
+        if raw_size is not None:
+            return raw_size * TREE_SIZE_FACTOR
+        return ELEMENT_SIZE * sum(1 for x in data.iter())
+    return 0
+
+
+class ItemMemory(object):
+
+    ''' Tracks the approximate memory used by the data of the items of a
+    manifest, in least recently used order. '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.binary, self.trees = OrderedDict(), OrderedDict()
+        self.total = self.peak = 0
+        self.spilled_count = 0
+
+    def touch(self, item):
+        for q in (self.binary, self.trees):
+            if item in q:
+                q.move_to_end(item)
+                break
+
+    def loaded(self, item, data, raw_size=None):
+        self.discard(item)
+        size = estimated_size(data, raw_size)
+        if not size:
+            return
+        (self.binary if isinstance(data, bytes) else self.trees)[item] = size
+        self.total += size
+        if self.total > self.limit:
+            self.spill(self.binary, exclude=item)
+        self.peak = max(self.peak, self.total)
+
+    def discard(self, item):
+        for q in (self.binary, self.trees):
+            size = q.pop(item, None)
+            if size is not None:
+                self.total -= size
+                break
+
+    def spill(self, q, exclude=None):
+        for item in tuple(q):
+            if self.total <= self.limit:
+                break
+            if item is not exclude and item.spill():
+                self.spilled_count += 1
+
+    def enforce(self):
+        ''' Spill data until the memory used is below the limit. Must only be
+        called when no code holds references to the parsed data of items. '''
+        if self.total > self.limit:
+            self.spill(self.binary)
+            self.spill(self.trees)
+
+
+def spill_to_disk(oeb, raw, path=None):
+    if path is None:
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile(suffix='_oeb_spill') as pt:
+            pt.write(raw)
+        oeb._temp_files.append(pt.name)
+        return pt.name
+    with open(path, 'wb') as f:
+        f.write(raw)
+    return path
+
+
+def create_book(path, size, image_size=256 * 1024, images_per_file=2, text_size=16 * 1024):
+    ''' Create a synthetic book in the directory path of about size bytes,
+    mostly images, for testing. Returns the path to its OPF. '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest, spine = [], []
+    text = '<p>Some text in a paragraph, <i>with</i> some <b>markup</b>.</p>' * (text_size // 64)
+    for i in range(max(1, size // (image_size * images_per_file + text_size))):
+        imgs = []
+        for j in range(images_per_file):
+            name = 'img%d_%d.jpg' % (i, j)
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(os.urandom(image_size))
+            manifest.append('<item id="i%d_%d" href="%s" media-type="image/jpeg"/>' % (i, j, name))
+            imgs.append('<div><img src="%s" alt="x"/></div>' % name)
+        name = 'ch%d.html' % i
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(('<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%d</title></head><body><h1>Chapter %d</h1>%s%s</body></html>' % (
+                i, i, ''.join(imgs), text)).encode('utf-8'))
+        manifest.append('<item id="c%d" href="%s" media-type="application/xhtml+xml"/>' % (i, name))
+        spine.append('<itemref idref="c%d"/>' % i)
+    with open(os.path.join(path, 'content.opf'), 'wb') as f:
+        f.write(('<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+                 '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic</dc:title><dc:identifier id="id">x</dc:identifier>'
+                 '<dc:language>en</dc:language></metadata><manifest>%s</manifest><spine>%s</spine></package>' % (
+                     ''.join(manifest), ''.join(spine))).encode('utf-8'))
+    return os.path.join(path, 'content.opf')
+
+
+def convert_book(size, limit):
+    ''' Convert a synthetic book of size MB with a memory limit
+    of limit MB. Returns the peak memory used by the items of the book and the
+    peak RSS of this process, in bytes. '''
+    import shutil
+    import tempfile
+    from calibre.ebooks.conversion.plumber import OptionRecommendation, Plumber
+    from calibre.ebooks.conversion.profile import peak_rss
+    from calibre.utils.logging import Log
+    tdir = tempfile.mkdtemp()
+    try:
+        opf = create_book(os.path.join(tdir, 'book'), size * 1024 * 1024)
+        log = Log()
+        log.filter_level = Log.ERROR
+        plumber = Plumber(opf, os.path.join(tdir, 'output.oeb'), log)
+        plumber.merge_ui_recommendations([('memory_limit', limit, OptionRecommendation.HIGH)])
+        plumber.run()
+        return plumber.oeb.manifest.memory.peak, peak_rss()
+    finally:
+        shutil.rmtree(tdir)
+
+
+def main(args=sys.argv):
+    ''' Convert a synthetic book of the specified size, 1GB by default, with
+    the specified memory limit in MB and report the memory used. Run with:
+    calibre-debug -c "from calibre.ebooks.oeb.spill import main; main()" size_in_mb limit_in_mb '''
+    size = int(args[1]) if len(args) > 1 else 1024
+    limit = int(args[2]) if len(args) > 2 else 128
+    peak, rss = convert_book(size, limit)
+    print('Converted a book of %d MB with a limit of %d MB' % (size, limit))
+    print('Peak memory used by the items: %.1f MB, peak RSS: %.1f MB' % (peak / 1024**2, rss / 1024**2))
+    if peak > limit * 1024 * 1024:
+        # Transforms such as DetectStructure keep references to the parsed
+        # data of many items at once, which cannot be spilled until they are done
+        print('The limit was exceeded by transforms that use the parsed data of many items at once')
+
+
+def find_tests():
+    import shutil
+    import tempfile
+    import unittest
+
+    class TestSpill(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def read_book(self, limit):
+            from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+            from calibre.ebooks.oeb.base import DirContainer, OEBBook
+            from calibre.utils.logging import Log
+            log = Log()
+            log.outputs = []
+            oeb = OEBBook(log, HTMLPreProcessor(log))
+            oeb.container = DirContainer(self.tdir, log)
+            oeb.manifest.set_memory_limit(limit)
+            return oeb
+
+        def test_spill(self):
+            from calibre.ebooks.oeb.base import XPath
+            create_book(self.tdir, 4 * 1024 * 1024, image_size=64 * 1024)
+            limit = 512 * 1024
+            oeb = self.read_book(limit)
+            images, docs = {}, []
+            for name in sorted(os.listdir(self.tdir)):
+                if name.endswith('.jpg'):
+                    images[oeb.manifest.add(name, name, 'image/jpeg')] = open(os.path.join(self.tdir, name), 'rb').read()
+                elif name.endswith('.html'):
+                    docs.append(oeb.manifest.add(name, name, 'application/xhtml+xml'))
+            memory = oeb.manifest.memory
+            for repeat in range(2):
+                for item, raw in images.items():
+                    self.assertEqual(item.data, raw)
+                    self.assertLessEqual(memory.total, limit)
+            self.assertLessEqual(memory.peak, limit)
+            self.assertGreater(memory.spilled_count, len(images))
+            # Images that were set, rather than loaded, are written to disk
+            item = next(iter(images))
+            item.data = b'modified' * 1000
+            oeb.manifest.enforce_memory_limit()
+            for other in images:
+                other.data
+            self.assertIsNone(item._data)
+            self.assertEqual(item.data, b'modified' * 1000)
+
+            # Parsed data is spilled only when the limit is enforced,
+            # modifications are preserved
+            for doc in docs:
+                XPath('//h:h1')(doc.data)[0].text = 'Modified ' + doc.id
+            self.assertTrue(all(doc._data is not None for doc in docs))
+            oeb.manifest.enforce_memory_limit()
+            self.assertLessEqual(memory.total, limit)
+            self.assertTrue(any(doc._data is None for doc in docs))
+            for doc in docs:
+                self.assertEqual(XPath('//h:h1')(doc.data)[0].text, 'Modified ' + doc.id)
+                oeb.manifest.enforce_memory_limit()
+            oeb.manifest.remove(docs[-1])
+            self.assertNotIn(docs[-1], memory.trees)
+            oeb.clean_temp_files()
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestSpill)
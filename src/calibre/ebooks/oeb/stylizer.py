@@ -9,6 +9,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import os, re, logging, copy, unicodedata, numbers
+from collections import defaultdict
 from operator import itemgetter
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
@@ -97,6 +98,15 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+pseudo_pat = re.compile(':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
+
+
+def pseudo_class_of(selector_text):
+    m = pseudo_pat.search(selector_text)
+    if m is not None:
+        return m.group(1)
+
+
 class StylizerRules(object):
 
     def __init__(self, opts, profile, stylesheets):
@@ -185,6 +195,9 @@ class StylizerRules(object):
 
 class Stylizer(object):
     STYLESHEETS = WeakKeyDictionary()
+    # Use an index of the tags in the tree to find the tags matched by rules,
+    # rather than selecting them from the whole tree for every rule
+    use_rule_index = True
 
     def __init__(self, tree, path, oeb, opts, profile=None,
             extra_css='', user_css='', base_css=''):
@@ -298,11 +311,42 @@ class Stylizer(object):
         self.flatten_style = self.oeb.stylizer_rules.flatten_style
 
         self._styles = {}
-        pseudo_pat = re.compile(':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
+        fake_first_letter = getattr(self.oeb, 'plumber_output_format', '').lower() in {'mobi', 'docx'}
+        if self.use_rule_index and not (fake_first_letter and any(
+                pseudo_class_of(text) == 'first-letter' for _, _, _, text, _ in self.rules)):
+            self.apply_rules_indexed(select)
+        else:
+            # Faking first-letter changes the tree while rules are being
+            # applied, so the rules must be applied one after another
+            self.apply_rules(select, fake_first_letter)
+        for elem in xpath(tree, '//h:*[@style]'):
+            self.style(elem)._apply_style_attr(url_replacer=item.abshref)
+        num_pat = re.compile(r'[0-9.]+$')
+        for elem in xpath(tree, '//h:img[@width or @height]'):
+            style = self.style(elem)
+            # Check if either height or width is not default
+            is_styled = style._style.get('width', 'auto') != 'auto' or \
+                    style._style.get('height', 'auto') != 'auto'
+            if not is_styled:
+                # Update img style dimension using width and height
+                upd = {}
+                for prop in ('width', 'height'):
+                    val = elem.get(prop, '').strip()
+                    try:
+                        del elem.attrib[prop]
+                    except:
+                        pass
+                    if val:
+                        if num_pat.match(val) is not None:
+                            val += 'px'
+                        upd[prop] = val
+                if upd:
+                    style._update_cssdict(upd)
 
+    def apply_rules(self, select, fake_first_letter=False):
         for _, _, cssdict, text, _ in self.rules:
-            fl = pseudo_pat.search(text)
+            fl = pseudo_class_of(text)
             try:
                 matches = tuple(select(text))
             except SelectorError as err:
@@ -310,9 +354,7 @@ class Stylizer(object):
                 continue
 
             if fl is not None:
-                fl = fl.group(1)
-                if fl == 'first-letter' and getattr(self.oeb,
-                        'plumber_output_format', '').lower() in {'mobi', 'docx'}:
+                if fl == 'first-letter' and fake_first_letter:
                     # Fake first-letter
                     for elem in matches:
                         for x in elem.iter('*'):
@@ -342,29 +384,39 @@ class Stylizer(object):
             else:
                 for elem in matches:
                     self.style(elem)._update_cssdict(cssdict)
-        for elem in xpath(tree, '//h:*[@style]'):
-            self.style(elem)._apply_style_attr(url_replacer=item.abshref)
-        num_pat = re.compile(r'[0-9.]+$')
-        for elem in xpath(tree, '//h:img[@width or @height]'):
-            style = self.style(elem)
-            # Check if either height or width is not default
-            is_styled = style._style.get('width', 'auto') != 'auto' or \
-                    style._style.get('height', 'auto') != 'auto'
-            if not is_styled:
-                # Update img style dimension using width and height
-                upd = {}
-                for prop in ('width', 'height'):
-                    val = elem.get(prop, '').strip()
-                    try:
-                        del elem.attrib[prop]
-                    except:
-                        pass
-                    if val:
-                        if num_pat.match(val) is not None:
-                            val += 'px'
-                        upd[prop] = val
-                if upd:
-                    style._update_cssdict(upd)
+
+    def apply_rules_indexed(self, select):
+        # The tags in the tree are indexed by id, class and tag name in a
+        # single pass. Rules that need a key that no tag has are skipped and
+        # rules without combinators are tested only against the tags that have
+        # the key of the rule, rather than selecting from the whole tree.
+        # Testing tags individually against rules with combinators is slower
+        # than select(), so select() is still used for them. Rules are applied
+        # in the same order as by apply_rules(), so the styles are identical.
+        index, all_tags = defaultdict(list), []
+        for elem in select.itertag():
+            all_tags.append(elem)
+            for key in select.element_index_keys(elem):
+                index[key].append(elem)
+        for _, _, cssdict, text, _ in self.rules:
+            try:
+                keys = select.index_keys(text)
+                if any(key is not None and key not in index for key in keys):
+                    continue  # The rule cannot match anything in this tree
+                if len(keys) == 1:
+                    matches = select.matcher(text)
+                    matches = [elem for elem in (all_tags if keys[0] is None else index[keys[0]]) if matches(elem)]
+                else:
+                    matches = tuple(select(text))
+            except SelectorError as err:
+                self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
+                continue
+            fl = pseudo_class_of(text)
+            for elem in matches:
+                if fl is None:
+                    self.style(elem)._update_cssdict(cssdict)
+                else:
+                    self.style(elem)._update_pseudo_class(fl, cssdict)
 
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
@@ -806,3 +858,47 @@ class Style(object):
     @property
     def is_hidden(self):
         return self._style.get('display') == 'none' or self._style.get('visibility') == 'hidden'
+
+
+def benchmark(path, repeat=3):
+    ''' Compare the time taken to apply the CSS rules to all the HTML files in
+    the book at path, with and without the rule index, and check that the
+    resulting styles are identical. Use it as:
+    calibre-debug -c "from calibre.ebooks.oeb.stylizer import benchmark; benchmark('book.epub')" '''
+    import time
+    from calibre.ebooks.conversion.plumber import Plumber, create_oebbook
+    from calibre.ebooks.oeb.base import OEB_DOCS
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.logging import default_log
+    with TemporaryDirectory('_stylizer_benchmark') as tdir:
+        container = get_container(path, log=default_log, tdir=tdir)
+        plumber = Plumber(path, os.path.join(tdir, 'out.epub'), default_log)
+        plumber.setup_options()
+        oeb = create_oebbook(default_log, container.name_to_abspath(container.opf_name), plumber.opts)
+        items = [item for item in oeb.spine if item.media_type in OEB_DOCS]
+        times, original = {}, Stylizer.use_rule_index
+        for use_rule_index in (False, True):
+            Stylizer.use_rule_index = use_rule_index
+            styles, elapsed = [], []
+            try:
+                for i in range(repeat):
+                    total = 0
+                    for item in items:
+                        tree = copy.deepcopy(item.data)
+                        st = time.monotonic()
+                        stylizer = Stylizer(tree, item.href, oeb, plumber.opts)
+                        total += time.monotonic() - st
+                        if i == 0:
+                            styles.append([
+                                (tree.getroottree().getpath(elem), style.cssdict(), style.pseudo_classes(None))
+                                for elem, style in sorted(iteritems(stylizer._styles), key=lambda x: tree.getroottree().getpath(x[0]))])
+                    elapsed.append(total)
+            finally:
+                Stylizer.use_rule_index = original
+            times[use_rule_index] = styles, min(elapsed)
+        print('Applied %d rules to %d files' % (len(oeb.stylizer_rules.rules), len(items)))
+        print('Without rule index: %.3f seconds' % times[False][1])
+        print('With rule index:    %.3f seconds' % times[True][1])
+        if times[False][0] != times[True][0]:
+            raise SystemExit('The styles computed with the rule index are different')
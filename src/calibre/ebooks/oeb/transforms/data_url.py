@@ -43,6 +43,7 @@ class DataURL(object):
                     self.log.warn('Image encoded as data URL has unknown format, ignoring')
                     continue
                 img.set('src', item.relhref(self.convert_image_data_uri(data, fmt, oeb)))
+            oeb.manifest.enforce_memory_limit()
 
     def convert_image_data_uri(self, data, fmt, oeb):
         self.log('Found image encoded as data URI converting it to normal image')
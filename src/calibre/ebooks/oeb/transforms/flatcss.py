@@ -112,6 +112,16 @@ def FontMapper(sbase=None, dbase=None, dkey=None):
         return NullMapper()
 
 
+class FlattenedStylizer(object):
+
+    ''' The parts of the Stylizer of an item that CSSFlattener uses after the
+    item is flattened, used when the Stylizer itself is not kept. '''
+
+    def __init__(self, profile, page_rule, font_face_rules, body_font_size):
+        self.profile, self.page_rule, self.body_font_size = profile, page_rule, body_font_size
+        self.font_face_rules = font_face_rules
+
+
 class EmbedFontsCSSRules(object):
 
     def __init__(self, body_font_family, rules):
@@ -135,8 +145,9 @@ class CSSFlattener(object):
 
     def __init__(self, fbase=None, fkey=None, lineh=None, unfloat=False,
                  untable=False, page_break_on_body=False, specializer=None,
-                 transform_css_rules=()):
+                 transform_css_rules=(), parallel=False):
         self.fbase = fbase
+        self.parallel = parallel
         self.transform_css_rules = transform_css_rules
         if self.transform_css_rules:
             from calibre.ebooks.css_transform_rules import compile_rules
@@ -198,10 +209,18 @@ class CSSFlattener(object):
         # like the AZW3 output inline ToC.
         self.oeb.store_embed_font_rules = EmbedFontsCSSRules(self.body_font_family,
                 self.embed_font_rules)
-        self.stylize_spine()
-        self.sbase = self.baseline_spine() if self.fbase else None
-        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
-        self.flatten_spine()
+        flattened = False
+        if self.parallel:
+            from calibre.ebooks.oeb.transforms.parallel import flatten_css_in_parallel
+            flattened = flatten_css_in_parallel(self)
+        if not flattened and self.oeb.manifest.memory is not None:
+            self.flatten_spine_with_memory_limit()
+            flattened = True
+        if not flattened:
+            self.stylize_spine()
+            self.sbase = self.baseline_spine() if self.fbase else None
+            self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+            self.flatten_spine()
         if epub3_nav is not None:
             self.opts.epub3_nav_parsed = epub3_nav.data
 
@@ -271,36 +290,38 @@ class CSSFlattener(object):
 
     def stylize_spine(self):
         self.stylizers = {}
+        for item in self.items:
+            self.stylizers[item] = self.stylize_item(item)
+
+    def stylize_item(self, item):
         profile = self.context.source
         css = ''
-        for item in self.items:
-            html = item.data
-            body = html.find(XHTML('body'))
-            if 'style' in html.attrib:
-                b = body.attrib.get('style', '')
-                body.set('style',  html.get('style') + ';' + b)
-                del html.attrib['style']
-            bs = body.get('style', '').split(';')
-            bs.append('margin-top: 0pt')
-            bs.append('margin-bottom: 0pt')
-            if float(self.context.margin_left) >= 0:
-                bs.append('margin-left : %gpt'%
-                        float(self.context.margin_left))
-            if float(self.context.margin_right) >= 0:
-                bs.append('margin-right : %gpt'%
-                        float(self.context.margin_right))
-            bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
-            if self.page_break_on_body:
-                bs.extend(['page-break-before: always'])
-            if self.context.change_justification != 'original':
-                bs.append('text-align: '+ self.context.change_justification)
-            if self.body_font_family:
-                bs.append('font-family: '+self.body_font_family)
-            body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+        html = item.data
+        body = html.find(XHTML('body'))
+        if 'style' in html.attrib:
+            b = body.attrib.get('style', '')
+            body.set('style',  html.get('style') + ';' + b)
+            del html.attrib['style']
+        bs = body.get('style', '').split(';')
+        bs.append('margin-top: 0pt')
+        bs.append('margin-bottom: 0pt')
+        if float(self.context.margin_left) >= 0:
+            bs.append('margin-left : %gpt'%
+                    float(self.context.margin_left))
+        if float(self.context.margin_right) >= 0:
+            bs.append('margin-right : %gpt'%
+                    float(self.context.margin_right))
+        bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
+        if self.page_break_on_body:
+            bs.extend(['page-break-before: always'])
+        if self.context.change_justification != 'original':
+            bs.append('text-align: '+ self.context.change_justification)
+        if self.body_font_family:
+            bs.append('font-family: '+self.body_font_family)
+        body.set('style', '; '.join(bs))
+        return Stylizer(html, item.href, self.oeb, self.context, profile,
+                user_css=self.context.extra_css,
+                extra_css=css)
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
@@ -314,11 +335,15 @@ class CSSFlattener(object):
     def baseline_spine(self):
         sizes = defaultdict(float)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            body = html.find(XHTML('body'))
-            fsize = self.context.source.fbase
-            self.baseline_node(body, stylizer, sizes, fsize)
+            self.baseline_item(item, self.stylizers[item], sizes)
+        return self.source_base_font_size(sizes)
+
+    def baseline_item(self, item, stylizer, sizes):
+        body = item.data.find(XHTML('body'))
+        fsize = self.context.source.fbase
+        self.baseline_node(body, stylizer, sizes, fsize)
+
+    def source_base_font_size(self, sizes):
         try:
             sbase = max(list(sizes.items()), key=operator.itemgetter(1))[0]
         except:
@@ -525,7 +550,7 @@ class CSSFlattener(object):
 
         pseudo_classes = style.pseudo_classes(self.filter_css)
         if cssdict or pseudo_classes:
-            keep_classes = set()
+            keep_classes = []
 
             if cssdict:
                 items = sorted(iteritems(cssdict))
@@ -539,11 +564,9 @@ class CSSFlattener(object):
                 if css in styles:
                     match = styles[css]
                 else:
-                    match = klass + unicode_type(names[klass] or '')
-                    styles[css] = match
-                    names[klass] += 1
+                    match = self.new_class(names, styles, klass, css)
                 node.attrib['class'] = match
-                keep_classes.add(match)
+                keep_classes.append(match)
 
             for psel, cssdict in iteritems(pseudo_classes):
                 items = sorted(iteritems(cssdict))
@@ -558,11 +581,8 @@ class CSSFlattener(object):
                     # If the pcalibre class for a:hover and a:link is the same,
                     # then the class attribute for a.x tags will contain both
                     # that class and the class for a.x:hover, which is wrong.
-                    klass = 'pcalibre'
-                    match = klass + unicode_type(names[klass] or '')
-                    pstyles[css] = match
-                    names[klass] += 1
-                keep_classes.add(match)
+                    match = self.new_class(names, pstyles, 'pcalibre', css, psel)
+                keep_classes.append(match)
                 node.attrib['class'] = ' '.join(keep_classes)
 
         elif 'class' in node.attrib:
@@ -573,6 +593,12 @@ class CSSFlattener(object):
             for child in node:
                 self.flatten_node(child, stylizer, names, styles, pseudo_styles, psize, item_id)
 
+    def new_class(self, names, styles, klass, css, psel=None):
+        match = klass + unicode_type(names[klass] or '')
+        styles[css] = match
+        names[klass] += 1
+        return match
+
     def flatten_head(self, item, href, global_href):
         html = item.data
         head = html.find(XHTML('head'))
@@ -657,13 +683,56 @@ class CSSFlattener(object):
         names = defaultdict(int)
         styles, pseudo_styles = {}, defaultdict(dict)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            if self.specializer is not None:
-                self.specializer(item, stylizer)
-            fsize = self.context.dest.fbase
-            self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
-            self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+            self.flatten_item(item, self.stylizers[item], names, styles, pseudo_styles)
+        self.create_stylesheets(styles, pseudo_styles)
+
+    def flatten_item(self, item, stylizer, names, styles, pseudo_styles):
+        html = item.data
+        if self.specializer is not None:
+            self.specializer(item, stylizer)
+        fsize = self.context.dest.fbase
+        self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
+        self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+
+    def flatten_spine_with_memory_limit(self):
+        # Keep only one item stylized at a time, so that the parsed data of
+        # the other items can be spilled to disk. Items are stylized twice,
+        # once for the base font size and once for flattening.
+        manifest = self.oeb.manifest
+        self.sbase = None
+        if self.fbase:
+            sizes = defaultdict(float)
+            for item in self.items:
+                html = item.data
+                body = html.find(XHTML('body'))
+                # stylize_item() changes the style of body, restore it so that
+                # it is not changed twice
+                styles = html.get('style'), body.get('style')
+                stylizer = self.stylize_item(item)
+                self.baseline_item(item, stylizer, sizes)
+                stylizer._styles.clear()  # break reference cycles
+                for elem, style in zip((html, body), styles):
+                    if style is None:
+                        elem.attrib.pop('style', None)
+                    else:
+                        elem.set('style', style)
+                del html, body, stylizer
+                manifest.enforce_memory_limit()
+            self.sbase = self.source_base_font_size(sizes)
+        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+        self.stylizers = {}
+        names, styles, pseudo_styles = defaultdict(int), {}, defaultdict(dict)
+        for item in self.items:
+            stylizer = self.stylize_item(item)
+            self.flatten_item(item, stylizer, names, styles, pseudo_styles)
+            self.stylizers[item] = FlattenedStylizer(
+                stylizer.profile, stylizer.page_rule, stylizer.font_face_rules, stylizer.body_font_size)
+            stylizer._styles.clear()
+            del stylizer
+            manifest.enforce_memory_limit()
+        self.create_stylesheets(styles, pseudo_styles)
+
+    def create_stylesheets(self, styles, pseudo_styles):
         items = sorted(((key, val) for (val, key) in iteritems(styles)), key=lambda x:numeric_sort_key(x[0]))
         # :hover must come after link and :active must come after :hover
         psels = sorted(pseudo_styles, key=lambda x :
@@ -680,5 +749,5 @@ class CSSFlattener(object):
         href = self.replace_css(css)
         global_css = self.collect_global_css()
         for item in self.items:
-            stylizer = self.stylizers[item]
             self.flatten_head(item, href, global_css[item])
+            self.oeb.manifest.enforce_memory_limit()
@@ -79,8 +79,7 @@ class RemoveFakeMargins(object):
                 self.log.debug('Negative text indent detected at level '
                         ' %s, ignoring this level'%level)
 
-    def get_margins(self, elem):
-        cls = elem.get('class', None)
+    def get_margins(self, cls):
         if cls:
             style = self.selector_map.get('.'+cls, None)
             if style:
@@ -100,8 +99,8 @@ class RemoveFakeMargins(object):
         self.stats[level+'_left'] = Counter()
         self.stats[level+'_right'] = Counter()
 
-        for elem in elems:
-            lm, rm = self.get_margins(elem)[:2]
+        for cls, num_paras in elems:
+            lm, rm = self.get_margins(cls)[:2]
             self.stats[level+'_left'][lm] += 1
             self.stats[level+'_right'][rm] += 1
 
@@ -120,8 +119,8 @@ class RemoveFakeMargins(object):
             self.log('Removing level %s right margin of:'%level, mcr)
 
         if remove_left or remove_right:
-            for elem in elems:
-                lm, rm, style = self.get_margins(elem)
+            for cls, num_paras in elems:
+                lm, rm, style = self.get_margins(cls)
                 if remove_left and lm == mcl:
                     style.removeProperty('margin-left')
                 if remove_right and rm == mcr:
@@ -145,11 +144,16 @@ class RemoveFakeMargins(object):
             body = body[0]
 
             for p in paras(body):
-                level = level_of(p, body)
-                level = '%s_%d'%(barename(p.tag), level)
+                num = level_of(p, body)
+                tag = barename(p.tag)
+                level = '%s_%d'%(tag, num)
                 if level not in self.levels:
                     self.levels[level] = []
-                self.levels[level].append(p)
+                # Only the class and number of child paras of the elements
+                # are needed, so no references to the parsed data of items
+                # are kept, allowing it to be spilled to disk
+                self.levels[level].append((p.get('class', None), len(paras(p)) if tag == 'div' and num < 3 else 0))
+            self.oeb.manifest.enforce_memory_limit()
 
         remove = set()
         for k, v in iteritems(self.levels):
@@ -165,10 +169,7 @@ class RemoveFakeMargins(object):
                 elif level < 3:
                     # Check each level < 3 element and only keep those
                     # that have many child paras
-                    for elem in list(v):
-                        children = len(paras(elem))
-                        if children < 5:
-                            v.remove(elem)
+                    v[:] = [x for x in v if x[1] >= 5]
 
         for k in remove:
             self.levels.pop(k)
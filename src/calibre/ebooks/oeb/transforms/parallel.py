@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the parts of transforms that process every spine item separately in
+worker processes. The results from the workers are merged in spine order, so
+that the book is the same as when the transforms are run in this process.
+'''
+
+import logging
+from collections import defaultdict
+from functools import partial
+
+import css_parser
+from lxml import etree
+
+from calibre import detect_ncpus
+from calibre.ebooks.oeb.base import OEB_STYLES, XHTML, XHTML_NS, OEBBook, css_text, namespace
+from calibre.ebooks.oeb.transforms.flatcss import CSSFlattener, FlattenedStylizer, FontMapper
+from calibre.utils.logging import Log, Stream
+from calibre.utils.serialize import pickle_dumps
+from calibre.utils.xml_parse import safe_xml_fromstring
+from polyglot.builtins import iteritems, string_or_bytes, unicode_type
+
+# Starting the worker processes takes a few seconds, so books with fewer spine
+# items than this are processed in this process
+MIN_ITEMS = 8
+PROFILE_OPTIONS = {'input_profile': 'input', 'source': 'input', 'output_profile': 'output', 'dest': 'output'}
+FLATTENER_OPTIONS = ('fbase', 'fkey', 'lineh', 'unfloat', 'untable', 'page_break_on_body')
+
+
+class JobFailed(Exception):
+
+    def __init__(self, msg, details):
+        Exception.__init__(self, msg)
+        self.details = details
+
+
+class RecordingStream(Stream):
+
+    ''' Records messages logged in a worker, so that they can be logged in
+    the main process, in spine order. '''
+
+    def __init__(self):
+        Stream.__init__(self)
+        self.messages = []
+
+    def prints(self, level, *args, **kwargs):
+        self.messages.append((level, tuple(a if isinstance(a, string_or_bytes) else unicode_type(a) for a in args)))
+
+
+def serialize_options(opts):
+    ans = {}
+    for name, val in iteritems(vars(opts)):
+        if name in PROFILE_OPTIONS:
+            val = val.short_name
+        else:
+            try:
+                pickle_dumps(val)
+            except Exception:
+                continue  # Only used by the output plugins, not by transforms
+        ans[name] = val
+    return ans
+
+
+def unserialize_options(data):
+    from calibre.customize.ui import input_profiles, output_profiles
+    from calibre.ebooks.conversion.plumber import OptionValues
+    profiles = {
+        'input': {p.short_name: p for p in input_profiles()},
+        'output': {p.short_name: p for p in output_profiles()},
+    }
+    opts = OptionValues()
+    for name, val in iteritems(data):
+        if name in PROFILE_OPTIONS:
+            val = profiles[PROFILE_OPTIONS[name]][val]
+        setattr(opts, name, val)
+    return opts
+
+
+# Worker process {{{
+worker_state = None
+
+
+class WorkerCSSFlattener(CSSFlattener):
+
+    def new_class(self, names, styles, klass, css, psel=None):
+        # Record the classes created for an item, so that the main process
+        # can map them to the classes for the whole book
+        match = CSSFlattener.new_class(self, names, styles, klass, css, psel)
+        self.new_classes.append((psel, klass, css, match))
+        return match
+
+
+def create_worker_flattener(common_data):
+    log = Log(level=Log.DEBUG)
+    log.outputs = [RecordingStream()]
+    opts = unserialize_options(common_data['options'])
+    oeb = OEBBook(log, None)
+    oeb.plumber_output_format = common_data['output_format']
+    parser = css_parser.CSSParser(fetcher=lambda x: ('utf-8', b''), log=logging.getLogger('calibre.css'))
+    for item_id, href, media_type, css in common_data['stylesheets']:
+        oeb.manifest.add(item_id, href, media_type, data=parser.parseString(css, href=href, validate=False))
+    specializer = None
+    if common_data['specialize']:
+        from calibre.customize.ui import plugin_for_output_format
+        plugin = plugin_for_output_format(common_data['output_format'])
+        specializer = partial(plugin.specialize_css_for_output, log, opts)
+    ans = WorkerCSSFlattener(specializer=specializer, **common_data['flattener'])
+    ans.oeb, ans.context, ans.opts = oeb, opts, opts
+    ans.filter_css, ans.body_font_family = common_data['filter_css'], common_data['body_font_family']
+    return ans
+
+
+def run_in_worker(func, common_data, item_id, href, media_type, raw):
+    global worker_state
+    if worker_state is None or worker_state[0] is not common_data:
+        worker_state = common_data, create_worker_flattener(common_data)
+    flattener = worker_state[1]
+    messages = flattener.oeb.log.outputs[0].messages
+    del messages[:]
+    item = flattener.oeb.manifest.add(item_id, href, media_type, data=safe_xml_fromstring(raw))
+    try:
+        return func(flattener, item, messages), tuple(messages)
+    finally:
+        flattener.oeb.manifest.remove(item)
+
+
+def font_sizes(item_id, href, media_type, raw, common_data=None):
+    def sizes_for_item(flattener, item, messages):
+        sizes = defaultdict(float)
+        flattener.baseline_item(item, flattener.stylize_item(item), sizes)
+        return tuple(iteritems(sizes))
+    return run_in_worker(sizes_for_item, common_data, item_id, href, media_type, raw)
+
+
+def flatten(item_id, href, media_type, raw, sbase, report_stylize_messages, common_data=None):
+
+    def flatten_item(flattener, item, messages):
+        flattener.sbase = sbase
+        flattener.fmap = FontMapper(sbase, flattener.fbase, flattener.fkey)
+        stylizer = flattener.stylize_item(item)
+        if not report_stylize_messages:
+            del messages[:]
+        flattener.new_classes = []
+        flattener.flatten_item(item, stylizer, defaultdict(int), {}, defaultdict(dict))
+        return {
+            'html': etree.tostring(item.data, encoding='utf-8'),
+            'new_classes': flattener.new_classes,
+            'page_rule': dict(stylizer.page_rule),
+            'font_face_rules': [css_text(r) for r in stylizer.font_face_rules],
+            'body_font_size': stylizer.body_font_size,
+        }
+    return run_in_worker(flatten_item, common_data, item_id, href, media_type, raw)
+# }}}
+
+
+def run_jobs(pool, func, items, log, *args):
+    for i, (item, raw) in enumerate(items):
+        pool(i, __name__, func, item.id, item.href, item.media_type, raw, *args)
+    pool.wait_for_tasks()
+    results = {}
+    while not pool.results.empty():
+        r = pool.results.get()
+        if r.is_terminal_failure:
+            break
+        if r.result.err:
+            raise JobFailed(r.result.err, r.result.traceback)
+        results[r.id] = r.result.value
+    # The result of a job whose worker crashed is never queued
+    if pool.failed or len(results) < len(items):
+        raise JobFailed('Worker process failed', getattr(pool.terminal_failure, 'tb', None))
+    ans = []
+    for i in range(len(items)):
+        value, messages = results[i]
+        for level, args in messages:
+            log.prints(level, *args)
+        ans.append(value)
+    return ans
+
+
+def rename_classes(node, class_map, recurse=True):
+    # Visits the same tags as CSSFlattener.flatten_node()
+    if not isinstance(node.tag, string_or_bytes) or namespace(node.tag) != XHTML_NS:
+        return
+    classes = node.get('class')
+    if classes:
+        node.set('class', ' '.join(class_map.get(x, x) for x in classes.split()))
+    if recurse:
+        for child in node:
+            rename_classes(child, class_map)
+
+
+def flatten_css_in_parallel(flattener):
+    ''' Stylize and flatten the items of the book in worker processes, in
+    two rounds, as the size of the base font depends on all items. Returns
+    False if the book is too small for this to be worthwhile or the workers
+    failed, in which case the book is unchanged. '''
+    from calibre.utils.ipc.pool import Failure, Pool
+    oeb, items = flattener.oeb, flattener.items
+    if len(items) < MIN_ITEMS:
+        return False
+    log = oeb.log
+    common_data = {
+        'options': serialize_options(flattener.opts),
+        'output_format': getattr(oeb, 'plumber_output_format', ''),
+        'stylesheets': [(item.id, item.href, item.media_type, css_text(item.data)) for item in oeb.manifest
+                        if item.media_type in OEB_STYLES and hasattr(item.data, 'cssRules')],
+        'flattener': {name: getattr(flattener, name) for name in FLATTENER_OPTIONS},
+        'filter_css': flattener.filter_css, 'body_font_family': flattener.body_font_family,
+        'specialize': flattener.specializer is not None,
+    }
+    items = [(item, etree.tostring(item.data, encoding='utf-8')) for item in items]
+    num_workers = min(detect_ncpus(), len(items))
+    log.info('Flattening CSS in %d worker processes' % num_workers)
+    pool = Pool(max_workers=num_workers, name='FlattenCSS')
+    try:
+        pool.set_common_data(common_data)
+        sbase = None
+        if flattener.fbase:
+            sizes = defaultdict(float)
+            for item_sizes in run_jobs(pool, 'font_sizes', items, log):
+                for size, count in item_sizes:
+                    sizes[size] += count
+            sbase = flattener.source_base_font_size(sizes)
+        results = run_jobs(pool, 'flatten', items, log, sbase, not flattener.fbase)
+    except (Failure, JobFailed) as err:
+        log.warn('Flattening CSS in worker processes failed, flattening in this process instead. Error:', err)
+        log.debug(getattr(err, 'details', None) or '')
+        return False
+    finally:
+        pool.shutdown()
+
+    flattener.sbase = sbase
+    flattener.fmap = FontMapper(sbase, flattener.fbase, flattener.fkey)
+    flattener.stylizers = {}
+    names, styles, pseudo_styles = defaultdict(int), {}, defaultdict(dict)
+    for (item, raw), result in zip(items, results):
+        # Allocate the class names in the same order as when flattening in
+        # this process, so that they are the same
+        class_map = {}
+        for psel, klass, css, match in result['new_classes']:
+            table = styles if psel is None else pseudo_styles[psel]
+            class_map[match] = table[css] if css in table else flattener.new_class(names, table, klass, css, psel)
+        html = safe_xml_fromstring(result['html'])
+        rename_classes(html, class_map, recurse=False)
+        body = html.find(XHTML('body'))
+        if body is not None:
+            rename_classes(body, class_map)
+        item.data = html
+        flattener.stylizers[item] = FlattenedStylizer(
+            flattener.context.source, result['page_rule'],
+            [css_parser.parseString(r, validate=False).cssRules[0] for r in result['font_face_rules']], result['body_font_size'])
+    flattener.create_stylesheets(styles, pseudo_styles)
+    return True
+
+
+def find_tests():
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    def create_book(tdir, count):
+        css = (
+            'body { font-size: 12pt; font-family: serif }\n'
+            'p { margin: 0; text-indent: 1.5em }\n'
+            '.big { font-size: 1.5em } .small { font-size: 0.8em }\n'
+            'h1 { font-size: 2em; text-align: center }\n'
+            'a:hover { color: red } a:link { color: blue }\n'
+            '@page { margin-top: 10pt }\n'
+        )
+        with open(os.path.join(tdir, 'style.css'), 'w') as f:
+            f.write(css)
+        for i in range(count):
+            paras = ''.join(
+                '<p id="p{0}" class="{1}" style="{2}">Text {0} <a href="#p0">link</a> <span class="small">small</span></p>'.format(
+                    j, ('', 'big', 'small', 'c%d' % j)[(i + j) % 4], 'color: #%02x0000' % j if j % 5 == 0 else '')
+                for j in range(20))
+            inline = '<style>.c{0} {{ font-weight: bold; font-size: {1}pt }}</style>'.format(i % 4, 10 + i) if i % 3 == 0 else ''
+            with open(os.path.join(tdir, 'ch%d.html' % i), 'w') as f:
+                f.write(
+                    '<html xmlns="{0}"><head><title>Chapter {1}</title><link rel="stylesheet" href="style.css"/>{2}</head>'
+                    '<body><h1 class="c{3}">Chapter {1}</h1>{4}<font size="+1">font</font></body></html>'.format(XHTML_NS, i, inline, i % 4, paras))
+        with open(os.path.join(tdir, 'book.opf'), 'w') as f:
+            f.write(
+                '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Parallel</dc:title><dc:identifier id="id">parallel</dc:identifier>'
+                '<dc:language>en</dc:language></metadata><manifest><item id="css" href="style.css" media-type="text/css"/>{0}</manifest>'
+                '<spine>{1}</spine></package>'.format(
+                    ''.join('<item id="ch{0}" href="ch{0}.html" media-type="application/xhtml+xml"/>'.format(i) for i in range(count)),
+                    ''.join('<itemref idref="ch%d"/>' % i for i in range(count))))
+        return os.path.join(tdir, 'book.opf')
+
+    class TestParallel(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def convert(self, path, parallel):
+            from calibre.ebooks.conversion.plumber import OptionRecommendation, Plumber
+            output = os.path.join(self.tdir, 'output-%d' % parallel)
+            log = Log(level=Log.DEBUG)
+            log.outputs = [RecordingStream()]
+            plumber = Plumber(path, output, log)
+            plumber.merge_ui_recommendations([('parallel_transforms', parallel, OptionRecommendation.HIGH)])
+            plumber.run()
+            messages = [' '.join(args) for level, args in log.outputs[0].messages]
+            ans = {}
+            for dirpath, dirnames, filenames in os.walk(output):
+                for name in filenames:
+                    if name.endswith(('.html', '.css')):
+                        with open(os.path.join(dirpath, name), 'rb') as f:
+                            ans[os.path.relpath(os.path.join(dirpath, name), output)] = f.read()
+            return ans, messages
+
+        def test_flatten_css(self):
+            path = create_book(self.tdir, MIN_ITEMS + 2)
+            sequential, messages = self.convert(path, False)
+            parallel, messages = self.convert(path, True)
+            self.assertTrue(any(m.startswith('Flattening CSS in') and 'worker processes' in m for m in messages))
+            self.assertFalse([m for m in messages if 'worker processes failed' in m])
+            self.assertEqual(len([name for name in sequential if name.endswith('.html')]), MIN_ITEMS + 2)
+            self.assertIn('stylesheet.css', sequential)
+            self.assertEqual(sequential, parallel)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestParallel)
@@ -9,6 +9,18 @@ __docformat__ = 'restructuredtext en'
 from calibre import fit_image
 
 
+def rescale_image(raw, fmt, width, height, convert_to_rgb, common_data=None):
+    from PIL import Image
+    from io import BytesIO
+    img = Image.open(BytesIO(raw))
+    if convert_to_rgb:
+        img = img.convert('RGB')
+    img = img.resize((width, height))
+    buf = BytesIO()
+    img.save(buf, fmt)
+    return buf.getvalue()
+
+
 class RescaleImages(object):
 
     'Rescale all images to fit inside given screen size'
@@ -23,6 +35,7 @@ class RescaleImages(object):
     def rescale(self):
         from PIL import Image
         from io import BytesIO
+        from calibre.ebooks.conversion.images import num_workers, process_images, timing_summary
 
         is_image_collection = getattr(self.opts, 'is_image_collection', False)
 
@@ -33,6 +46,9 @@ class RescaleImages(object):
             page_width -= (self.opts.margin_left + self.opts.margin_right) * self.opts.dest.dpi/72
             page_height -= (self.opts.margin_top + self.opts.margin_bottom) * self.opts.dest.dpi/72
 
+        # Only the headers of the images are read here, the images that have
+        # to be rescaled are decoded and re-encoded by rescale_image()
+        to_rescale = []
         for item in self.oeb.manifest:
             if item.media_type.startswith('image'):
                 ext = item.media_type.split('/')[-1].upper()
@@ -51,14 +67,12 @@ class RescaleImages(object):
                     continue
                 width, height = img.size
 
-                try:
-                    if self.check_colorspaces and img.mode == 'CMYK':
-                        self.log.warn(
-                            'The image %s is in the CMYK colorspace, converting it '
-                            'to RGB as Adobe Digital Editions cannot display CMYK' % item.href)
-                        img = img.convert('RGB')
-                except Exception:
-                    self.log.exception('Failed to convert image %s from CMYK to RGB' % item.href)
+                convert_to_rgb = False
+                if self.check_colorspaces and img.mode == 'CMYK':
+                    self.log.warn(
+                        'The image %s is in the CMYK colorspace, converting it '
+                        'to RGB as Adobe Digital Editions cannot display CMYK' % item.href)
+                    convert_to_rgb = True
 
                 scaled, new_width, new_height = fit_image(width, height, page_width, page_height)
                 if scaled:
@@ -66,16 +80,22 @@ class RescaleImages(object):
                     new_height = max(1, new_height)
                     self.log('Rescaling image from %dx%d to %dx%d'%(
                         width, height, new_width, new_height), item.href)
-                    try:
-                        img = img.resize((new_width, new_height))
-                    except Exception:
-                        self.log.exception('Failed to rescale image: %s' % item.href)
-                        continue
-                    buf = BytesIO()
-                    try:
-                        img.save(buf, ext)
-                    except Exception:
-                        self.log.exception('Failed to rescale image: %s' % item.href)
-                    else:
-                        item.data = buf.getvalue()
-                        item.unload_data_from_memory()
+                    to_rescale.append((item, ext, new_width, new_height, convert_to_rgb))
+
+        max_workers = num_workers(len(to_rescale)) if getattr(self.opts, 'parallel_transforms', False) else 1
+        # The data is read from the items as it is needed, so that it can be
+        # removed from memory as soon as each image is done
+        jobs = ((item, (item.data, ext, width, height, convert_to_rgb)) for item, ext, width, height, convert_to_rgb in to_rescale)
+        results = []
+        for result in process_images(jobs, __name__, 'rescale_image', max_workers=max_workers, name='RescaleImages'):
+            results.append(result)
+            item = result.id
+            if result.error is not None:
+                self.log.error('Failed to rescale image: %s' % item.href)
+                self.log.debug(result.error)
+                continue
+            self.log.debug('Rescaled image %s in %.3f seconds' % (item.href, result.time))
+            item.data = result.value
+            item.unload_data_from_memory()
+        if results:
+            self.log.debug(timing_summary(results))
@@ -10,6 +10,7 @@ assumes a prior call to the flatcss transform.
 '''
 
 import os, functools, collections, re, copy
+from bisect import bisect_left
 from collections import OrderedDict
 
 from lxml.etree import XPath as _XPath
@@ -18,21 +19,162 @@ from lxml import etree
 from calibre import as_unicode, force_unicode
 from calibre.ebooks.epub import rules
 from calibre.ebooks.oeb.base import (OEB_STYLES, XPNSMAP as NAMESPACES,
-        urldefrag, rewrite_links, XHTML, urlnormalize)
-from calibre.ebooks.oeb.polish.split import do_split
-from polyglot.builtins import iteritems, range, map, unicode_type
+        urldefrag, rewrite_links, XHTML, XHTML_NS, urlnormalize, barename, namespace)
+from calibre.ebooks.oeb.polish.split import adjust_split_point, do_split
+from polyglot.builtins import iteritems, range, map, string_or_bytes, unicode_type
 from polyglot.urllib import unquote
 from css_selectors import Select, SelectorError
 
 XPath = functools.partial(_XPath, namespaces=NAMESPACES)
 
 SPLIT_POINT_ATTR = 'csp'
+# Trees are not split such that one of the parts is smaller than this
+MIN_SPLIT_SIZE = 5 * 1024
 
 
 def tostring(root):
     return etree.tostring(root, encoding='utf-8')
 
 
+def text_size(text, attribute=False):
+    ' The size of text, serialized as the text or as the value of an attribute of an element '
+    if not text:
+        return 0
+    ans = len(text.encode('utf-8')) + 4 * text.count('&') + 3 * (text.count('<') + text.count('>') + text.count('\r'))
+    if attribute:
+        ans += 5 * text.count('"') + 4 * (text.count('\n') + text.count('\t'))
+    return ans
+
+
+def split_priority(elem, valid_paths):
+    '''
+    The priority of elem as a split point, lower is better, in the same
+    order as :meth:`FlowSplitter.find_split_point`, or None if the tree must
+    not be split at elem. valid_paths caches whether the paths of elements
+    are valid XPath expressions, as that depends only on the tags of the
+    element and its ancestors.
+    '''
+    if not isinstance(elem.tag, string_or_bytes) or namespace(elem.tag) != XHTML_NS:
+        return None
+    name = barename(elem.tag)
+    if re.search(r'h[1-6]', name, flags=re.I) is not None:
+        ans = 0
+    elif name == 'div':
+        parent = elem.getparent()
+        ans = 1 if barename(parent.tag) == 'body' and parent.getparent() is not None and parent.getparent().getparent() is None else 5
+    else:
+        ans = {'pre': 2, 'hr': 3, 'p': 4, 'br': 6, 'li': 7}.get(name)
+        if ans is None:
+            return None
+    key = tuple((x.tag, x.prefix) for x in elem.iterancestors()) + ((elem.tag, elem.prefix),)
+    valid = valid_paths.get(key)
+    if valid is None:
+        try:
+            XPath(elem.getroottree().getpath(elem))
+            valid = True
+        except Exception:
+            valid = False
+        valid_paths[key] = valid
+    return ans if valid else None
+
+
+def serialized_positions(body):
+    '''
+    Estimate the position, in bytes, of the start tag of every element in
+    body in its serialized form, in a single pass. Returns the positions and
+    the estimated size of the contents of body.
+    '''
+    positions, pos = {}, 0
+    for event, elem in etree.iterwalk(body, events=('start', 'end')):
+        if event == 'start':
+            positions[elem] = pos
+            pos += len(barename(elem.tag)) + 2 + text_size(elem.text) + sum(
+                len(barename(k)) + text_size(v, True) + 4 for k, v in iteritems(elem.attrib))
+            if elem is body:
+                content_start = pos
+            for child in elem:
+                # Comments and processing instructions are not walked, they
+                # are counted as if they were at the start of their parent
+                if not isinstance(child.tag, string_or_bytes):
+                    pos += len(etree.tostring(child, encoding='utf-8', with_tail=False)) + text_size(child.tail)
+        elif elem is not body:
+            if len(elem) or elem.text:
+                pos += len(barename(elem.tag)) + 3
+            else:
+                # Empty elements are serialized as <tag/>
+                pos += 1
+            pos += text_size(elem.tail)
+    return positions, pos - content_start
+
+
+class PartCopier(object):
+
+    '''
+    Copies the parts of the tree rooted at root between split points, with
+    the same result as splitting the tree with :func:`do_split` before each
+    of them. Only the ancestors of the split points are visited, everything
+    else is either copied whole or skipped, so copying all the parts of a
+    tree takes time proportional to its size.
+    '''
+
+    def __init__(self, root, body):
+        self.root, self.body = root, body
+        self.nodes = tuple(body.iterdescendants())
+        # The position of every node in document order and the position of
+        # its last descendant
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.last = {}
+        for node in reversed(self.nodes):
+            self.last[node] = self.last[node[-1]] if len(node) else self.index[node]
+        self.children = {}
+
+    def children_between(self, parent, lo, hi):
+        ' The children of parent that end at or after lo and start before hi '
+        try:
+            children, firsts, ends = self.children[parent]
+        except KeyError:
+            children = tuple(parent)
+            firsts = [self.index[c] for c in children]
+            ends = [self.last[c] for c in children]
+            self.children[parent] = children, firsts, ends
+        return children[bisect_left(ends, lo):bisect_left(firsts, hi)]
+
+    def __call__(self, start, stop):
+        ''' Copy the part from the element start to just before the element
+        stop. start is None for the first part and stop for the last part. '''
+        index, last = self.index, self.last
+        lo = -1 if start is None else index[start]
+        hi = len(index) if stop is None else index[stop]
+
+        def copy_shell(src, dest, text):
+            ans = src.makeelement(src.tag, src.attrib)
+            ans.text, ans.tail = text, src.tail
+            dest.append(ans)
+            return ans
+
+        def copy_children(src, dest):
+            for child in self.children_between(src, lo, hi):
+                first, end = index[child], last[child]
+                if first < lo:
+                    # An ancestor of start, its text comes before start
+                    copy_children(child, copy_shell(child, dest, '\n'))
+                elif end < hi:
+                    dest.append(copy.deepcopy(child))
+                else:
+                    # An ancestor of stop
+                    copy_children(child, copy_shell(child, dest, child.text))
+
+        # A new document, so that getroottree() works for the part
+        ans = etree.Element(self.root.tag, self.root.attrib, nsmap=self.root.nsmap)
+        ans.text = self.root.text
+        for child in self.root:
+            if child is self.body:
+                copy_children(child, copy_shell(child, ans, child.text if start is None else '\n'))
+            else:
+                ans.append(copy.deepcopy(child))
+        return ans.getroottree()
+
+
 class SplitError(ValueError):
 
     def __init__(self, path, root):
@@ -221,7 +363,7 @@ class FlowSplitter(object):
                     self.log('\tFound large tree #%d'%i)
                     lt_found = True
                     self.split_trees = []
-                    self.split_to_size(tree)
+                    self.split_to_size_in_one_pass(tree)
                     self.tree_map[tree] = self.split_trees
             if not lt_found:
                 self.log('\tNo large trees found')
@@ -295,9 +437,8 @@ class FlowSplitter(object):
         body = self.get_body(root)
         if body is None:
             return False
-        txt = re.sub(r'\s+|\xa0', '',
-                etree.tostring(body, method='text', encoding='unicode'))
-        if len(txt):
+        txt = etree.tostring(body, method='text', encoding='unicode')
+        if re.search(r'[^\s\xa0]', txt) is not None:
             return False
         for img in root.xpath('//h:img', namespaces=NAMESPACES):
             if img.get('style', '') != 'display:none':
@@ -324,9 +465,7 @@ class FlowSplitter(object):
                 buf = part
         return ans
 
-    def split_to_size(self, tree):
-        self.log.debug('\t\tSplitting...')
-        root = tree.getroot()
+    def split_large_pres(self, root):
         # Split large <pre> tags if they contain only text
         for pre in XPath('//h:pre')(root):
             if len(tuple(pre.iterchildren(etree.Element))) > 0:
@@ -345,6 +484,11 @@ class FlowSplitter(object):
                 i = p.index(pre)
                 p[i:i+1] = new_pres
 
+    def split_to_size(self, tree):
+        self.log.debug('\t\tSplitting...')
+        root = tree.getroot()
+        self.split_large_pres(root)
+
         split_point, before = self.find_split_point(root)
         if split_point is None:
             raise SplitError(self.item.href, root)
@@ -357,6 +501,9 @@ class FlowSplitter(object):
             self.split_to_size(tree)
             return
 
+        self.commit_split_trees(trees, sizes)
+
+    def commit_split_trees(self, trees, sizes):
         for t, size in zip(trees, sizes):
             r = t.getroot()
             if self.is_page_empty(r):
@@ -371,6 +518,79 @@ class FlowSplitter(object):
                         '\t\t\tSplit tree still too large: %d KB' % (size/1024.))
                 self.split_to_size(t)
 
+    def split_to_size_in_one_pass(self, tree):
+        '''
+        Split tree into parts no larger than max_flow_size, at the same split
+        points as :meth:`split_to_size`. Unlike :meth:`split_to_size`, which
+        splits the tree in two and re-serializes both halves to measure them,
+        recursively, the sizes of all elements are estimated once and the
+        tree is copied into its parts only once all the split points have
+        been chosen. Any parts that are still too large are split with
+        :meth:`split_to_size`.
+        '''
+        self.log.debug('\t\tSplitting in one pass...')
+        root = tree.getroot()
+        self.split_large_pres(root)
+        body = self.get_body(root)
+        if body is None:
+            return self.split_to_size(tree)
+        copy_part = PartCopier(root, body)
+        index = copy_part.index
+        positions, content_size = serialized_positions(body)
+        # The size of everything other than the contents of <body>, such as
+        # <head>, this also absorbs any error in the estimated sizes
+        overhead = max(0, len(tostring(root)) - content_size)
+        groups, priorities, valid_paths = collections.defaultdict(list), {}, {}
+        for node in copy_part.nodes:
+            priority = split_priority(node, valid_paths)
+            if priority is not None:
+                groups[priority].append(node)
+                priorities[node] = priority
+        group_indices = {priority: [index[x] for x in nodes] for priority, nodes in iteritems(groups)}
+        # Elements that were tried as split points, the equivalent of the
+        # SPLIT_POINT_ATTR set by find_split_point()
+        tried = set()
+
+        def position(elem, default):
+            return default if elem is None else positions[elem]
+
+        def split_points(start, stop):
+            # The split points of the part from start to just before stop,
+            # chosen the way find_split_point() chooses them: the middle
+            # element of the best kind that has not been tried before
+            begin, end = position(start, 0), position(stop, content_size)
+            if end - begin + overhead <= self.max_flow_size:
+                return []
+            lo = -1 if start is None else index[start]
+            hi = len(index) if stop is None else index[stop]
+            # The ancestors of start are in the part too, before everything else
+            ancestors = [] if start is None else [x for x in reversed(tuple(start.iterancestors())) if x in priorities]
+            for priority in sorted(groups):
+                nodes, indices = groups[priority], group_indices[priority]
+                elems = [x for x in ancestors if priorities[x] == priority] + nodes[
+                    bisect_left(indices, max(lo, 0)):bisect_left(indices, hi)]
+                elems = [x for x in elems if x not in tried]
+                while elems:
+                    elem = elems.pop(len(elems) // 2)
+                    tried.add(elem)
+                    split_point = adjust_split_point(elem, self.log)
+                    pos = positions[split_point]
+                    if lo < index[split_point] < hi and min(pos - begin, end - pos) + overhead >= MIN_SPLIT_SIZE:
+                        return split_points(start, split_point) + [split_point] + split_points(split_point, stop)
+                    self.log.debug('\t\t\tSplit tree too small')
+            # The part is split by split_to_size() below, if it really is too large
+            return []
+
+        points = split_points(None, None)
+        if not points:
+            self.log.debug('\t\t\tNo split points found in one pass')
+            return self.split_to_size(tree)
+
+        self.log.debug('\t\t\tFound %d split points' % len(points))
+        trees = [copy_part(start, stop) for start, stop in zip(
+            [None] + points, points + [None])]
+        self.commit_split_trees(trees, [len(tostring(t.getroot())) for t in trees])
+
     def find_split_point(self, root):
         '''
         Find the tag at which to split the tree rooted at `root`.
@@ -486,3 +706,82 @@ class FlowSplitter(object):
                     page.href = nhref
 
         self.oeb.manifest.remove(self.item)
+
+
+def create_large_file(size, para_size=1024):
+    ''' Create an OEBBook with a single HTML file of about size bytes, made of
+    many paragraphs with an occasional heading, like a book converted from TXT. '''
+    from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+    from calibre.ebooks.oeb.base import OEBBook
+    from calibre.utils.logging import Log
+    log = Log()
+    log.outputs = []
+    oeb = OEBBook(log, HTMLPreProcessor(log))
+    text = 'Some text in a paragraph. ' * (para_size // 26)
+    paras = ''.join(('<h2 id="c%d">Chapter %d</h2>' % (i, i) if i % 100 == 0 else '') + '<p id="p%d">%s</p>' % (i, text) for i in range(size // para_size))
+    html = '<html xmlns="%s"><head><title>t</title></head><body>%s<p><a href="#p1">link</a></p></body></html>' % (XHTML_NS, paras)
+    item = oeb.manifest.add('x', 'index.html', 'application/xhtml+xml', data=etree.fromstring(html))
+    oeb.spine.add(item, True)
+    return oeb, item
+
+
+def benchmark(args=None):
+    ''' Report the time taken to split a single HTML file of the specified size,
+    50MB by default, into files of at most 260KB. Run with:
+    calibre-debug -c "from calibre.ebooks.oeb.transforms.split import benchmark; benchmark()" size_in_mb '''
+    import sys
+    from calibre.utils.monotonic import monotonic
+    args = sys.argv if args is None else args
+    size = int(args[1]) if len(args) > 1 else 50
+    oeb, item = create_large_file(size * 1024 * 1024)
+    start = monotonic()
+    FlowSplitter(item, [], [], 260 * 1024, oeb, None)
+    print('Split %d MB of HTML into %d files in %.2f seconds' % (size, len(oeb.spine), monotonic() - start))
+
+
+def find_tests():
+    import unittest
+
+    class TestSplit(unittest.TestCase):
+
+        def test_copy_part(self):
+            from calibre.utils.logging import Log
+            log = Log()
+            log.outputs = []
+            root = etree.fromstring(
+                '<html xmlns="%s"><head><title>t</title></head><body>a<div id="d">b<p id="p1">c</p>d<div id="e"><p id="p2">e</p>f</div>g'
+                '<p id="p3">h<br id="br"/>i</p>j</div>k<h2 id="h">l</h2>m</body></html>' % XHTML_NS)
+            copy_part = PartCopier(root, root[1])
+            for a, b in (('p1', 'p3'), ('p2', 'br'), ('d', 'h'), ('br', 'h')):
+                a, b = (adjust_split_point(root.xpath('//*[@id="%s"]' % x)[0], log) for x in (a, b))
+                before, after = do_split(a, log)
+                mid = do_split(after.getroot().xpath('//*[@id="%s"]' % b.get('id'))[0], log)[0]
+                for expected, start, stop in ((before, None, a), (mid, a, b)):
+                    self.assertEqual(tostring(copy_part(start, stop).getroot()), tostring(expected.getroot()))
+                self.assertEqual(tostring(copy_part(b, None).getroot()), tostring(do_split(b, log)[1].getroot()))
+
+        def test_split_to_size(self):
+            oeb, item = create_large_file(500 * 1024)
+            max_size = 50 * 1024
+            FlowSplitter(item, [], [], max_size, oeb, None)
+            items = list(oeb.spine)
+            self.assertGreater(len(items), 500 * 1024 // max_size)
+            for x in items:
+                self.assertLessEqual(len(tostring(x.data)), max_size)
+            text = ''.join(etree.tostring(x.data, method='text', encoding='unicode') for x in items)
+            self.assertEqual(text.count('Some text'), 500 * (1024 // 26))
+            self.assertEqual(items[-1].data.xpath('//*[@href]')[0].get('href'), items[0].href + '#p1')
+
+            # The same split points as splitting recursively
+            class RecursiveSplitter(FlowSplitter):
+                split_to_size_in_one_pass = FlowSplitter.split_to_size
+
+            for para_size in (1024, 300):
+                parts = []
+                for cls in (FlowSplitter, RecursiveSplitter):
+                    oeb, item = create_large_file(500 * 1024, para_size)
+                    cls(item, [], [], max_size, oeb, None)
+                    parts.append([tostring(x.data) for x in oeb.spine])
+                self.assertEqual(parts[0], parts[1])
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestSplit)
@@ -9,7 +9,8 @@ __docformat__ = 'restructuredtext en'
 from collections import defaultdict
 
 from calibre.ebooks.oeb.base import urlnormalize, css_text
-from calibre.utils.fonts.sfnt.subset import subset, NoGlyphs, UnsupportedFont
+from calibre import detect_ncpus
+from calibre.utils.fonts.sfnt.subset import subset_fonts, subset_or_error, NoGlyphs, UnsupportedFont
 from polyglot.builtins import iteritems, itervalues, unicode_type, range
 from tinycss.fonts3 import parse_font_family
 
@@ -151,24 +152,32 @@ class SubsetFonts(object):
             else:
                 fonts[item.href] = font
 
+        results = {}
+        if getattr(self.opts, 'parallel_transforms', False):
+            used = [font for font in itervalues(fonts) if font['chars']]
+            results = dict(zip((font['item'].href for font in used), subset_fonts(
+                [(font['item'].data, font['chars']) for font in used], detect_ncpus())))
+
         for font in itervalues(fonts):
             if not font['chars']:
                 self.log('The font %s is unused. Removing it.'%font['src'])
                 remove(font)
                 continue
-            try:
-                raw, old_stats, new_stats = subset(font['item'].data, font['chars'])
-            except NoGlyphs:
+            result = results.pop(font['item'].href, None)
+            if result is None:
+                result = subset_or_error(font['item'].data, font['chars'])
+            if isinstance(result, NoGlyphs):
                 self.log('The font %s has no used glyphs. Removing it.'%font['src'])
                 remove(font)
                 continue
-            except UnsupportedFont as e:
+            if isinstance(result, UnsupportedFont):
                 self.log.warn('The font %s is unsupported for subsetting. %s'%(
-                    font['src'], e))
+                    font['src'], result))
                 sz = len(font['item'].data)
                 totals[0] += sz
                 totals[1] += sz
             else:
+                raw, old_stats, new_stats = result
                 font['item'].data = raw
                 nlen = sum(itervalues(new_stats))
                 olen = sum(itervalues(old_stats))
@@ -222,13 +231,52 @@ class SubsetFonts(object):
         self.style_rules = dict(rules)
 
     def find_font_usage(self):
+        # The style of an element depends only on the style of its parent and
+        # on its class attribute, so the style, and the embedded font it uses,
+        # are computed once for every distinct pair of the two and shared by all
+        # the elements in the book with that pair. The text that uses each font
+        # is collected in a list and converted to a set of characters at the end.
+        self.styles, self.style_ids, self.child_styles = [], {}, {}
+        self.text_runs = defaultdict(list)
+        base = self.style_id({'font-family':['serif'], 'font-weight': '400',
+                'font-style':'normal', 'font-stretch':'normal'})
         for item in self.oeb.manifest:
             if not hasattr(item.data, 'xpath'):
                 continue
             for body in item.data.xpath('//*[local-name()="body"]'):
-                base = {'font-family':['serif'], 'font-weight': '400',
-                        'font-style':'normal', 'font-stretch':'normal'}
                 self.find_usage_in(body, base)
+        for i, runs in iteritems(self.text_runs):
+            self.embedded_fonts[i]['chars'] |= set(''.join(runs))
+        del self.styles, self.style_ids, self.child_styles, self.text_runs
+
+    def style_id(self, style):
+        key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in iteritems(style)))
+        ans = self.style_ids.get(key)
+        if ans is None:
+            font = self.used_font(style)
+            font = None if font is None else next(i for i, f in enumerate(self.embedded_fonts) if f is font)
+            ans = self.style_ids[key] = len(self.styles)
+            self.styles.append((style, font))
+        return ans
+
+    def find_usage_in(self, body, base):
+        styles, child_styles, text_runs = self.styles, self.child_styles, self.text_runs
+        stack = [(body, base)]
+        while stack:
+            elem, parent = stack.pop()
+            key = parent, elem.get('class', '') or ''
+            sid = child_styles.get(key)
+            if sid is None:
+                sid = child_styles[key] = self.style_id(elem_style(self.style_rules, key[1], styles[parent][0]))
+            font = styles[sid][1]
+            if font is not None:
+                runs = text_runs[font]
+                if elem.text:
+                    runs.append(elem.text)
+                for child in elem:
+                    if child.tail:
+                        runs.append(child.tail)
+            stack.extend((child, sid) for child in elem)
 
     def used_font(self, style):
         '''
@@ -296,21 +344,40 @@ class SubsetFonts(object):
             if matches:
                 return matches[0]
 
-    def find_chars(self, elem):
-        ans = set()
-        if elem.text:
-            ans |= set(elem.text)
-        for child in elem:
-            if child.tail:
-                ans |= set(child.tail)
-        return ans
 
-    def find_usage_in(self, elem, inherited_style):
-        style = elem_style(self.style_rules, elem.get('class', '') or '', inherited_style)
-        for child in elem:
-            self.find_usage_in(child, style)
-        font = self.used_font(style)
-        if font:
-            chars = self.find_chars(elem)
-            if chars:
-                font['chars'] |= chars
+def find_tests():
+    import unittest
+
+    class TestSubsetFonts(unittest.TestCase):
+
+        def test_font_usage(self):
+            from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+            from calibre.ebooks.oeb.base import OEBBook
+            from calibre.utils.logging import Log
+            log = Log()
+            log.outputs = []
+            oeb = OEBBook(log, HTMLPreProcessor(log))
+            for name in ('a.ttf', 'ab.ttf', 'b.ttf'):
+                oeb.manifest.add(name, name, 'application/x-font-ttf', data=b'font')
+            oeb.manifest.add('css', 'styles.css', 'text/css', data='''
+                @font-face { font-family: A; src: url(a.ttf) }
+                @font-face { font-family: A; font-weight: bold; src: url(ab.ttf) }
+                @font-face { font-family: "B"; font-style: italic; src: url(b.ttf) }
+                .a { font-family: A } .b { font-family: B; font-style: italic }
+                .w { font-weight: bold } .x { font-weight: bolder } .s { font-family: serif }''')
+            oeb.manifest.add('html', 'index.html', 'application/xhtml+xml', data='''
+                <html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head><body>
+                <p class="a">abc<span class="w">def</span>ghi<!--jk--><span class="x">lm<span class="s">no</span>pq</span></p>
+                <div class="b">rst<p class="a w">uv</p>wx</div><p class="a">ab<span class="w">d</span></p><p>yz</p></body></html>''')
+            s = SubsetFonts()
+            s.oeb, s.log, s.opts = oeb, log, None
+            s.find_embedded_fonts()
+            s.find_style_rules()
+            s.find_font_usage()
+            usage = defaultdict(set)
+            for font in s.embedded_fonts:
+                usage[font['item'].href] |= font['chars']
+            self.assertEqual(dict(usage), {
+                'a.ttf': set('abcghijk'), 'ab.ttf': set('deflmpquv'), 'b.ttf': set('rstwx')})
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestSubsetFonts)
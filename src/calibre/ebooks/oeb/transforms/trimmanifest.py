@@ -65,6 +65,7 @@ class ManifestTrimmer(object):
                             found = oeb.manifest.hrefs[href]
                             if found not in used:
                                 new.add(found)
+                oeb.manifest.enforce_memory_limit()
             used.update(new)
             unchecked = new
         for item in oeb.manifest.values():
@@ -16,7 +16,10 @@ from calibre.utils.logging import Log
 
 def gui_convert(input, output, recommendations, notification=DummyReporter(),
         abort_after_input_dump=False, log=None, override_input_metadata=False):
-    recommendations = list(recommendations)
+    from calibre.utils.config import tweaks
+    input_cache_size = tweaks['conversion_input_cache_size']
+    if input_cache_size > 0:
+        recommendations = [('input_cache_size', input_cache_size, OptionRecommendation.HIGH)] + list(recommendations)
     recommendations.append(('verbose', 2, OptionRecommendation.HIGH))
     if log is None:
         log = Log()
@@ -5,7 +5,7 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, random, struct
+import hmac, os, random, struct
 from collections import OrderedDict
 from hashlib import md5, sha256
 from itertools import permutations
@@ -16,9 +16,10 @@ from calibre.srv.http_request import parse_uri
 from calibre.srv.utils import parse_http_dict, encode_path
 from calibre.utils.monotonic import monotonic
 from polyglot import http_client
-from polyglot.binary import from_base64_unicode, from_hex_bytes, as_hex_unicode
+from polyglot.binary import from_base64_unicode, from_hex_bytes, as_hex_unicode, from_hex_unicode
 
 MAX_AGE_SECONDS = 3600
+CREDENTIALS_CACHE_TTL = 60
 nonce_counter, nonce_counter_lock = 0, Lock()
 
 
@@ -120,6 +121,54 @@ def is_nonce_stale(nonce, max_age_seconds=MAX_AGE_SECONDS):
     return True
 
 
+def session_signature(secret, username, expires, pw):
+    return hmac.new(as_bytestring(secret), as_bytestring('\0'.join((username, expires, pw))), sha256).hexdigest()
+
+
+def create_session_token(secret, username, pw, expires):
+    '''
+    Create a session token of the form username:expires:signature where the
+    signature is a HMAC of the username, expiry time and password. Changing
+    the password of a user invalidates all their session tokens.
+    '''
+    expires = '%d' % expires
+    return ':'.join((as_hex_unicode(username), expires, session_signature(secret, username, expires, pw)))
+
+
+class CredentialsCache(object):
+
+    '''
+    An expiring in-memory cache of user passwords, used to validate session
+    tokens without a user database lookup on every request. Entries are
+    discarded after ttl seconds, or when the generation attribute of
+    user_credentials, if any, changes, which happens when users are changed in
+    this process.
+    '''
+
+    def __init__(self, user_credentials, ttl=CREDENTIALS_CACHE_TTL, max_size=1000):
+        self.user_credentials, self.ttl, self.max_size = user_credentials, ttl, max_size
+        self.items = {}
+        self.generation = None
+        self.lock = Lock()
+
+    def get(self, username):
+        now = monotonic()
+        generation = getattr(self.user_credentials, 'generation', None)
+        with self.lock:
+            if generation != self.generation:
+                self.items.clear()
+                self.generation = generation
+            x = self.items.get(username)
+            if x is not None and x[1] > now:
+                return x[0]
+        pw = self.user_credentials.get(username)
+        with self.lock:
+            if len(self.items) >= self.max_size:
+                self.items.clear()
+            self.items[username] = pw, now + self.ttl
+        return pw
+
+
 class DigestAuth(object):  # {{{
 
     valid_algorithms = {'MD5', 'MD5-SESS'}
@@ -239,13 +288,23 @@ class AuthController(object):
     hijacking, since we have to ignore repeated nc values, because Firefox does
     not implement the digest auth spec properly (it sends out of order nc
     values).
+
+    If session_lifetime (in seconds) is non-zero, a signed session cookie is
+    set after a successful login. Requests with a valid session cookie and no
+    Authorization header are authenticated by checking its signature, without
+    verifying credentials, which is much faster, for example, when a page loads hundreds of
+    thumbnails. The same caveats about session-hijacking apply.
     '''
     ANDROID_COOKIE = 'android_workaround'
+    SESSION_COOKIE = 'calibre_session'
 
     def __init__(self,
                  user_credentials=None, prefer_basic_auth=False, realm='calibre',
-                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5):
+                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5,
+                 session_lifetime=0):
         self.user_credentials, self.prefer_basic_auth = user_credentials, prefer_basic_auth
+        self.session_lifetime = session_lifetime
+        self.credentials_cache = CredentialsCache(user_credentials)
         self.ban_list = BanList(ban_time_in_minutes=ban_time_in_minutes, max_failures_before_ban=ban_after)
         self.log = log
         self.secret = as_hex_unicode(os.urandom(random.randint(20, 30)))
@@ -270,6 +329,31 @@ class AuthController(object):
     def validate_android_cookie(self, path, cookie):
         return cookie and validate_nonce(self.key_order, cookie, path, self.secret) and not is_nonce_stale(cookie, self.max_age_seconds)
 
+    def validate_session_cookie(self, cookie):
+        ' Return the username for a valid session cookie or None '
+        try:
+            hexname, expires, signature = cookie.split(':')
+            username = from_hex_unicode(hexname)
+            if int(expires) < monotonic():
+                return
+        except Exception:
+            return
+        pw = self.credentials_cache.get(username)
+        if pw and hmac.compare_digest(as_bytestring(signature), as_bytestring(session_signature(self.secret, username, expires, pw))):
+            return username
+
+    def start_session(self, data, username, pw):
+        if self.session_lifetime:
+            token = create_session_token(self.secret, username, pw, monotonic() + self.session_lifetime)
+            data.outcookie[self.SESSION_COOKIE] = token
+            morsel = data.outcookie[self.SESSION_COOKIE]
+            morsel['path'] = '/' + (data.opts.url_prefix or '').strip('/')
+            morsel['max-age'] = self.session_lifetime
+            morsel['httponly'] = True
+            morsel['samesite'] = 'Strict'
+            if data.is_ssl:
+                morsel['secure'] = True
+
     def do_http_auth(self, data, endpoint):
         ban_key = data.remote_addr, data.forwarded_for
         if self.ban_list.is_banned(ban_key):
@@ -278,6 +362,12 @@ class AuthController(object):
         nonce_is_stale = False
         log_msg = None
         data.username = None
+        # Credentials sent explicitly take precedence over a session cookie
+        if self.session_lifetime and not auth:
+            username = self.validate_session_cookie(data.cookies.get(self.SESSION_COOKIE))
+            if username is not None:
+                data.username = username
+                return
 
         if auth:
             scheme, rest = auth.partition(' ')[::2]
@@ -290,6 +380,7 @@ class AuthController(object):
                         nonce_is_stale = is_nonce_stale(da.nonce, self.max_age_seconds)
                         if not nonce_is_stale:
                             data.username = da.username
+                            self.start_session(data, da.username, pw)
                             return
                 log_msg = 'Failed login attempt from: %s' % data.remote_addr
                 self.ban_list.failed(ban_key)
@@ -302,6 +393,7 @@ class AuthController(object):
                     raise HTTPSimpleResponse(http_client.BAD_REQUEST, 'The username or password was empty')
                 if self.check(un, pw):
                     data.username = un
+                    self.start_session(data, un, pw)
                     return
                 log_msg = 'Failed login attempt from: %s' % data.remote_addr
                 self.ban_list.failed(ban_key)
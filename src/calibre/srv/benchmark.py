@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Load testing for the Content server. Creates a synthetic library, runs a
+server on it in a separate process and drives concurrent workloads against it,
+reporting requests per second and latency percentiles for each workload.
+
+Run it with either of::
+
+    python setup.py benchmark_server --books 5000
+    calibre-debug -c "from calibre.srv.benchmark import main; main()" -- --books 5000
+
+Use --http-only to benchmark just the HTTP layer, with keep-alive thumbnail
+requests against an in-process server that does no library work, comparing the
+one-pass and incremental HTTP header parsers.
+
+The grid-http1 and grid-http2 workloads measure the time taken to load the
+thumbnails for a page of the book grid, the way a browser does, over six
+HTTP/1.1 connections or over a single HTTP/2 connection. For them, the
+reported requests and latencies are for complete pages.
+'''
+
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from io import BytesIO
+from threading import Lock, Thread
+
+from calibre.ptempfile import TemporaryDirectory
+from calibre.utils.monotonic import monotonic
+from polyglot import http_client
+from polyglot.binary import as_hex_unicode
+from polyglot.builtins import iteritems
+from polyglot.urllib import urlencode
+
+WORDS = (
+    'ancient', 'autumn', 'bright', 'broken', 'city', 'cold', 'crimson', 'dark',
+    'dawn', 'dream', 'empire', 'falling', 'fire', 'forest', 'garden', 'ghost',
+    'glass', 'golden', 'hidden', 'house', 'iron', 'island', 'king', 'last',
+    'light', 'lost', 'moon', 'night', 'ocean', 'queen', 'river', 'road',
+    'secret', 'shadow', 'silent', 'silver', 'sky', 'song', 'stone', 'storm',
+    'summer', 'sword', 'time', 'tower', 'war', 'water', 'white', 'wind',
+    'winter', 'wolf',
+)
+FIRST_NAMES = ('Anna', 'Boris', 'Chen', 'Dana', 'Emil', 'Fatima', 'Gita', 'Hugo', 'Ines', 'Jonas', 'Kemal', 'Lena')
+LAST_NAMES = ('Abbott', 'Brandt', 'Costa', 'Dubois', 'Eriksen', 'Fischer', 'Garcia', 'Haddad', 'Ivanova', 'Jensen', 'Kowalski', 'Lindqvist')
+WORKLOADS = ('books', 'books-init', 'opds', 'cover', 'thumb', 'search', 'download', 'grid-http1', 'grid-http2')
+GRID_WORKLOADS = ('grid-http1', 'grid-http2')
+# The number of books on a page of the book grid
+GRID_PAGE_SIZE = 50
+# The maximum number of connections browsers make to a server for HTTP/1.1
+BROWSER_CONNECTIONS = 6
+
+
+# Synthetic library {{{
+
+def random_title(rng):
+    return ' '.join(rng.choice(WORDS) for i in range(rng.randint(1, 5))).capitalize()
+
+
+def random_author(rng):
+    return '%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def create_library(library_path, num_books, formats=('EPUB',), format_size=256, seed=0, report=None):
+    ''' Create a library with num_books synthetic books, each having a cover
+    and the specified formats, each format_size KB in size. '''
+    from calibre.db.cache import Cache
+    from calibre.db.legacy import create_backend
+    from calibre.ebooks.metadata.book.base import Metadata
+    rng = random.Random(seed)
+    db = Cache(create_backend(library_path))
+    db.init()
+    cover = I('lt.png', data=True)
+    payload = os.urandom(max(1, format_size) * 1024)
+    batch = []
+
+    def add_batch():
+        db.add_books(batch, apply_import_tags=False, run_hooks=False)
+        del batch[:]
+        if report is not None:
+            report('Created %d of %d books' % (len(db.all_book_ids()), num_books))
+
+    for i in range(num_books):
+        mi = Metadata(random_title(rng), [random_author(rng) for a in range(rng.randint(1, 3))])
+        mi.tags = rng.sample(WORDS, rng.randint(0, 6))
+        if rng.random() < 0.5:
+            mi.series, mi.series_index = random_title(rng), rng.randint(1, 20)
+        mi.rating = rng.randint(0, 10)
+        mi.comments = '<p>%s</p>' % ' '.join(rng.choice(WORDS) for w in range(rng.randint(20, 200)))
+        mi.languages = [rng.choice(('eng', 'fra', 'deu', 'spa'))]
+        mi.cover_data = ('png', cover)
+        batch.append((mi, {fmt: BytesIO(payload) for fmt in formats}))
+        if len(batch) >= 100:
+            add_batch()
+    if batch:
+        add_batch()
+    db.close()
+# }}}
+
+
+# Server {{{
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def start_server(library_path, port, log_path, server_args=()):
+    from calibre.utils.ipc.simple_worker import start_pipe_worker
+    args = ['calibre-server', '--port', str(port), '--listen-on', '127.0.0.1', '--disable-use-bonjour', '--enable-use-h2c',
+            '--log', log_path] + list(server_args) + [library_path]
+    devnull = open(os.devnull, 'wb')
+    try:
+        return start_pipe_worker(
+            'from calibre.srv.standalone import main; main(%r)' % args, env={'CALIBRE_NO_SI_DANGER_DANGER': '1'},
+            stdin=devnull, stdout=devnull, stderr=subprocess.STDOUT)
+    finally:
+        devnull.close()
+
+
+def wait_for_server(host, port, timeout=120):
+    end = monotonic() + timeout
+    while monotonic() < end:
+        conn = http_client.HTTPConnection(host, port, timeout=5)
+        try:
+            conn.request('GET', '/ajax/library-info')
+            r = conn.getresponse()
+            r.read()
+            if r.status == http_client.OK:
+                return
+        except (socket.error, http_client.HTTPException):
+            time.sleep(0.1)
+        finally:
+            conn.close()
+    raise SystemExit('Timed out waiting for the server to start')
+
+
+def get_json(host, port, path):
+    conn = http_client.HTTPConnection(host, port, timeout=120)
+    try:
+        conn.request('GET', path)
+        r = conn.getresponse()
+        data = r.read()
+        if r.status != http_client.OK:
+            raise SystemExit('Request for %s failed with status: %d' % (path, r.status))
+        return json.loads(data)
+    finally:
+        conn.close()
+# }}}
+
+
+# Workloads {{{
+
+class WorkloadURLs(object):
+
+    def __init__(self, library_id, book_ids, formats=('EPUB',), opds_page_size=30, seed=0):
+        self.library_id, self.book_ids, self.formats = library_id, book_ids, formats
+        self.opds_page_size = opds_page_size
+        self.rng = random.Random(seed)
+        self.lock = Lock()
+
+    def book_id(self):
+        return self.rng.choice(self.book_ids)
+
+    def __call__(self, workload):
+        with self.lock:
+            return getattr(self, workload.replace('-', '_'))()
+
+    def books(self):
+        ids = self.rng.sample(self.book_ids, min(50, len(self.book_ids)))
+        return '/ajax/books/%s?%s' % (self.library_id, urlencode({'ids': ','.join(map(str, ids))}))
+
+    def books_init(self):
+        return '/interface-data/books-init?' + urlencode({
+            'library_id': self.library_id, 'num': 50, 'sort': self.rng.choice(('timestamp.desc', 'title.asc', 'authors.asc'))})
+
+    def opds(self):
+        pages = max(1, len(self.book_ids) // self.opds_page_size)
+        return '/opds/navcatalog/%s?%s' % (as_hex_unicode('Otimestamp'), urlencode({
+            'library_id': self.library_id, 'offset': self.rng.randrange(pages) * self.opds_page_size}))
+
+    def cover(self):
+        return '/get/cover/%d/%s' % (self.book_id(), self.library_id)
+
+    def thumb(self):
+        return '/get/thumb/%d/%s?sz=300x400' % (self.book_id(), self.library_id)
+
+    def search(self):
+        query = ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 2)))
+        return '/ajax/search/%s?%s' % (self.library_id, urlencode({'query': query, 'num': 50}))
+
+    def download(self):
+        return '/get/%s/%d/%s' % (self.rng.choice(self.formats), self.book_id(), self.library_id)
+
+    def grid(self):
+        ids = self.rng.sample(self.book_ids, min(GRID_PAGE_SIZE, len(self.book_ids)))
+        return ['/get/thumb/%d/%s?sz=300x400' % (book_id, self.library_id) for book_id in ids]
+
+
+class Client(Thread):
+
+    daemon = True
+
+    def __init__(self, host, port, workload, urls, end_time, headers=None):
+        Thread.__init__(self, name='BenchmarkClient')
+        self.host, self.port, self.workload, self.urls, self.end_time = host, port, workload, urls, end_time
+        self.headers = headers or {}
+        self.latencies, self.errors, self.bytes_received = [], 0, 0
+
+    def run(self):
+        conn = None
+        while monotonic() < self.end_time:
+            url = self.urls(self.workload)
+            if conn is None:
+                conn = http_client.HTTPConnection(self.host, self.port, timeout=120)
+            st = monotonic()
+            try:
+                conn.request('GET', url, headers=self.headers)
+                r = conn.getresponse()
+                self.bytes_received += len(r.read())
+                if r.status != http_client.OK:
+                    self.errors += 1
+            except (socket.error, http_client.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = None
+            self.latencies.append(monotonic() - st)
+        if conn is not None:
+            conn.close()
+
+
+class GridClient(Thread):
+
+    ''' Repeatedly loads the thumbnails for a page of the book grid, all at
+    once, the way a browser does, recording the time taken for each page. '''
+
+    daemon = True
+
+    def __init__(self, host, port, workload, urls, end_time, headers=None):
+        Thread.__init__(self, name='BenchmarkGridClient')
+        self.host, self.port, self.urls, self.end_time = host, port, urls, end_time
+        self.http2 = workload == 'grid-http2'
+        self.headers = headers or {}
+        self.latencies, self.errors, self.bytes_received = [], 0, 0
+        self.lock = Lock()
+
+    def fetch_http1(self, conn, page):
+        while True:
+            with self.lock:
+                if not page:
+                    break
+                url = page.pop()
+            if conn[0] is None:
+                conn[0] = http_client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                conn[0].request('GET', url, headers=self.headers)
+                r = conn[0].getresponse()
+                data = r.read()
+                ok = r.status == http_client.OK
+            except (socket.error, http_client.HTTPException):
+                data, ok = b'', False
+                conn[0].close()
+                conn[0] = None
+            with self.lock:
+                self.bytes_received += len(data)
+                self.errors += int(not ok)
+
+    def run(self):
+        from calibre.srv.http2 import HTTP2Client
+        if self.http2:
+            client = HTTP2Client(self.host, self.port, timeout=120)
+        else:
+            conns = [[None] for i in range(BROWSER_CONNECTIONS)]
+        while monotonic() < self.end_time:
+            page = self.urls('grid')
+            st = monotonic()
+            if self.http2:
+                for status, headers, body in client.get(*page, headers=self.headers):
+                    self.bytes_received += len(body)
+                    self.errors += int(status != http_client.OK)
+            else:
+                workers = [Thread(target=self.fetch_http1, args=(conn, page)) for conn in conns]
+                for w in workers:
+                    w.start()
+                for w in workers:
+                    w.join()
+            self.latencies.append(monotonic() - st)
+        if self.http2:
+            client.close()
+        else:
+            for conn in conns:
+                if conn[0] is not None:
+                    conn[0].close()
+
+
+def percentile(sorted_values, pc):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, max(0, int(round(pc / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+def run_workload(host, port, workload, urls, concurrency, duration, headers=None):
+    st = monotonic()
+    client_class = GridClient if workload in GRID_WORKLOADS else Client
+    clients = [client_class(host, port, workload, urls, st + duration, headers) for i in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = monotonic() - st
+    latencies = sorted(x for c in clients for x in c.latencies)
+    return {
+        'requests': len(latencies), 'errors': sum(c.errors for c in clients),
+        'requests_per_second': len(latencies) / elapsed,
+        'bytes_per_second': sum(c.bytes_received for c in clients) / elapsed,
+        'mean': sum(latencies) / max(1, len(latencies)),
+        'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else 0,
+    }
+
+
+# Headers sent by a typical browser when loading a thumbnail
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:82.0) Gecko/20100101 Firefox/82.0',
+    'Accept': 'image/webp,*/*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Referer': 'http://127.0.0.1/',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache',
+    'DNT': '1',
+}
+
+
+def run_http_workloads(concurrency, duration, report=print):
+    ''' Measure the throughput of the HTTP layer alone, for keep-alive
+    thumbnail requests with browser-like headers, using both the one-pass and
+    the incremental header parsers, and the time taken to load a page of the
+    book grid over HTTP/1.1 and HTTP/2. '''
+    from calibre.srv.http_request import HTTPRequest
+    from calibre.srv.http_response import create_http_handler
+    from calibre.srv.loop import ServerLoop
+    from calibre.srv.opts import Options
+    from calibre.srv.utils import ServerLog
+    thumbnail = os.urandom(8 * 1024)
+
+    def handler(data):
+        data.outheaders['Content-Type'] = 'image/jpeg'
+        return thumbnail
+
+    urls = WorkloadURLs('library', list(range(1, 1001)))
+    results = {}
+    for workload, fast in (('http-fast', True), ('http-incr', False), ('grid-http1', True), ('grid-http2', True)):
+        loop = ServerLoop(
+            create_http_handler(handler), opts=Options(listen_on='127.0.0.1', port=0, userdb=':memory:', use_h2c=True),
+            log=ServerLog(level=ServerLog.WARN))
+        server = Thread(target=loop.serve_forever, name='BenchmarkServer')
+        server.daemon = True
+        HTTPRequest.use_fast_header_parsing = fast
+        server.start()
+        try:
+            while not loop.ready and server.is_alive():
+                time.sleep(0.01)
+            host, port = loop.bound_address[:2]
+            report('Running the %s workload for %g seconds...' % (workload, duration))
+            results[workload] = run_workload(
+                host, port, workload if workload in GRID_WORKLOADS else 'thumb', urls, concurrency, duration, BROWSER_HEADERS)
+        finally:
+            HTTPRequest.use_fast_header_parsing = True
+            loop.stop()
+            server.join(5)
+    return results
+# }}}
+
+
+# Reporting {{{
+
+def format_report(results):
+    lines = ['%-12s %9s %7s %9s %9s %9s %9s %9s' % ('Workload', 'Req/s', 'Errors', 'Mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'Max ms')]
+    for workload, r in iteritems(results):
+        lines.append('%-12s %9.1f %7d %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+            workload, r['requests_per_second'], r['errors'], r['mean'] * 1000,
+            r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000, r['max'] * 1000))
+    return '\n'.join(lines)
+
+
+def find_regressions(results, baseline, max_regression):
+    ''' Return a list of descriptions of workloads whose throughput or p90
+    latency is worse than in baseline by more than max_regression percent. '''
+    ans = []
+    factor = max_regression / 100.0
+    for workload, r in iteritems(results):
+        b = baseline.get(workload)
+        if not b:
+            continue
+        if r['requests_per_second'] < b['requests_per_second'] * (1 - factor):
+            ans.append('%s: throughput dropped from %.1f to %.1f requests/sec' % (
+                workload, b['requests_per_second'], r['requests_per_second']))
+        if b['p90'] > 0 and r['p90'] > b['p90'] * (1 + factor):
+            ans.append('%s: p90 latency increased from %.1f to %.1f ms' % (workload, b['p90'] * 1000, r['p90'] * 1000))
+    return ans
+# }}}
+
+
+def add_benchmark_options(add_option):
+    add_option('--books', type='int', default=1000, help='Number of books in the synthetic library')
+    add_option('--formats', default='EPUB,MOBI', help='Comma separated list of formats each synthetic book has')
+    add_option('--format-size', type='int', default=256, help='Size of each synthetic format file in KB')
+    add_option('--library', default=None, help='Use this existing library instead of creating a synthetic one')
+    add_option('--url', default=None, help='Benchmark an already running server at this URL (for example http://localhost:8080)'
+               ' instead of starting one. Only unauthenticated servers are supported.')
+    add_option('--workloads', default=','.join(WORKLOADS), help='Comma separated list of workloads to run, from: ' + ', '.join(WORKLOADS))
+    add_option('--concurrency', type='int', default=10, help='Number of concurrent clients')
+    add_option('--duration', type='float', default=10, help='Number of seconds to run each workload for')
+    add_option('--server-args', default='', help='Extra command line arguments for the server, for example: "--worker-count 20"')
+    add_option('--json-output', default=None, help='Save the results as JSON to the specified file')
+    add_option('--baseline', default=None, help='JSON results from a previous run to compare against')
+    add_option('--max-regression', type='float', default=10, help='Percentage by which results can be worse than the'
+               ' baseline before the benchmark fails')
+    add_option('--seed', type='int', default=0, help='Seed for the random number generator')
+    add_option('--http-only', default=False, action='store_true', help='Only benchmark the HTTP layer, with keep-alive'
+               ' thumbnail requests against an in-process server that does no library work, comparing the one-pass and incremental'
+               ' HTTP header parsers, and HTTP/1.1 with HTTP/2 for loading pages of the book grid')
+
+
+def option_parser():
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage='%prog [options]\n\n' + __doc__.strip().splitlines()[0])
+    add_benchmark_options(parser.add_option)
+    return parser
+
+
+def run_server_workloads(opts, report=print):
+    import shlex
+    workloads = [x.strip() for x in opts.workloads.split(',') if x.strip()]
+    for w in workloads:
+        if w not in WORKLOADS:
+            raise SystemExit('Unknown workload: %s' % w)
+    formats = [x.strip().upper() for x in opts.formats.split(',') if x.strip()]
+    with TemporaryDirectory('srv-benchmark') as tdir:
+        server = None
+        if opts.url:
+            from polyglot.urllib import urlparse
+            purl = urlparse(opts.url)
+            host, port = purl.hostname, purl.port or 80
+        else:
+            library_path = opts.library
+            if not library_path:
+                library_path = os.path.join(tdir, 'library')
+                os.mkdir(library_path)
+                st = monotonic()
+                create_library(library_path, opts.books, formats, opts.format_size, opts.seed, report=report)
+                report('Synthetic library created in %.1f seconds' % (monotonic() - st))
+            host, port = '127.0.0.1', free_port()
+            server = start_server(library_path, port, os.path.join(tdir, 'server.log'), shlex.split(opts.server_args))
+        try:
+            wait_for_server(host, port)
+            info = get_json(host, port, '/ajax/library-info')
+            library_id = info['default_library']
+            book_ids = get_json(host, port, '/ajax/search/%s?num=%d' % (library_id, 10**9))['book_ids']
+            if not book_ids:
+                raise SystemExit('The library has no books')
+            urls = WorkloadURLs(library_id, book_ids, formats=formats or ('EPUB',), seed=opts.seed)
+            results = {}
+            for workload in workloads:
+                report('Running the %s workload for %g seconds...' % (workload, opts.duration))
+                results[workload] = run_workload(host, port, workload, urls, opts.concurrency, opts.duration)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    return results
+
+
+def run_benchmark(opts, report=print):
+    if opts.http_only:
+        results = run_http_workloads(opts.concurrency, opts.duration, report=report)
+    else:
+        results = run_server_workloads(opts, report=report)
+    report(format_report(results))
+    if opts.json_output:
+        with lopen(opts.json_output, 'wb') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True).encode('utf-8'))
+    if opts.baseline:
+        with lopen(opts.baseline, 'rb') as f:
+            baseline = json.loads(f.read())
+        regressions = find_regressions(results, baseline, opts.max_regression)
+        if regressions:
+            report('Performance regressions compared to baseline:')
+            for r in regressions:
+                report('\t' + r)
+            return 1
+    return 0
+
+
+def main(args=sys.argv):
+    opts, args = option_parser().parse_args(args)
+    raise SystemExit(run_benchmark(opts))
+
+
+if __name__ == '__main__':
+    main()
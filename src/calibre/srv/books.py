@@ -4,10 +4,12 @@
 
 
 import errno
+import heapq
 import json as jsonlib
 import os
 import tempfile
 import time
+from collections import Counter, defaultdict
 from functools import partial
 from hashlib import sha1
 from threading import Lock, RLock
@@ -20,6 +22,7 @@ from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.filenames import rmtree
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import json_dumps
 from polyglot.builtins import as_unicode, itervalues, map
 
@@ -70,7 +73,32 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, name))
+            except EnvironmentError:
+                pass
+    return ans
+
+
+RENDER_PRIORITY_INTERACTIVE, RENDER_PRIORITY_BACKGROUND = 0, 10
+PRERENDER_FORMATS = ('EPUB', 'AZW3', 'MOBI')
+MAX_QUEUED_PRERENDERS = 2
+PRERENDER_CHECK_INTERVAL = 5 * 60
+render_stats = {
+    'renders': 0, 'failed_renders': 0, 'background_renders': 0,
+    'render_time': 0.0, 'max_render_time': 0.0, 'wait_time': 0.0,
+    'cache_hits': 0, 'cache_misses': 0, 'evictions': 0,
+}
+read_counts = defaultdict(Counter)
+last_prerender_check = {}
+background_jobs = set()
+
+
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, priority=RENDER_PRIORITY_INTERACTIVE):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
@@ -81,52 +109,148 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
+    max_cache_size = int(max(0, getattr(ctx.opts, 'render_cache_size', 0)) * 1024 * 1024)
     job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.render_book', 'render', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, monotonic(), max_cache_size), priority=priority)
     queued_jobs[bhash] = job_id
+    if priority == RENDER_PRIORITY_BACKGROUND:
+        background_jobs.add(bhash)
     return job_id
 
 
-last_final_clean_time = 0
+_final_cache_sizes = None
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x,  'calibre-book-manifest.json'))
-        except EnvironmentError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+def final_cache_sizes():
+    # Map of book hash to size on disk of the rendered book. Must be called
+    # with cache_lock held.
+    global _final_cache_sizes
+    if _final_cache_sizes is None:
+        fdir = os.path.join(books_cache_dir(), 'f')
+        _final_cache_sizes = {x: dir_size(os.path.join(fdir, x)) for x in os.listdir(fdir)}
+    return _final_cache_sizes
+
+
+def last_access_time(bhash):
+    # The manifest is touched every time the book is opened, so its mtime is
+    # the time of last access
+    try:
+        return os.path.getmtime(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+    except EnvironmentError:
+        return 0
+
+
+def clean_final(max_size=0, max_age=24 * 60 * 60):
+    ''' Remove rendered books that have not been accessed for max_age seconds
+    and then remove the least recently used books until the total size of the
+    cache is no more than max_size bytes. A max_size of zero means no limit. '''
+    with cache_lock:
+        sizes = final_cache_sizes()
+        fdir = os.path.join(books_cache_dir(), 'f')
+        now = time.time()
+        atimes = {bhash: last_access_time(bhash) for bhash in sizes}
+        total = sum(itervalues(sizes))
+        for bhash in sorted(sizes, key=atimes.__getitem__):
+            if now - atimes[bhash] < max_age and (max_size < 1 or total <= max_size):
+                break
+            safe_remove(os.path.join(fdir, bhash), False)
+            total -= sizes.pop(bhash)
+            render_stats['evictions'] += 1
 
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, queued_at, max_cache_size = job.data
         queued_jobs.pop(bhash, None)
+        was_background = bhash in background_jobs
+        background_jobs.discard(bhash)
         safe_remove(pathtoebook)
+        render_time = job.end_time - job.start_time
+        render_stats['wait_time'] += max(0, job.start_time - queued_at)
         if job.failed:
+            render_stats['failed_renders'] += 1
             failed_jobs[bhash] = (job.was_aborted, job.traceback)
             safe_remove(tdir, False)
         else:
+            render_stats['renders'] += 1
+            render_stats['background_renders'] += int(was_background)
+            render_stats['render_time'] += render_time
+            render_stats['max_render_time'] = max(render_stats['max_render_time'], render_time)
             try:
-                clean_final()
+                sizes = final_cache_sizes()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
+                sizes.pop(bhash, None)
                 os.rename(tdir, dest)
+                sizes[bhash] = dir_size(dest)
+                clean_final(max_cache_size)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
+def get_render_stats(ctx=None):
+    ''' Statistics about rendering of books for the in-browser viewer. Times are in seconds. '''
+    with cache_lock:
+        ans = render_stats.copy()
+        sizes = final_cache_sizes()
+        ans['cached_books'], ans['cache_size'] = len(sizes), sum(itervalues(sizes))
+        ans['queued_renders'] = len(queued_jobs)
+        ans['queued_background_renders'] = len(background_jobs)
+    jm = getattr(ctx, 'jobs_manager', None)
+    if jm is not None:
+        ans['job_queue_depth'] = jm.queue_depth
+        ans['running_jobs'] = jm.num_running_jobs
+    return ans
+
+
+def format_for_prerender(db, book_id):
+    fmts = db.formats(book_id, verify_formats=False)
+    for fmt in PRERENDER_FORMATS:
+        if fmt in fmts:
+            return fmt
+
+
+def schedule_prerender(ctx, db):
+    ''' Queue background rendering jobs for the most recently added and most
+    read books in the library, so that they are ready by the time a user opens
+    them. Rendering requests from users always take precedence over these
+    jobs. The number of books is controlled by the prerender_books option. '''
+    num = getattr(ctx.opts, 'prerender_books', 0)
+    if num < 1 or ctx.jobs_manager is None:
+        return
+    library_id = db.server_library_id
+    key = db.last_modified(), tuple(x[0] for x in read_counts[library_id].most_common(num))
+    now = monotonic()
+    prev = last_prerender_check.get(library_id)
+    if prev is not None and prev[1] == key and now - prev[0] < PRERENDER_CHECK_INTERVAL:
+        return
+    last_prerender_check[library_id] = now, key
+    candidates = heapq.nlargest(num, db.all_book_ids()) + list(key[1])
+    seen = set()
+    for book_id in candidates:
+        if book_id in seen:
+            continue
+        seen.add(book_id)
+        with cache_lock:
+            if len(background_jobs) >= MAX_QUEUED_PRERENDERS:
+                break
+        with db.safe_read_lock:
+            fmt = format_for_prerender(db, book_id)
+            if fmt is None:
+                continue
+            fm = db.format_metadata(book_id, fmt, allow_cache=False)
+            if not fm:
+                continue
+            size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+            bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+            with cache_lock:
+                if bhash in queued_jobs or bhash in failed_jobs or bhash in final_cache_sizes():
+                    continue
+                queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, priority=RENDER_PRIORITY_BACKGROUND)
+
+
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -149,6 +273,8 @@ def book_manifest(ctx, rd, book_id, fmt):
                 os.utime(mpath, None)
                 with lopen(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
+                render_stats['cache_hits'] += 1
+                read_counts[library_id][book_id] += 1
                 ans['metadata'] = book_as_json(db, book_id)
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
@@ -160,9 +286,19 @@ def book_manifest(ctx, rd, book_id, fmt):
             x = failed_jobs.pop(bhash, None)
             if x is not None:
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
+            # The client polls this endpoint until rendering is done, so only
+            # count the request that actually needs a render
             job_id = queued_jobs.get(bhash)
             if job_id is None:
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                render_stats['cache_misses'] += 1
+                read_counts[library_id][book_id] += 1
+            elif bhash in background_jobs:
+                # A user is waiting for this book, so it jumps the queue
+                ctx.raise_job_priority(job_id, RENDER_PRIORITY_INTERACTIVE)
+                background_jobs.discard(bhash)
+                render_stats['cache_misses'] += 1
+                read_counts[library_id][book_id] += 1
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+import hashlib
+import os
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+
+from calibre.utils.shared_file import share_open
+from calibre.utils.zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+CRC_CACHE_SIZE = 10000
+crc_cache = OrderedDict()
+crc_cache_lock = Lock()
+
+
+def file_crc(path, size, mtime):
+    ' The CRC32 of the specified file, cached by path, size and mtime '
+    key = path, size, mtime
+    with crc_cache_lock:
+        ans = crc_cache.pop(key, None)
+        if ans is not None:
+            crc_cache[key] = ans
+            return ans
+    ans = 0
+    with share_open(path, 'rb') as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            ans = zlib.crc32(chunk, ans)
+    ans &= 0xffffffff
+    with crc_cache_lock:
+        crc_cache[key] = ans
+        if len(crc_cache) > CRC_CACHE_SIZE:
+            crc_cache.popitem(last=False)
+    return ans
+
+
+class CentralDirectory(BytesIO):
+
+    # Used to have ZipFile write the central directory for an archive whose
+    # entries are never actually written to it
+
+    def __init__(self, offset):
+        BytesIO.__init__(self)
+        self.offset = offset
+
+    def tell(self):
+        return self.offset + BytesIO.tell(self)
+
+
+def zip_date_time(mtime):
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+class ZipBundle(object):
+
+    '''
+    A read-only, seekable, file-like object that presents a ZIP archive of the
+    specified files, stored without compression. The archive is never created,
+    only its headers are kept in memory and file data is read from disk as
+    needed, so memory use does not depend on the size of the files. files must
+    be an iterable of (name in archive, path) pairs. '''
+
+    def __init__(self, files):
+        self.starts, self.segments = [], []
+        self.pos = self.size = 0
+        self.current_file = self.current_path = None
+        infos = []
+        for name, path in files:
+            st = os.stat(path)
+            zi = ZipInfo(name, date_time=zip_date_time(st.st_mtime))
+            zi.compress_type = ZIP_STORED
+            zi.file_size = zi.compress_size = st.st_size
+            zi.CRC = file_crc(path, st.st_size, st.st_mtime)
+            zi.external_attr = 0o644 << 16
+            zi.header_offset = self.size
+            self.add_segment(zi.FileHeader())
+            self.add_segment(path, st.st_size)
+            infos.append(zi)
+        cd = CentralDirectory(self.size)
+        zf = ZipFile(cd, 'w')
+        zf.filelist = infos
+        zf.close()
+        self.add_segment(cd.getvalue())
+        # The headers contain the names, sizes, timestamps and checksums of all files
+        self.etag = '"%s"' % hashlib.sha1(b''.join(x for x in self.segments if isinstance(x, bytes))).hexdigest()
+
+    def add_segment(self, data, size=None):
+        if size is None:
+            size = len(data)
+        if size:
+            self.starts.append(self.size)
+            self.segments.append(data)
+            self.size += size
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def read_from_file(self, path, offset, amt):
+        if path != self.current_path:
+            self.close()
+            self.current_file, self.current_path = share_open(path, 'rb'), path
+        self.current_file.seek(offset)
+        ans = self.current_file.read(amt)
+        if len(ans) < amt:
+            raise IOError('The file %s was truncated while being sent' % path)
+        return ans
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        parts = []
+        while size > 0 and self.pos < self.size:
+            idx = bisect_right(self.starts, self.pos) - 1
+            start, segment = self.starts[idx], self.segments[idx]
+            end = self.starts[idx + 1] if idx + 1 < len(self.starts) else self.size
+            offset, amt = self.pos - start, min(size, end - self.pos)
+            if isinstance(segment, bytes):
+                data = segment[offset:offset + amt]
+            else:
+                data = self.read_from_file(segment, offset, amt)
+            parts.append(data)
+            self.pos += amt
+            size -= amt
+        if self.pos >= self.size:
+            self.close()
+        return b''.join(parts)
+
+    def close(self):
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = self.current_path = None
@@ -7,7 +7,9 @@ import hashlib
 import random
 import shutil
 import sys
+import tempfile
 import zipfile
+from itertools import chain
 from json import load as load_json_file, loads as json_loads
 from threading import Lock
 
@@ -16,21 +18,27 @@ from calibre.constants import in_develop_mode
 from calibre.customize.ui import available_input_formats
 from calibre.db.view import sanitize_sort_field_name
 from calibre.srv.ajax import search_result
+from calibre.srv.books import schedule_prerender
+from calibre.srv.content import cover
 from calibre.srv.errors import (
     BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound
 )
 from calibre.srv.metadata import (
-    book_as_json, categories_as_json, categories_settings, icon_map
+    book_as_json, books_as_json, categories_as_json, categories_settings, icon_map,
+    serialized_book_as_json
 )
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
+from calibre.utils.date import isoformat, utcnow
 from calibre.utils.icu import numeric_sort_key, sort_key
+from calibre.utils.iso8601 import parse_iso8601
 from calibre.utils.localization import (
     get_lang, lang_map_for_ui, localize_website_link
 )
 from calibre.utils.search_query_parser import ParseException
 from calibre.utils.serialize import json_dumps
+from polyglot.binary import as_base64_bytes
 from polyglot.builtins import iteritems, itervalues
 
 POSTABLE = frozenset({'GET', 'POST', 'HEAD'})
@@ -207,19 +215,14 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['field_metadata'] = db.field_metadata.all_metadata()
         ans['virtual_libraries'] = db._pref('virtual_libraries', {})
         ans['book_display_fields'] = get_field_list(db)
-        mdata = ans['metadata'] = {}
         try:
             extra_books = set(
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             )
         except Exception:
             extra_books = ()
-        for coll in (ans['search_result']['book_ids'], extra_books):
-            for book_id in coll:
-                if book_id not in mdata:
-                    data = book_as_json(db, book_id)
-                    if data is not None:
-                        mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, chain(ans['search_result']['book_ids'], extra_books))
+    schedule_prerender(ctx, db)
     return ans
 
 
@@ -300,11 +303,7 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, ans['search_result']['book_ids'])
 
     return ans
 
@@ -342,7 +341,6 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -352,10 +350,7 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest('Invalid search expression: %s' % as_unicode(err))
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, ans['search_result']['book_ids'])
     return ans
 
 
@@ -380,6 +375,94 @@ def book_metadata(ctx, rd, book_id):
     return data
 
 
+def bulk_metadata_book_ids(rd, db, allowed_book_ids):
+    ids = rd.query.get('ids')
+    if ids is not None:
+        try:
+            ids = {int(x) for x in ids.split(',') if x.strip()}
+        except Exception:
+            raise HTTPBadRequest('Invalid book ids: %r' % ids)
+    elif rd.method == 'POST':
+        try:
+            ids = set(map(int, load_json_file(rd.request_body_file)['ids']))
+        except Exception as err:
+            raise HTTPBadRequest('Invalid book ids: %s' % as_unicode(err))
+    if ids is not None:
+        return sorted(ids & allowed_book_ids)
+    since = rd.query.get('since')
+    if not since:
+        return sorted(allowed_book_ids)
+    try:
+        since = parse_iso8601(since, assume_utc=True)
+    except Exception:
+        raise HTTPBadRequest('Invalid timestamp: %r' % since)
+    last_modified = db.all_field_for('last_modified', allowed_book_ids)
+    return sorted(book_id for book_id, lm in iteritems(last_modified) if lm is not None and lm > since)
+
+
+def bulk_metadata_thumbnail(ctx, rd, db, book_id, width, height):
+    if db.cover_last_modified(book_id) is None:
+        return
+    with cover(ctx, rd, db.server_library_id, db, book_id, width=width, height=height).output as f:
+        return as_base64_bytes(f.read())
+
+
+@endpoint('/interface-data/bulk-metadata', methods=POSTABLE, cache_control='no-cache')
+def bulk_metadata(ctx, rd):
+    '''
+    Get metadata for many books at once, as newline delimited JSON, for
+    clients that keep an offline copy of the library. The first line is of the
+    form: {"library_id": ..., "book_ids": [...], "timestamp": ...} where
+    book_ids are all the books in the library the user can access, so that
+    clients can remove deleted books, and timestamp should be used as since in
+    the next request, to get only the books that have changed. Each following
+    line is of the form: {"id": book_id, "metadata": ..., "thumbnail": ...}.
+
+    The books to return are specified as a comma separated list of ids or as
+    JSON of the form {"ids": [...]} in the request body. Otherwise, all books
+    modified after since, an ISO 8601 timestamp, are returned, or all books if
+    since is not specified. If thumbnail is specified, as WIDTHxHEIGHT,
+    thumbnails of the covers of books that have covers are included as base64
+    encoded JPEG images.
+
+    Optional: ?library_id=<default library>&ids=&since=&thumbnail=
+    '''
+    db, library_id = get_library_data(ctx, rd)[:2]
+    thumbnail = rd.query.get('thumbnail')
+    if thumbnail:
+        try:
+            width, height = map(int, thumbnail.partition('x')[::2])
+        except Exception:
+            raise HTTPBadRequest('Invalid thumbnail size: %r' % thumbnail)
+    # Taken before reading any metadata so that books changed while this
+    # request is being processed are returned by the next incremental request
+    timestamp = isoformat(utcnow())
+    allowed_book_ids = ctx.allowed_book_ids(rd, db)
+    book_ids = bulk_metadata_book_ids(rd, db, allowed_book_ids)
+    etag = json_dumps([db.last_modified().isoformat(), rd.username, library_id, thumbnail, book_ids])
+    etag = hashlib.sha1(etag).hexdigest()
+
+    def generate():
+        # The output can be very large, so it is written to a temporary file
+        # rather than kept in memory
+        ans = tempfile.TemporaryFile(dir=rd.tdir)
+        ans.write(json_dumps({'library_id': library_id, 'book_ids': sorted(allowed_book_ids), 'timestamp': timestamp}) + b'\n')
+        for book_id in book_ids:
+            data = serialized_book_as_json(db, book_id)
+            if data is None:
+                continue
+            ans.write(b'{"id": %d, "metadata": ' % book_id + data)
+            if thumbnail:
+                tdata = bulk_metadata_thumbnail(ctx, rd, db, book_id, width, height)
+                if tdata is not None:
+                    ans.write(b', "thumbnail": "' + tdata + b'"')
+            ans.write(b'}\n')
+        ans.seek(0)
+        return ans
+
+    return rd.etagged_dynamic_response(etag, generate, 'application/x-ndjson; charset=UTF-8')
+
+
 @endpoint('/interface-data/tag-browser')
 def tag_browser(ctx, rd):
     '''
@@ -19,12 +19,14 @@ from calibre.ebooks.metadata import authors_to_string
 from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
-from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.bundle import ZipBundle
+from calibre.srv.errors import HTTPBadRequest, HTTPNotFound, BookNotFound
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import http_date, get_db, get_use_roman
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.img import scale_image, image_from_data
+from calibre.utils.search_query_parser import ParseException
 from calibre.utils.filenames import ascii_filename, atomic_rename
 from calibre.utils.shared_file import share_open
 from polyglot.urllib import quote
@@ -342,3 +344,66 @@ def get(ctx, rd, what, book_id, library_id):
                 return book_fmt(ctx, rd, library_id, db, book_id, what.lower())
             except NoSuchFormat:
                 raise HTTPNotFound('No %s format for the book %r' % (what.lower(), book_id))
+
+
+@endpoint('/get/bundle', android_workaround=True)
+def bundle(ctx, rd):
+    '''
+    Download a format of several books as a single, uncompressed ZIP file. The
+    books are specified either as ?ids=1,2,3 or as ?search=<query>&vl=<virtual library>.
+    For every book, the first of the formats in ?fmt=EPUB,AZW3 that the book
+    has is used, by default the preferred output format or else any format.
+    Books without a matching format are skipped. The ZIP file is generated as
+    it is sent, directly from the files in the library, so metadata in the
+    files is not updated.
+
+    Optional: ?library_id=<default library>
+    '''
+    from calibre.utils.config import prefs
+    db = get_db(ctx, rd, rd.query.get('library_id'))
+    fmts = [x.strip().upper() for x in rd.query.get('fmt', '').split(',') if x.strip()]
+    with db.safe_read_lock:
+        allowed_book_ids = ctx.allowed_book_ids(rd, db)
+        if 'ids' in rd.query:
+            try:
+                book_ids = [int(x) for x in rd.query.get('ids').split(',') if x.strip()]
+            except Exception:
+                raise HTTPBadRequest('ids must be a comma separated list of integers')
+            book_ids = [x for x in book_ids if x in allowed_book_ids]
+        else:
+            try:
+                book_ids = sorted(ctx.search(rd, db, rd.query.get('search', ''), vl=rd.query.get('vl', '')))
+            except ParseException as err:
+                raise HTTPBadRequest('Invalid search expression: %s' % err.msg)
+        preferred = fmts or [prefs['output_format'].upper()]
+        files, seen, names = [], set(), set()
+        for book_id in book_ids:
+            if book_id in seen:
+                continue
+            seen.add(book_id)
+            available = db.formats(book_id)
+            fmt = next((x for x in preferred if x in available), None)
+            if fmt is None and not fmts and available:
+                fmt = available[0]
+            path = None if fmt is None else db.format_abspath(book_id, fmt)
+            if path:
+                name = book_filename(rd, book_id, db.get_proxy_metadata(book_id), fmt)
+                # Names are compared case insensitively, as the archive can
+                # be extracted on a case insensitive filesystem
+                base, ext = os.path.splitext(name)
+                while name.lower() in names:
+                    base += '_%d' % book_id
+                    name = base + ext
+                names.add(name.lower())
+                files.append((name, path))
+    if not files:
+        raise HTTPNotFound('No books found')
+    try:
+        ans = ZipBundle(files)
+    except EnvironmentError as err:
+        if err.errno == errno.ENOENT:
+            raise HTTPNotFound('A book file is missing from the library')
+        raise
+    rd.outheaders['Content-Type'] = 'application/zip'
+    rd.outheaders['Content-Disposition'] = 'attachment; filename="calibre-books.zip"'
+    return ans
@@ -6,6 +6,7 @@
 import os
 import shutil
 import tempfile
+from itertools import count
 from threading import Lock
 
 from calibre.customize.ui import input_profiles, output_profiles
@@ -20,23 +21,27 @@ from polyglot.builtins import iteritems
 
 receive_data_methods = {'GET', 'POST'}
 conversion_jobs = {}
+running_conversions = {}
+conversion_stats = {'conversions': 0, 'deduplicated': 0}
 cache_lock = Lock()
+request_ids = count()
+_conversion_cache = None
 
 
-class JobStatus(object):
+class Conversion(object):
 
-    def __init__(self, job_id, book_id, tdir, library_id, pathtoebook, conversion_data):
-        self.job_id = job_id
+    ''' A conversion, shared by all requests for identical conversions made
+    while it is running. '''
+
+    def __init__(self, key, tdir, pathtoebook, output_fmt, running=True):
+        self.job_id, self.key = None, key
         self.log = self.traceback = ''
-        self.book_id = book_id
-        self.output_path = os.path.join(
-            tdir, 'output.' + conversion_data['output_fmt'].lower())
-        self.tdir = tdir
-        self.library_id, self.pathtoebook = library_id, pathtoebook
-        self.conversion_data = conversion_data
-        self.running = self.ok = True
-        self.last_check_at = monotonic()
+        self.output_path = os.path.join(tdir, 'output.' + output_fmt.lower())
+        self.tdir, self.pathtoebook = tdir, pathtoebook
+        self.running = self.needs_caching = running
+        self.ok = True
         self.was_aborted = False
+        self.num_requests = 0
 
     def cleanup(self):
         safe_delete_tree(self.tdir)
@@ -58,13 +63,67 @@ class JobStatus(object):
         return 0, ''
 
 
-def expire_old_jobs():
+class JobStatus(object):
+
+    def __init__(self, job_id, book_id, library_id, conversion, conversion_data):
+        self.job_id = job_id
+        self.book_id = book_id
+        self.library_id = library_id
+        self.conversion = conversion
+        self.conversion_data = conversion_data
+        self.last_check_at = monotonic()
+        conversion.num_requests += 1
+
+    def cleanup(self):
+        # Must be called with cache_lock held. Returns the id of the worker job
+        # to abort, if no other request is waiting for it.
+        c = self.conversion
+        c.num_requests -= 1
+        if c.num_requests > 0:
+            return
+        if running_conversions.get(c.key) is c:
+            del running_conversions[c.key]
+        if c.running:
+            # The conversion is cleaned up in job_done()
+            return c.job_id
+        c.cleanup()
+
+
+def conversion_cache(ctx):
+    global _conversion_cache
+    max_size = int(max(0, getattr(ctx.opts, 'conversion_cache_size', 0)) * 1024 * 1024)
+    if not max_size:
+        return
+    if _conversion_cache is None:
+        from calibre.ebooks.conversion.cache import ConversionCache
+        _conversion_cache = ConversionCache(max_size=max_size)
+    return _conversion_cache
+
+
+def get_conversion_stats(ctx=None):
+    ''' Statistics about conversions requested via the server '''
+    with cache_lock:
+        ans = conversion_stats.copy()
+        ans['running_conversions'] = len(running_conversions)
+    ans['cache_hits'] = ans['cache_misses'] = ans['cache_size'] = 0
+    cache = None if ctx is None else conversion_cache(ctx)
+    if cache is not None:
+        stats = cache.stats
+        ans['cache_hits'], ans['cache_misses'], ans['cache_size'] = stats['hits'], stats['misses'], stats['cache_size']
+    return ans
+
+
+def expire_old_jobs(ctx):
     now = monotonic()
     with cache_lock:
         remove = [job_id for job_id, job_status in iteritems(conversion_jobs) if now - job_status.last_check_at >= 360]
+        abort = []
         for job_id in remove:
             job_status = conversion_jobs.pop(job_id)
-            job_status.cleanup()
+            abort.append(job_status.cleanup())
+    for job_id in abort:
+        if job_id is not None:
+            ctx.abort_job(job_id)
 
 
 def safe_delete_file(path):
@@ -82,18 +141,20 @@ def safe_delete_tree(path):
 
 
 def job_done(job):
+    conversion = job.data
     with cache_lock:
-        try:
-            job_status = conversion_jobs[job.job_id]
-        except KeyError:
-            return
-        job_status.running = False
+        conversion.running = False
+        if running_conversions.get(conversion.key) is conversion:
+            del running_conversions[conversion.key]
         if job.failed:
-            job_status.ok = False
-            job_status.log = job.read_log()
-            job_status.was_aborted = job.was_aborted
-            job_status.traceback = job.traceback
-    safe_delete_file(job_status.pathtoebook)
+            conversion.ok = conversion.needs_caching = False
+            conversion.log = job.read_log()
+            conversion.was_aborted = job.was_aborted
+            conversion.traceback = job.traceback
+        if conversion.num_requests < 1:
+            # Nobody is waiting for the result any longer
+            conversion.cleanup()
+    safe_delete_file(conversion.pathtoebook)
 
 
 def convert_book(path_to_ebook, opf_path, cover_path, output_fmt, recs):
@@ -120,8 +181,16 @@ def convert_book(path_to_ebook, opf_path, cover_path, output_fmt, recs):
     plumber.run()
 
 
+def add_request(book_id, library_id, conversion, conversion_data):
+    # Must be called with cache_lock held
+    job_id = next(request_ids)
+    conversion_jobs[job_id] = JobStatus(job_id, book_id, library_id, conversion, conversion_data)
+    return job_id
+
+
 def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
     from calibre.ebooks.metadata.opf2 import metadata_to_opf
+    from calibre.ebooks.conversion.cache import conversion_key
     from calibre.ebooks.conversion.config import GuiRecommendations, save_specifics
     from calibre.customize.conversion import OptionRecommendation
     tdir = tempfile.mkdtemp(dir=rd.tdir)
@@ -140,17 +209,45 @@ def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
     recs['gui_preferred_input_format'] = conversion_data['input_fmt'].lower()
     save_specifics(db, book_id, recs)
     recs = [(k, v, OptionRecommendation.HIGH) for k, v in iteritems(recs)]
+    output_fmt = conversion_data['output_fmt']
+    # Identical conversions share a single worker job and their results are
+    # cached, so the key must include everything that affects the output
+    key = conversion_key(src_file.name, output_fmt, recs + [
+        ('read_metadata_from_opf', opf_file.name, OptionRecommendation.HIGH),
+        ('cover', cover_path, OptionRecommendation.HIGH)])
+    recs.append(('input_cache_size', max(0, getattr(ctx.opts, 'conversion_input_cache_size', 0)), OptionRecommendation.HIGH))
+    expire_old_jobs(ctx)
 
-    job_id = ctx.start_job(
+    with cache_lock:
+        conversion = running_conversions.get(key)
+        if conversion is not None:
+            conversion_stats['deduplicated'] += 1
+            job_id = add_request(book_id, library_id, conversion, conversion_data)
+    if conversion is not None:
+        safe_delete_tree(tdir)
+        return job_id
+
+    cache = conversion_cache(ctx)
+    if cache is not None:
+        conversion = Conversion(key, tdir, src_file.name, output_fmt, running=False)
+        if cache.get(key, output_fmt, conversion.output_path):
+            safe_delete_file(src_file.name)
+            with cache_lock:
+                return add_request(book_id, library_id, conversion, conversion_data)
+
+    conversion = Conversion(key, tdir, src_file.name, output_fmt)
+    with cache_lock:
+        conversion_stats['conversions'] += 1
+        job_id = add_request(book_id, library_id, conversion, conversion_data)
+        running_conversions[key] = conversion
+    # The conversion is registered before the worker job is started, so that
+    # it is not cleaned up if the job finishes before this function returns
+    conversion.job_id = ctx.start_job(
         'Convert book %s (%s)' % (book_id, fmt), 'calibre.srv.convert',
         'convert_book', args=(
-            src_file.name, opf_file.name, cover_path, conversion_data['output_fmt'], recs),
-        job_done_callback=job_done
+            src_file.name, opf_file.name, cover_path, output_fmt, recs),
+        job_done_callback=job_done, job_data=conversion
     )
-    expire_old_jobs()
-    with cache_lock:
-        conversion_jobs[job_id] = JobStatus(
-            job_id, book_id, tdir, library_id, src_file.name, conversion_data)
     return job_id
 
 
@@ -172,34 +269,50 @@ def conversion_status(ctx, rd, job_id):
         if job_status is None:
             raise HTTPNotFound('No job with id: {}'.format(job_id))
         job_status.last_check_at = monotonic()
-        if job_status.running:
-            percent, msg = job_status.current_status
+        conversion = job_status.conversion
+        if conversion.running:
+            percent, msg = conversion.current_status
             if rd.query.get('abort_job'):
-                ctx.abort_job(job_id)
+                if conversion.num_requests > 1:
+                    # Other requests are waiting for the result of this
+                    # conversion, so only this request is aborted
+                    del conversion_jobs[job_id]
+                    job_status.cleanup()
+                    return {'running': False, 'ok': False, 'was_aborted': True, 'traceback': '', 'log': ''}
+                ctx.abort_job(conversion.job_id)
             return {'running': True, 'percent': percent, 'msg': msg}
 
         del conversion_jobs[job_id]
+        needs_caching, conversion.needs_caching = conversion.needs_caching, False
 
     try:
-        ans = {'running': False, 'ok': job_status.ok, 'was_aborted':
-               job_status.was_aborted, 'traceback': job_status.traceback,
-               'log': job_status.log}
-        if job_status.ok:
+        ans = {'running': False, 'ok': conversion.ok, 'was_aborted':
+               conversion.was_aborted, 'traceback': conversion.traceback,
+               'log': conversion.log}
+        if conversion.ok:
             db, library_id = get_library_data(ctx, rd)[:2]
             if library_id != job_status.library_id:
                 raise HTTPNotFound('job library_id does not match')
-            fmt = job_status.output_path.rpartition('.')[-1]
+            fmt = conversion.output_path.rpartition('.')[-1]
             try:
-                db.add_format(job_status.book_id, fmt, job_status.output_path)
+                db.add_format(job_status.book_id, fmt, conversion.output_path)
             except NoSuchBook:
                 raise HTTPNotFound(
                     'book_id {} not found in library'.format(job_status.book_id))
             formats_added({job_status.book_id: (fmt,)})
-            ans['size'] = os.path.getsize(job_status.output_path)
+            ans['size'] = os.path.getsize(conversion.output_path)
             ans['fmt'] = fmt
+            cache = conversion_cache(ctx) if needs_caching else None
+            if cache is not None:
+                try:
+                    cache.put(conversion.key, fmt, conversion.output_path)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
         return ans
     finally:
-        job_status.cleanup()
+        with cache_lock:
+            job_status.cleanup()
 
 
 def get_conversion_options(input_fmt, output_fmt, book_id, db):
@@ -85,7 +85,7 @@ class Server(object):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, websocket_handler=self.handler.ctx.change_notifier),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -102,6 +102,7 @@ class Server(object):
                         pass
                 return
             self.handler.set_jobs_manager(self.loop.jobs_manager)
+            self.handler.set_metrics(self.loop.metrics)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
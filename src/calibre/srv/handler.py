@@ -23,25 +23,37 @@ class Context(object):
     log = None
     url_for = None
     jobs_manager = None
+    metrics = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    RESTRICTION_CACHE_SIZE = 25
+    OPDS_ENTRY_CACHE_SIZE = 5000
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
-        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(libraries)
+        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(
+            libraries, idle_timeout=opts.library_idle_timeout * 60, memory_budget=opts.max_library_memory * 1024 * 1024)
         self.testing = testing
         self.lock = Lock()
         self.user_manager = UserManager(opts.userdb)
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        # Imported here as calibre.srv.push defines endpoints, which need this
+        # module to be importable
+        from calibre.srv.push import ChangeNotifier
+        self.change_notifier = ChangeNotifier(self)
 
     def notify_changes(self, library_path, change_event):
+        self.change_notifier.notify(library_path, change_event)
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
-        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, priority=0):
+        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data, priority)
+
+    def raise_job_priority(self, job_id, priority):
+        return self.jobs_manager.raise_priority(job_id, priority)
 
     def job_status(self, job_id):
         return self.jobs_manager.job_status(job_id)
@@ -49,27 +61,47 @@ class Context(object):
     def abort_job(self, job_id):
         return self.jobs_manager.abort_job(job_id)
 
+    def cache_lookup(self, cache, hit):
+        if self.metrics is not None:
+            self.metrics.inc('calibre_server_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
     def is_field_displayable(self, field):
         if self.displayed_fields and field not in self.displayed_fields:
             return False
         return field not in self.ignored_fields
 
     def init_session(self, endpoint, data):
-        pass
+        # The libraries used by this request, which must not be unloaded
+        # until it is finished
+        data.libraries_in_use = []
 
     def finalize_session(self, endpoint, data, output):
         pass
 
+    def end_session(self, endpoint, data):
+        for library_id in data.libraries_in_use:
+            self.library_broker.release(library_id)
+        del data.libraries_in_use[:]
+
+    def _get_library(self, request_data, library_id):
+        in_use = getattr(request_data, 'libraries_in_use', None)
+        if in_use is None:
+            return self.library_broker.get(library_id)
+        db = self.library_broker.acquire(library_id)
+        if db is not None:
+            in_use.append(db.server_library_id)
+        return db
+
     def get_library(self, request_data, library_id=None):
         if not request_data.username:
-            return self.library_broker.get(library_id)
+            return self._get_library(request_data, library_id)
         lf = partial(self.user_manager.allowed_library_names, request_data.username)
         allowed_libraries = self.library_broker.allowed_libraries(lf)
         if not allowed_libraries:
             raise HTTPForbidden('The user {} is not allowed to access any libraries on this server'.format(request_data.username))
         library_id = library_id or next(iter(allowed_libraries))
         if library_id in allowed_libraries:
-            return self.library_broker.get(library_id)
+            return self._get_library(request_data, library_id)
         raise HTTPForbidden('The user {} is not allowed to access the library {}'.format(request_data.username, library_id))
 
     def library_info(self, request_data):
@@ -84,18 +116,39 @@ class Context(object):
     def restriction_for(self, request_data, db):
         return self.user_manager.library_restriction(request_data.username, path_for_db(db))
 
+    def books_matching_restriction(self, db, restriction):
+        ''' Return the set of ids of books matching the restriction. The result
+        is cached until the library is next changed. Raises ParseException if
+        the restriction is invalid. '''
+        state = db.clear_search_cache_count, db.last_modified()
+        with self.lock:
+            cache = self.library_broker.restriction_caches[db.server_library_id]
+            old = cache.pop(restriction, None)
+            self.cache_lookup('restriction', old is not None and old[0] == state)
+            if old is None or old[0] != state:
+                try:
+                    old = (state, frozenset(db.search('', restriction=restriction)), None)
+                except ParseException as err:
+                    old = (state, None, err.args)
+                if len(cache) >= self.RESTRICTION_CACHE_SIZE:
+                    cache.popitem(last=False)
+            cache[restriction] = old
+        if old[2] is not None:
+            raise ParseException(*old[2])
+        return old[1]
+
     def has_id(self, request_data, db, book_id):
         restriction = self.restriction_for(request_data, db)
         if restriction:
             try:
-                return book_id in db.search('', restriction=restriction)
+                return book_id in self.books_matching_restriction(db, restriction)
             except ParseException:
                 return False
         return db.has_id(book_id)
 
     def get_allowed_book_ids_from_restriction(self, request_data, db):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
+        return self.books_matching_restriction(db, restriction) if restriction else None
 
     def allowed_book_ids(self, request_data, db):
         try:
@@ -116,7 +169,11 @@ class Context(object):
 
     def get_effective_book_ids(self, db, request_data, vl, report_parse_errors=False):
         try:
-            return db.books_in_virtual_library(vl, self.restriction_for(request_data, db))
+            restriction = self.restriction_for(request_data, db)
+            if restriction:
+                ans = self.books_matching_restriction(db, restriction)
+                return ans & db.books_in_virtual_library(vl) if vl else ans
+            return db.books_in_virtual_library(vl)
         except ParseException:
             if report_parse_errors:
                 raise
@@ -130,6 +187,7 @@ class Context(object):
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
+            self.cache_lookup('categories', old is not None and old[0] > db.last_modified())
             if old is None or old[0] <= db.last_modified():
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
                 cache[key] = old = (utcnow(), categories)
@@ -145,6 +203,7 @@ class Context(object):
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
+            self.cache_lookup('tag_browser', old is not None and old[0] > db.last_modified())
             if old is None or old[0] <= db.last_modified():
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
                 data = json.dumps(render(db, categories), ensure_ascii=False)
@@ -171,6 +230,7 @@ class Context(object):
         with self.lock:
             cache = self.library_broker.search_caches[db.server_library_id]
             old = cache.pop(key, None)
+            self.cache_lookup('search', old is not None and old[0] >= db.clear_search_cache_count)
             if old is None or old[0] < db.clear_search_cache_count:
                 matches = db.search(query, book_ids=restrict_to_ids)
                 cache[key] = old = (db.clear_search_cache_count, matches)
@@ -183,7 +243,7 @@ class Context(object):
             return old[1]
 
 
-SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert')
+SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'metrics', 'push')
 
 
 class Handler(object):
@@ -195,7 +255,8 @@ class Handler(object):
             has_ssl = opts.ssl_certfile is not None and opts.ssl_keyfile is not None
             prefer_basic_auth = {'auto':has_ssl, 'basic':True}.get(opts.auth_mode, False)
             self.auth_controller = AuthController(
-                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after)
+                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after,
+                session_lifetime=opts.session_lifetime * 60)
         self.router = Router(ctx=ctx, url_prefix=opts.url_prefix, auth_controller=self.auth_controller)
         for module in SRV_MODULES:
             module = import_module('calibre.srv.' + module)
@@ -212,7 +273,11 @@ class Handler(object):
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
 
+    def set_metrics(self, metrics):
+        self.router.ctx.metrics = metrics
+
     def close(self):
+        self.router.ctx.change_notifier.stop()
         self.router.ctx.library_broker.close()
 
     @property
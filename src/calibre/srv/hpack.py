@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+HPACK header compression for HTTP/2, see :rfc:`7541`. The encoder never adds
+entries to the dynamic table, which keeps it simple and is allowed by the
+specification, the decoder implements the complete specification.
+'''
+
+from collections import deque
+
+# The static table from Appendix A of the RFC
+STATIC_TABLE = (
+    (b':authority', b''),
+    (b':method', b'GET'),
+    (b':method', b'POST'),
+    (b':path', b'/'),
+    (b':path', b'/index.html'),
+    (b':scheme', b'http'),
+    (b':scheme', b'https'),
+    (b':status', b'200'),
+    (b':status', b'204'),
+    (b':status', b'206'),
+    (b':status', b'304'),
+    (b':status', b'400'),
+    (b':status', b'404'),
+    (b':status', b'500'),
+    (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'accept-language', b''),
+    (b'accept-ranges', b''),
+    (b'accept', b''),
+    (b'access-control-allow-origin', b''),
+    (b'age', b''),
+    (b'allow', b''),
+    (b'authorization', b''),
+    (b'cache-control', b''),
+    (b'content-disposition', b''),
+    (b'content-encoding', b''),
+    (b'content-language', b''),
+    (b'content-length', b''),
+    (b'content-location', b''),
+    (b'content-range', b''),
+    (b'content-type', b''),
+    (b'cookie', b''),
+    (b'date', b''),
+    (b'etag', b''),
+    (b'expect', b''),
+    (b'expires', b''),
+    (b'from', b''),
+    (b'host', b''),
+    (b'if-match', b''),
+    (b'if-modified-since', b''),
+    (b'if-none-match', b''),
+    (b'if-range', b''),
+    (b'if-unmodified-since', b''),
+    (b'last-modified', b''),
+    (b'link', b''),
+    (b'location', b''),
+    (b'max-forwards', b''),
+    (b'proxy-authenticate', b''),
+    (b'proxy-authorization', b''),
+    (b'range', b''),
+    (b'referer', b''),
+    (b'refresh', b''),
+    (b'retry-after', b''),
+    (b'server', b''),
+    (b'set-cookie', b''),
+    (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''),
+    (b'user-agent', b''),
+    (b'vary', b''),
+    (b'via', b''),
+    (b'www-authenticate', b''),
+)
+STATIC_TABLE_MAP = {}
+for i, x in enumerate(STATIC_TABLE):
+    STATIC_TABLE_MAP.setdefault(x, i + 1)
+    STATIC_TABLE_MAP.setdefault(x[0], i + 1)
+del i, x
+
+# The Huffman code from Appendix B of the RFC as (code, length in bits) for
+# every byte and EOS
+HUFFMAN_CODES = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28), (0xfffffe4, 28), (0xfffffe5, 28),
+    (0xfffffe6, 28), (0xfffffe7, 28), (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28), (0xfffffed, 28), (0xfffffee, 28),
+    (0xfffffef, 28), (0xffffff0, 28), (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28), (0xffffff8, 28), (0xffffff9, 28),
+    (0xffffffa, 28), (0xffffffb, 28), (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10),
+    (0xf9, 8), (0x7fb, 11), (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6),
+    (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6), (0x1a, 6), (0x1b, 6),
+    (0x1c, 6), (0x1d, 6), (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8),
+    (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10), (0x1ffa, 13), (0x21, 6),
+    (0x5d, 7), (0x5e, 7), (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7),
+    (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7), (0x67, 7), (0x68, 7),
+    (0x69, 7), (0x6a, 7), (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7),
+    (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7), (0xfc, 8), (0x73, 7),
+    (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6),
+    (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5), (0x24, 6), (0x5, 5),
+    (0x25, 6), (0x26, 6), (0x27, 6), (0x6, 5), (0x74, 7), (0x75, 7),
+    (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6), (0x76, 7),
+    (0x2c, 6), (0x8, 5), (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15), (0x7fc, 11), (0x3ffd, 14),
+    (0x1ffd, 13), (0xffffffc, 28), (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20),
+    (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23),
+    (0x7fffdb, 23), (0x7fffdc, 23), (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23),
+    (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23), (0xffffee, 24), (0x7fffe1, 23),
+    (0x7fffe2, 23), (0x7fffe3, 23), (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23),
+    (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21),
+    (0xfffe9, 20), (0x3fffdb, 22), (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21),
+    (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21), (0x3fffdf, 22),
+    (0x7fffeb, 23), (0x7fffec, 23), (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22),
+    (0x3fffe3, 22), (0x3fffe4, 22), (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23),
+    (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22), (0x7ffff2, 23),
+    (0x3fffe8, 22), (0x1ffffec, 25), (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19), (0x1fffe3, 21),
+    (0x3ffffe6, 26), (0x7ffffe0, 27), (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24),
+    (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26), (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27),
+    (0x7ffffe4, 27), (0x7ffffe5, 27), (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21),
+    (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23), (0x3fffea, 22), (0x3fffeb, 22),
+    (0x1ffffee, 25), (0x1ffffef, 25), (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26), (0x7ffffe7, 27), (0x7ffffe8, 27),
+    (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27),
+    (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26), (0x3fffffff, 30),
+)
+EOS = 256
+HUFFMAN_DECODE_MAP = {(length << 32) | code: sym for sym, (code, length) in enumerate(HUFFMAN_CODES)}
+ENTRY_OVERHEAD = 32
+DEFAULT_TABLE_SIZE = 4096
+
+
+class HPACKError(ValueError):
+    pass
+
+
+def huffman_encode(data):
+    val = nbits = 0
+    for byte in bytearray(data):
+        code, length = HUFFMAN_CODES[byte]
+        val = (val << length) | code
+        nbits += length
+    pad = -nbits % 8
+    if pad:
+        # Pad with the most significant bits of EOS, which are all ones
+        val = (val << pad) | ((1 << pad) - 1)
+        nbits += pad
+    return val.to_bytes(nbits // 8, 'big')
+
+
+def huffman_encoded_length(data):
+    return (sum(HUFFMAN_CODES[byte][1] for byte in bytearray(data)) + 7) // 8
+
+
+def huffman_decode(data):
+    ans = bytearray()
+    code = length = 0
+    dmap = HUFFMAN_DECODE_MAP
+    for byte in bytearray(data):
+        for shift in (7, 6, 5, 4, 3, 2, 1, 0):
+            code = (code << 1) | ((byte >> shift) & 1)
+            length += 1
+            if length > 4:
+                sym = dmap.get((length << 32) | code)
+                if sym is not None:
+                    if sym == EOS:
+                        raise HPACKError('Huffman encoded data contains EOS')
+                    ans.append(sym)
+                    code = length = 0
+                elif length > 30:
+                    raise HPACKError('Invalid Huffman code')
+    if length > 7 or code != (1 << length) - 1:
+        raise HPACKError('Invalid padding in Huffman encoded data')
+    return bytes(ans)
+
+
+def encode_integer(val, prefix_bits, flags=0):
+    limit = (1 << prefix_bits) - 1
+    if val < limit:
+        return bytearray((flags | val,))
+    ans = bytearray((flags | limit,))
+    val -= limit
+    while val >= 128:
+        ans.append((val & 0x7f) | 0x80)
+        val >>= 7
+    ans.append(val)
+    return ans
+
+
+def decode_integer(data, pos, prefix_bits):
+    # Returns the decoded integer and the position after it
+    limit = (1 << prefix_bits) - 1
+    try:
+        val = data[pos] & limit
+        pos += 1
+        if val < limit:
+            return val, pos
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            val += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return val, pos
+            if shift > 28:
+                raise HPACKError('Integer too large')
+    except IndexError:
+        raise HPACKError('Truncated integer')
+
+
+def encode_string(data):
+    hlen = huffman_encoded_length(data)
+    if hlen < len(data):
+        return encode_integer(hlen, 7, 0x80) + huffman_encode(data)
+    return encode_integer(len(data), 7) + data
+
+
+def decode_string(data, pos):
+    if pos >= len(data):
+        raise HPACKError('Truncated string')
+    huffman = data[pos] & 0x80
+    length, pos = decode_integer(data, pos, 7)
+    end = pos + length
+    if end > len(data):
+        raise HPACKError('Truncated string')
+    ans = bytes(data[pos:end])
+    if huffman:
+        ans = huffman_decode(ans)
+    return ans, end
+
+
+class Encoder(object):
+
+    def encode(self, headers):
+        ''' Encode the list of (name, value) pairs, which must be bytestrings,
+        into a header block. Names must be lower case. '''
+        ans = bytearray()
+        for name, value in headers:
+            idx = STATIC_TABLE_MAP.get((name, value))
+            if idx is not None:
+                # Indexed header field
+                ans += encode_integer(idx, 7, 0x80)
+                continue
+            idx = STATIC_TABLE_MAP.get(name)
+            # Literal header field without indexing
+            if idx is None:
+                ans += encode_integer(0, 4)
+                ans += encode_string(name)
+            else:
+                ans += encode_integer(idx, 4)
+            ans += encode_string(value)
+        return bytes(ans)
+
+
+class Decoder(object):
+
+    def __init__(self, max_table_size=DEFAULT_TABLE_SIZE):
+        # The maximum size we allow the peer to use, as advertised in
+        # SETTINGS_HEADER_TABLE_SIZE
+        self.max_allowed_table_size = max_table_size
+        self.max_table_size = max_table_size
+        self.table = deque()
+        self.table_size = 0
+
+    def shrink(self):
+        while self.table_size > self.max_table_size:
+            name, value = self.table.pop()
+            self.table_size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+    def add(self, name, value):
+        size = len(name) + len(value) + ENTRY_OVERHEAD
+        if size > self.max_table_size:
+            # Adding an entry larger than the table empties it
+            self.table.clear()
+            self.table_size = 0
+            return
+        self.table.appendleft((name, value))
+        self.table_size += size
+        self.shrink()
+
+    def get(self, idx):
+        if idx < 1:
+            raise HPACKError('Invalid header table index: %d' % idx)
+        if idx <= len(STATIC_TABLE):
+            return STATIC_TABLE[idx - 1]
+        try:
+            return self.table[idx - len(STATIC_TABLE) - 1]
+        except IndexError:
+            raise HPACKError('Invalid header table index: %d' % idx)
+
+    def decode(self, data):
+        ''' Decode a complete header block into a list of (name, value)
+        pairs of bytestrings. Raises HPACKError if the block is invalid. '''
+        data = memoryview(data)
+        pos, end = 0, len(data)
+        ans = []
+        while pos < end:
+            byte = data[pos]
+            if byte & 0x80:
+                # Indexed header field
+                idx, pos = decode_integer(data, pos, 7)
+                ans.append(self.get(idx))
+                continue
+            if byte & 0xe0 == 0x20:
+                # Dynamic table size update
+                size, pos = decode_integer(data, pos, 5)
+                if size > self.max_allowed_table_size:
+                    raise HPACKError('Dynamic table size update larger than allowed')
+                self.max_table_size = size
+                self.shrink()
+                continue
+            if byte & 0x40:
+                # Literal header field with incremental indexing
+                idx, pos = decode_integer(data, pos, 6)
+                add_to_table = True
+            else:
+                # Literal header field without indexing or never indexed
+                idx, pos = decode_integer(data, pos, 4)
+                add_to_table = False
+            if idx:
+                name = self.get(idx)[0]
+            else:
+                name, pos = decode_string(data, pos)
+            value, pos = decode_string(data, pos)
+            if add_to_table:
+                self.add(name, value)
+            ans.append((name, value))
+        return ans
+
+
+def find_tests():
+    import unittest
+
+    class TestHPACK(unittest.TestCase):
+
+        ae = unittest.TestCase.assertEqual
+
+        def test_integers(self):
+            # Examples from Appendix C.1 of the RFC
+            self.ae(encode_integer(10, 5), bytearray((10,)))
+            self.ae(encode_integer(1337, 5), bytearray((31, 154, 10)))
+            self.ae(encode_integer(42, 8), bytearray((42,)))
+            self.ae(decode_integer(bytearray((31, 154, 10)), 0, 5), (1337, 3))
+            self.assertRaises(HPACKError, decode_integer, bytearray((31, 154)), 0, 5)
+
+        def test_huffman(self):
+            for raw in (b'', b'www.example.com', b'no-cache', b'custom-key', bytes(bytearray(range(256)))):
+                self.ae(huffman_decode(huffman_encode(raw)), raw)
+            self.ae(huffman_encode(b'www.example.com'), bytes.fromhex('f1e3c2e5f23a6ba0ab90f4ff'))
+            self.assertRaises(HPACKError, huffman_decode, b'\xff\xff\xff\xff')
+            self.assertRaises(HPACKError, huffman_decode, huffman_encode(b'a') + b'\xff')
+
+        def test_decoder(self):
+            # Requests with Huffman coding from Appendix C.4 of the RFC
+            d = Decoder()
+            self.ae(d.decode(bytes.fromhex('828684418cf1e3c2e5f23a6ba0ab90f4ff')), [
+                (b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com')])
+            self.ae(d.table_size, 57)
+            self.ae(d.decode(bytes.fromhex('828684be5886a8eb10649cbf')), [
+                (b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com'),
+                (b'cache-control', b'no-cache')])
+            self.ae(d.decode(bytes.fromhex('828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf')), [
+                (b':method', b'GET'), (b':scheme', b'https'), (b':path', b'/index.html'), (b':authority', b'www.example.com'),
+                (b'custom-key', b'custom-value')])
+            self.ae(d.table_size, 164)
+            self.ae(len(d.table), 3)
+            # Table size updates evict entries
+            d.decode(b'\x3f\x1a')
+            self.ae(d.max_table_size, 57)
+            self.ae(len(d.table), 1)
+            self.assertRaises(HPACKError, d.decode, b'\x3f\xe2\x1f')
+            self.assertRaises(HPACKError, d.decode, b'\xff\x00')
+
+        def test_round_trip(self):
+            headers = [(b':status', b'200'), (b'content-type', b'text/html; charset=UTF-8'), (b'x-custom', b'value'),
+                       (b'content-length', b'1234'), (b':status', b'404')]
+            self.ae(Decoder().decode(Encoder().encode(headers)), headers)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestHPACK)
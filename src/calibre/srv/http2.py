@@ -0,0 +1,801 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+HTTP/2 support for the server, see :rfc:`7540`. Connections are switched to
+HTTP/2 either when the client selects it via ALPN during the SSL handshake, if
+the use_http2 option is set, or when a client with prior knowledge sends the
+HTTP/2 connection preface instead of an HTTP/1 request line on a plain
+connection (h2c), if the use_h2c option is set. Requests on all streams of a connection are
+processed concurrently in the worker thread pool, using the same request
+handler and response generation as HTTP/1. Server push is not supported.
+'''
+
+import socket
+import sys
+from collections import defaultdict, deque
+from functools import partial
+from io import BytesIO, DEFAULT_BUFFER_SIZE
+from struct import pack, unpack_from
+
+from calibre import force_unicode
+from calibre.ptempfile import SpooledTemporaryFile
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.hpack import Decoder, Encoder, HPACKError
+from calibre.srv.http_request import HTTP_METHODS, add_header_field, parse_uri
+from calibre.srv.http_response import (
+    GeneratedOutput, Range, RequestData, request_lane
+)
+from calibre.srv.loop import RDWR, READ, WRITE
+from calibre.srv.utils import DESIRED_SEND_BUFFER_SIZE, HTTP11, MultiDict, http_date
+from calibre.srv.web_socket import WebSocketConnection
+from calibre.utils.monotonic import monotonic
+from polyglot import http_client
+from polyglot.builtins import error_message, iteritems, itervalues, reraise, unicode_type
+from polyglot.queue import Full
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+# Frame types
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE, CONTINUATION = range(10)
+FRAME_NAMES = ('data', 'headers', 'priority', 'rst_stream', 'settings', 'push_promise', 'ping', 'goaway', 'window_update', 'continuation')
+
+# Frame flags
+END_STREAM = ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+# Settings
+(SETTINGS_HEADER_TABLE_SIZE, SETTINGS_ENABLE_PUSH, SETTINGS_MAX_CONCURRENT_STREAMS,
+ SETTINGS_INITIAL_WINDOW_SIZE, SETTINGS_MAX_FRAME_SIZE, SETTINGS_MAX_HEADER_LIST_SIZE) = range(1, 7)
+
+# Error codes
+(NO_ERROR, PROTOCOL_ERROR, INTERNAL_ERROR, FLOW_CONTROL_ERROR, SETTINGS_TIMEOUT, STREAM_CLOSED,
+ FRAME_SIZE_ERROR, REFUSED_STREAM, CANCEL, COMPRESSION_ERROR, CONNECT_ERROR, ENHANCE_YOUR_CALM) = range(12)
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2**31 - 1
+DEFAULT_MAX_FRAME_SIZE = 16384
+MAX_CONCURRENT_STREAMS = 100
+MAX_HEADER_BLOCK_SIZE = 256 * 1024
+# DATA frames are generated only while less than this much data is waiting
+# to be sent, so that the streams that are sending share the connection fairly
+SEND_QUEUE_SIZE = DESIRED_SEND_BUFFER_SIZE
+# Headers that are specific to HTTP/1 connections and not allowed in HTTP/2
+CONNECTION_HEADERS = frozenset((b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'upgrade'))
+
+
+def frame(ftype, flags, stream_id, payload=b''):
+    size = len(payload)
+    return pack('!BHBBI', size >> 16, size & 0xffff, ftype, flags, stream_id) + payload
+
+
+def strip_padding(flags, payload):
+    if flags & PADDED:
+        if not payload or payload[0] >= len(payload):
+            raise ValueError('Invalid padding')
+        return payload[1:len(payload) - payload[0]]
+    return payload
+
+
+def read_range(f, r, chunk_size):
+    f.seek(r.start)
+    remaining = r.size
+    while remaining > 0:
+        chunk = f.read(min(remaining, chunk_size))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def iter_output(output, chunk_size):
+    ' Iterate over the body of a response, as bytestrings '
+    if isinstance(output, GeneratedOutput):
+        for chunk in output.output:
+            if chunk:
+                yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        return
+    f, ranges = output.src_file, output.ranges
+    if ranges is None:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            yield chunk
+    elif isinstance(ranges, Range):
+        for chunk in read_range(f, ranges, chunk_size):
+            yield chunk
+    else:
+        first = True
+        for r, range_part in ranges:
+            if r is None:
+                # EOF range part
+                yield b'\r\n' + range_part
+            else:
+                yield (b'' if first else b'\r\n') + range_part + b'\r\n'
+                first = False
+                for chunk in read_range(f, r, chunk_size):
+                    yield chunk
+
+
+class Stream(object):
+
+    def __init__(self, stream_id, send_window):
+        self.stream_id, self.send_window = stream_id, send_window
+        self.method = self.path = self.query = self.request_line = None
+        self.request_original_uri = self.forwarded_for = None
+        self.inheaders = self.body = None
+        self.body_size = 0
+        # True once the client has finished sending the request
+        self.request_complete = False
+        self.response_started = False
+        # The body of the response, as an iterator of bytestrings
+        self.output = None
+        self.pending = b''
+        # True when waiting for a WINDOW_UPDATE from the client
+        self.blocked = False
+
+
+class HTTP2Connection(WebSocketConnection):
+
+    in_http2_mode = False
+    current_stream = None
+
+    def __init__(self, *args, **kwargs):
+        WebSocketConnection.__init__(self, *args, **kwargs)
+        # HTTP/2 is negotiated via ALPN on SSL connections, the connection
+        # preface is only looked for on plain connections when explicitly
+        # enabled
+        self.h2c_allowed = self.opts.use_h2c and self.ssl_context is None
+
+    # Switching to HTTP/2 {{{
+    def connection_ready(self):
+        if self.ssl_handshake_done and not self.in_http2_mode and self.opts.use_http2 and self.socket.selected_alpn_protocol() == 'h2':
+            return self.start_http2(preface_received=False)
+        WebSocketConnection.connection_ready(self)
+
+    def parse_request_line(self, buf, event, first=False):
+        if self.h2c_allowed and first and buf.total_length < len(PREFACE):
+            so_far = buf.getvalue()
+            if PREFACE.startswith(so_far):
+                if not self.read_buffer.has_data:
+                    self.fill_read_buffer()
+                    if not self.read_buffer.has_data:
+                        buf.append(so_far)
+                        return
+                data = so_far + self.read_buffer.peek(len(PREFACE) - len(so_far))
+                if PREFACE.startswith(data):
+                    self.read_buffer.read(len(data) - len(so_far))
+                    if data == PREFACE:
+                        return self.start_http2()
+                    # Wait for the rest of the preface
+                    buf.append(data)
+                    return
+            buf.append(so_far)
+        self.h2c_allowed = False
+        return WebSocketConnection.parse_request_line(self, buf, event, first=first)
+
+    def start_http2(self, preface_received=True):
+        self.in_http2_mode = True
+        self.h2c_allowed = self.response_started = False
+        self.h2_preface_pending = not preface_received
+        self.h2_inbuf, self.h2_outbuf = bytearray(), bytearray()
+        self.h2_encoder, self.h2_decoder = Encoder(), Decoder()
+        self.h2_streams = {}
+        self.h2_sending = deque()
+        self.h2_last_stream_id = 0
+        self.h2_continuation = None
+        self.h2_send_window = self.h2_initial_window_size = DEFAULT_WINDOW_SIZE
+        self.h2_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.h2_goaway_sent = self.h2_goaway_received = False
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.queue_h2_frame(SETTINGS, 0, 0, pack(
+            '!HIHI', SETTINGS_MAX_CONCURRENT_STREAMS, MAX_CONCURRENT_STREAMS,
+            SETTINGS_MAX_HEADER_LIST_SIZE, MAX_HEADER_BLOCK_SIZE))
+        self.handle_event = self.h2_duplex
+        self.set_h2_state()
+    # }}}
+
+    # Frame I/O {{{
+    def h2_duplex(self, event):
+        self.current_stream = None
+        if event is READ:
+            self.h2_read()
+        elif event is WRITE:
+            self.h2_write()
+        else:
+            self.h2_job_done(*event)
+        self.set_h2_state()
+
+    def set_h2_state(self):
+        self.h2_queue_data()
+        if not self.h2_outbuf and (self.h2_goaway_sent or (self.h2_goaway_received and not self.h2_streams)):
+            self.ready = False
+            return
+        self.wait_for = RDWR if self.h2_outbuf else READ
+
+    def queue_h2_frame(self, ftype, flags, stream_id, payload=b''):
+        self.h2_outbuf += frame(ftype, flags, stream_id, payload)
+
+    def h2_write(self):
+        if self.h2_outbuf:
+            sent = self.send(bytes(self.h2_outbuf[:SEND_QUEUE_SIZE]))
+            del self.h2_outbuf[:sent]
+            self.bytes_sent += sent
+
+    def h2_read(self):
+        data = self.recv(DESIRED_SEND_BUFFER_SIZE)
+        if not data or self.h2_goaway_sent:
+            return
+        buf = self.h2_inbuf
+        buf += data
+        if self.h2_preface_pending:
+            if not PREFACE.startswith(bytes(buf[:len(PREFACE)])):
+                return self.h2_connection_error(PROTOCOL_ERROR, 'Invalid connection preface')
+            if len(buf) < len(PREFACE):
+                return
+            del buf[:len(PREFACE)]
+            self.h2_preface_pending = False
+        pos = 0
+        while len(buf) - pos >= 9 and not self.h2_goaway_sent:
+            size = (buf[pos] << 16) | (buf[pos + 1] << 8) | buf[pos + 2]
+            if size > DEFAULT_MAX_FRAME_SIZE:
+                return self.h2_connection_error(FRAME_SIZE_ERROR, 'Frame of size %d is too large' % size)
+            end = pos + 9 + size
+            if len(buf) < end:
+                break
+            ftype, flags = buf[pos + 3], buf[pos + 4]
+            stream_id = unpack_from('!I', buf, pos + 5)[0] & 0x7fffffff
+            payload = bytes(buf[pos + 9:end])
+            pos = end
+            if self.h2_continuation is not None and (ftype != CONTINUATION or stream_id != self.h2_continuation[0]):
+                return self.h2_connection_error(PROTOCOL_ERROR, 'Expected a CONTINUATION frame')
+            if ftype < len(FRAME_NAMES):
+                # Frames of unknown types are ignored
+                getattr(self, 'h2_%s_frame' % FRAME_NAMES[ftype])(flags, stream_id, payload)
+        del buf[:pos]
+
+    def h2_connection_error(self, code, msg):
+        self.log.warn('HTTP/2 connection error from %s: %s' % (self.remote_addr, msg))
+        self.h2_goaway(code, msg)
+
+    def h2_goaway(self, code=NO_ERROR, msg=''):
+        if not self.h2_goaway_sent:
+            self.h2_goaway_sent = True
+            self.queue_h2_frame(GOAWAY, 0, 0, pack('!II', self.h2_last_stream_id, code) + msg.encode('utf-8'))
+
+    def h2_reset_stream(self, stream_id, code):
+        self.queue_h2_frame(RST_STREAM, 0, stream_id, pack('!I', code))
+        self.h2_close_stream(self.h2_streams.get(stream_id))
+
+    def h2_close_stream(self, stream):
+        if stream is not None and self.h2_streams.get(stream.stream_id) is stream:
+            del self.h2_streams[stream.stream_id]
+            stream.output = None
+            if stream.body is not None:
+                stream.body.close()
+            if self.metrics is not None and self.bytes_sent:
+                self.metrics.inc('calibre_server_bytes_sent_total', self.bytes_sent)
+            self.bytes_sent = 0
+    # }}}
+
+    # Frame handlers {{{
+    def h2_data_frame(self, flags, stream_id, payload):
+        if stream_id == 0:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'DATA frame for stream zero')
+        if stream_id > self.h2_last_stream_id:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'DATA frame for idle stream')
+        if payload:
+            # Data is consumed as soon as it is received, so simply replenish
+            # the flow control windows
+            self.queue_h2_frame(WINDOW_UPDATE, 0, 0, pack('!I', len(payload)))
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            # Data for a stream that has already been closed
+            return
+        if stream.request_complete:
+            return self.h2_reset_stream(stream_id, STREAM_CLOSED)
+        try:
+            data = strip_padding(flags, payload)
+        except ValueError as err:
+            return self.h2_connection_error(PROTOCOL_ERROR, error_message(err))
+        if flags & END_STREAM:
+            stream.request_complete = True
+        elif payload:
+            self.queue_h2_frame(WINDOW_UPDATE, 0, stream_id, pack('!I', len(payload)))
+        if stream.response_started:
+            # An error response has already been sent, discard the request body
+            return
+        stream.body_size += len(data)
+        if stream.body_size > self.max_request_body_size:
+            self.h2_select_stream(stream)
+            return self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE,
+                "The entity sent with the request exceeds the maximum "
+                "allowed bytes (%d)." % self.max_request_body_size)
+        if data:
+            if stream.body is None:
+                stream.body = SpooledTemporaryFile(prefix='rq-body-', max_size=DEFAULT_BUFFER_SIZE, dir=self.tdir)
+            stream.body.write(data)
+        if stream.request_complete:
+            self.h2_dispatch(stream)
+
+    def h2_headers_frame(self, flags, stream_id, payload):
+        if stream_id == 0 or stream_id % 2 == 0:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'HEADERS frame with invalid stream id: %d' % stream_id)
+        try:
+            block = strip_padding(flags, payload)
+        except ValueError as err:
+            return self.h2_connection_error(PROTOCOL_ERROR, error_message(err))
+        if flags & PRIORITY_FLAG:
+            # Stream priorities are ignored
+            block = block[5:]
+        if flags & END_HEADERS:
+            self.h2_headers_received(stream_id, flags, block)
+        else:
+            self.h2_continuation = stream_id, flags, bytearray(block)
+
+    def h2_continuation_frame(self, flags, stream_id, payload):
+        if self.h2_continuation is None:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'Unexpected CONTINUATION frame')
+        stream_id, hflags, block = self.h2_continuation
+        block += payload
+        if len(block) > MAX_HEADER_BLOCK_SIZE:
+            return self.h2_connection_error(ENHANCE_YOUR_CALM, 'Header block too large')
+        if flags & END_HEADERS:
+            self.h2_continuation = None
+            self.h2_headers_received(stream_id, hflags, bytes(block))
+
+    def h2_priority_frame(self, flags, stream_id, payload):
+        if stream_id == 0:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'PRIORITY frame for stream zero')
+
+    def h2_rst_stream_frame(self, flags, stream_id, payload):
+        if stream_id == 0 or stream_id > self.h2_last_stream_id:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'RST_STREAM frame for idle stream')
+        if len(payload) != 4:
+            return self.h2_connection_error(FRAME_SIZE_ERROR, 'RST_STREAM frame with invalid size')
+        # Any response being generated for this stream is discarded
+        self.h2_close_stream(self.h2_streams.get(stream_id))
+
+    def h2_settings_frame(self, flags, stream_id, payload):
+        if stream_id != 0:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'SETTINGS frame for non-zero stream')
+        if flags & ACK:
+            if payload:
+                self.h2_connection_error(FRAME_SIZE_ERROR, 'SETTINGS acknowledgement with payload')
+            return
+        if len(payload) % 6:
+            return self.h2_connection_error(FRAME_SIZE_ERROR, 'SETTINGS frame with invalid size')
+        for pos in range(0, len(payload), 6):
+            key, val = unpack_from('!HI', payload, pos)
+            if key == SETTINGS_INITIAL_WINDOW_SIZE:
+                if val > MAX_WINDOW_SIZE:
+                    return self.h2_connection_error(FLOW_CONTROL_ERROR, 'Initial window size too large')
+                delta = val - self.h2_initial_window_size
+                self.h2_initial_window_size = val
+                for stream in itervalues(self.h2_streams):
+                    stream.send_window += delta
+                    self.h2_unblock_stream(stream)
+            elif key == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_MAX_FRAME_SIZE <= val <= 16777215:
+                    return self.h2_connection_error(PROTOCOL_ERROR, 'Invalid max frame size')
+                self.h2_max_frame_size = val
+            elif key == SETTINGS_ENABLE_PUSH and val > 1:
+                return self.h2_connection_error(PROTOCOL_ERROR, 'Invalid enable push setting')
+            # SETTINGS_HEADER_TABLE_SIZE is ignored as the header encoder
+            # never uses the dynamic table, other settings only restrict
+            # server push
+        self.queue_h2_frame(SETTINGS, ACK, 0)
+
+    def h2_push_promise_frame(self, flags, stream_id, payload):
+        self.h2_connection_error(PROTOCOL_ERROR, 'Clients must not send PUSH_PROMISE frames')
+
+    def h2_ping_frame(self, flags, stream_id, payload):
+        if stream_id != 0:
+            return self.h2_connection_error(PROTOCOL_ERROR, 'PING frame for non-zero stream')
+        if len(payload) != 8:
+            return self.h2_connection_error(FRAME_SIZE_ERROR, 'PING frame with invalid size')
+        if not flags & ACK:
+            self.queue_h2_frame(PING, ACK, 0, payload)
+
+    def h2_goaway_frame(self, flags, stream_id, payload):
+        # Finish the requests in progress and then close the connection
+        self.h2_goaway_received = True
+
+    def h2_window_update_frame(self, flags, stream_id, payload):
+        if len(payload) != 4:
+            return self.h2_connection_error(FRAME_SIZE_ERROR, 'WINDOW_UPDATE frame with invalid size')
+        increment = unpack_from('!I', payload)[0] & 0x7fffffff
+        if stream_id == 0:
+            if increment == 0:
+                return self.h2_connection_error(PROTOCOL_ERROR, 'WINDOW_UPDATE with zero increment')
+            self.h2_send_window += increment
+            if self.h2_send_window > MAX_WINDOW_SIZE:
+                return self.h2_connection_error(FLOW_CONTROL_ERROR, 'Flow control window too large')
+            return
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            return
+        if increment == 0:
+            return self.h2_reset_stream(stream_id, PROTOCOL_ERROR)
+        stream.send_window += increment
+        if stream.send_window > MAX_WINDOW_SIZE:
+            return self.h2_reset_stream(stream_id, FLOW_CONTROL_ERROR)
+        self.h2_unblock_stream(stream)
+    # }}}
+
+    # Requests {{{
+    def h2_headers_received(self, stream_id, flags, block):
+        try:
+            headers = self.h2_decoder.decode(block)
+        except HPACKError as err:
+            return self.h2_connection_error(COMPRESSION_ERROR, error_message(err))
+        if stream_id <= self.h2_last_stream_id:
+            stream = self.h2_streams.get(stream_id)
+            if stream is None or stream.request_complete:
+                return self.h2_reset_stream(stream_id, STREAM_CLOSED)
+            # Trailers, which are ignored
+            if not flags & END_STREAM:
+                return self.h2_reset_stream(stream_id, PROTOCOL_ERROR)
+            stream.request_complete = True
+            if not stream.response_started:
+                self.h2_dispatch(stream)
+            return
+        self.h2_last_stream_id = stream_id
+        if self.h2_goaway_received or len(self.h2_streams) >= MAX_CONCURRENT_STREAMS:
+            return self.queue_h2_frame(RST_STREAM, 0, stream_id, pack('!I', REFUSED_STREAM))
+        self.h2_streams[stream_id] = stream = Stream(stream_id, self.h2_initial_window_size)
+        stream.request_complete = bool(flags & END_STREAM)
+        if self.h2_process_headers(stream, headers) and stream.request_complete:
+            self.h2_dispatch(stream)
+
+    def h2_process_headers(self, stream, headers):
+        # Returns True if the request headers are valid, otherwise sends an
+        # error response
+        pseudo, cookies, inheaders = {}, [], MultiDict()
+        try:
+            for name, value in headers:
+                if name.startswith(b':'):
+                    if inheaders or cookies or name in pseudo:
+                        raise ValueError('Misplaced pseudo-header: %r' % name)
+                    pseudo[name] = value
+                elif name in CONNECTION_HEADERS or (name == b'te' and value != b'trailers') or name != name.lower():
+                    raise ValueError('Invalid header: %r' % name)
+                elif name == b'cookie':
+                    # Cookies can be split into multiple header fields
+                    cookies.append(value)
+                elif len(name) + len(value) + 4 > self.max_header_line_size:
+                    self.h2_select_stream(stream)
+                    self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE)
+                    return False
+                else:
+                    add_header_field(inheaders, name, value)
+            if cookies:
+                add_header_field(inheaders, b'cookie', b'; '.join(cookies))
+            method, path = pseudo[b':method'], pseudo[b':path']
+            stream.method = method.decode('ascii').upper()
+        except (KeyError, ValueError):
+            self.h2_reset_stream(stream.stream_id, PROTOCOL_ERROR)
+            return False
+        authority = pseudo.get(b':authority')
+        if authority and 'Host' not in inheaders:
+            inheaders['Host'] = authority.decode('utf-8', 'replace')
+        stream.request_line = method + b' ' + path + b' HTTP/2'
+        stream.request_original_uri = path
+        stream.inheaders = inheaders
+        stream.forwarded_for = inheaders.get('X-Forwarded-For')
+        self.h2_select_stream(stream)
+        if stream.method not in HTTP_METHODS:
+            self.simple_response(http_client.BAD_REQUEST, 'Unknown HTTP method')
+            return False
+        try:
+            scheme, stream.path, stream.query = parse_uri(path)
+        except HTTPSimpleResponse as e:
+            self.simple_response(e.http_code, error_message(e))
+            return False
+        try:
+            content_length = int(inheaders.get('Content-Length', 0))
+        except ValueError:
+            self.simple_response(http_client.BAD_REQUEST, 'Invalid Content-Length')
+            return False
+        if content_length > self.max_request_body_size:
+            self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE,
+                "The entity sent with the request exceeds the maximum "
+                "allowed bytes (%d)." % self.max_request_body_size)
+            return False
+        return True
+
+    def h2_select_stream(self, stream):
+        # Make stream the one that responses are sent on
+        self.current_stream = stream
+        self.method, self.request_line, self.forwarded_for = stream.method, stream.request_line, stream.forwarded_for
+
+    def h2_dispatch(self, stream):
+        self.h2_select_stream(stream)
+        if stream.method == 'TRACE':
+            msg = force_unicode(stream.request_line, 'utf-8') + '\n' + stream.inheaders.pretty()
+            return self.simple_response(http_client.OK, msg)
+        body = stream.body or BytesIO()
+        body.seek(0)
+        data = RequestData(
+            stream.method, stream.path, stream.query, stream.inheaders, body,
+            MultiDict(), HTTP11, self.static_cache, self.opts,
+            self.remote_addr, self.remote_port, self.is_trusted_ip,
+            self.translator_cache, self.tdir, stream.forwarded_for, stream.request_original_uri,
+            self.ssl_context is not None
+        )
+        try:
+            self.pool.put_nowait(
+                self.socket.fileno(), partial(self.run_stream_request_handler, stream, data, monotonic()),
+                lane=request_lane(stream.path, self.opts.url_prefix), client=self.client_id)
+        except Full:
+            self.log.error('Server busy handling request: %s' % self.state_description)
+            if self.metrics is not None:
+                self.metrics.inc('calibre_server_busy_responses_total')
+            self.simple_response(http_client.SERVICE_UNAVAILABLE)
+
+    def run_stream_request_handler(self, stream, data, queued_at):
+        # Runs in a worker thread, errors are reported for the stream, not
+        # the connection
+        try:
+            return stream, True, self.run_request_handler(data, queued_at)
+        except Exception:
+            return stream, False, sys.exc_info()
+
+    def h2_job_done(self, ok, result):
+        if not ok:
+            reraise(*result)
+        stream, ok, result = result
+        if self.h2_streams.get(stream.stream_id) is not stream:
+            # The stream was reset by the client
+            return
+        self.h2_select_stream(stream)
+        self.job_done(ok, result)
+    # }}}
+
+    # Responses {{{
+    def h2_send_response(self, headers, output=None):
+        stream = self.current_stream
+        stream.response_started = True
+        block = self.h2_encoder.encode(headers)
+        size = self.h2_max_frame_size
+        end_stream = output is None or stream.method == 'HEAD'
+        first, block = block[:size], block[size:]
+        self.queue_h2_frame(HEADERS, (END_STREAM if end_stream else 0) | (0 if block else END_HEADERS), stream.stream_id, first)
+        while block:
+            chunk, block = block[:size], block[size:]
+            self.queue_h2_frame(CONTINUATION, 0 if block else END_HEADERS, stream.stream_id, chunk)
+        if end_stream:
+            self.h2_stream_finished(stream)
+        else:
+            stream.output = output
+            self.h2_sending.append(stream)
+
+    def h2_stream_finished(self, stream):
+        if not stream.request_complete:
+            # A response was sent before the complete request was received,
+            # tell the client to stop sending it
+            self.queue_h2_frame(RST_STREAM, 0, stream.stream_id, pack('!I', NO_ERROR))
+        self.h2_close_stream(stream)
+
+    def h2_unblock_stream(self, stream):
+        if stream.blocked and stream.send_window > 0:
+            stream.blocked = False
+            self.h2_sending.append(stream)
+
+    def h2_queue_data(self):
+        # Generate DATA frames for the streams that have response data, in
+        # round robin order, respecting flow control
+        while self.h2_sending and self.h2_send_window > 0 and len(self.h2_outbuf) < SEND_QUEUE_SIZE:
+            stream = self.h2_sending.popleft()
+            if self.h2_streams.get(stream.stream_id) is not stream:
+                continue
+            if stream.send_window <= 0:
+                stream.blocked = True
+                continue
+            amt = min(self.h2_max_frame_size, self.h2_send_window, stream.send_window)
+            self.current_stream = stream
+            chunks, size = [stream.pending], len(stream.pending)
+            while size < amt and stream.output is not None:
+                chunk = next(stream.output, None)
+                if chunk is None:
+                    stream.output = None
+                else:
+                    chunks.append(chunk)
+                    size += len(chunk)
+            data = b''.join(chunks)
+            data, stream.pending = data[:amt], data[amt:]
+            finished = stream.output is None and not stream.pending
+            self.queue_h2_frame(DATA, END_STREAM if finished else 0, stream.stream_id, data)
+            self.h2_send_window -= len(data)
+            stream.send_window -= len(data)
+            if finished:
+                self.h2_stream_finished(stream)
+            else:
+                self.h2_sending.append(stream)
+        self.current_stream = None
+
+    def send_response(self, data, output):
+        if not self.in_http2_mode:
+            return WebSocketConnection.send_response(self, data, output)
+        outheaders = data.outheaders
+        headers = [(b':status', str(data.status_code).encode('ascii'))]
+        for header, value in iteritems(outheaders):
+            name = header.lower().encode('ascii')
+            if name not in CONNECTION_HEADERS:
+                headers.append((name, unicode_type(value).encode('utf-8')))
+        for morsel in itervalues(data.outcookie):
+            morsel['version'] = '1'
+            headers.append((b'set-cookie', morsel.OutputString().encode('utf-8')))
+        if self.access_log is not None:
+            sz = outheaders.get('Content-Length')
+            self.log_access(status_code=data.status_code, response_size=sz and int(sz), username=data.username)
+        self.h2_send_response(headers, iter_output(output, self.h2_max_frame_size))
+
+    def simple_response(self, status_code, msg='', close_after_response=True, extra_headers=None):
+        if not self.in_http2_mode:
+            return WebSocketConnection.simple_response(self, status_code, msg, close_after_response, extra_headers)
+        msg = msg.encode('utf-8')
+        ct = 'http' if self.method == 'TRACE' else 'plain'
+        headers = [
+            (b':status', str(status_code).encode('ascii')),
+            (b'content-length', str(len(msg)).encode('ascii')),
+            (b'content-type', ('text/%s; charset=UTF-8' % ct).encode('ascii')),
+            (b'date', http_date().encode('ascii')),
+        ]
+        if extra_headers is not None:
+            for h, v in iteritems(extra_headers):
+                headers.append((h.lower().encode('ascii'), v.encode('utf-8')))
+        self.log_access(status_code=status_code, response_size=len(msg))
+        self.h2_send_response(headers, iter((msg,)) if msg else None)
+
+    def send_not_modified(self, etag=None):
+        if not self.in_http2_mode:
+            return WebSocketConnection.send_not_modified(self, etag)
+        headers = [(b':status', b'304'), (b'date', http_date().encode('ascii'))]
+        if etag is not None:
+            headers.append((b'etag', etag.encode('ascii')))
+        self.log_access(status_code=http_client.NOT_MODIFIED, response_size=0)
+        self.h2_send_response(headers)
+
+    def send_range_not_satisfiable(self, content_length):
+        if not self.in_http2_mode:
+            return WebSocketConnection.send_range_not_satisfiable(self, content_length)
+        headers = [
+            (b':status', b'416'), (b'date', http_date().encode('ascii')),
+            (b'content-range', ('bytes */%d' % content_length).encode('ascii'))]
+        self.log_access(status_code=http_client.REQUESTED_RANGE_NOT_SATISFIABLE, response_size=0)
+        self.h2_send_response(headers)
+
+    def report_unhandled_exception(self, e, formatted_traceback):
+        if not self.in_http2_mode:
+            return WebSocketConnection.report_unhandled_exception(self, e, formatted_traceback)
+        stream = self.current_stream
+        if stream is None or self.h2_streams.get(stream.stream_id) is not stream:
+            self.h2_goaway(INTERNAL_ERROR)
+        elif stream.response_started:
+            self.h2_reset_stream(stream.stream_id, INTERNAL_ERROR)
+        else:
+            self.simple_response(http_client.INTERNAL_SERVER_ERROR)
+        self.set_h2_state()
+
+    def handle_timeout(self):
+        if self.in_http2_mode:
+            # Idle connections are closed, but not ones waiting for responses
+            return bool(self.h2_streams)
+        return WebSocketConnection.handle_timeout(self)
+    # }}}
+
+
+class HTTP2Client(object):
+
+    ''' A minimal, blocking, HTTP/2 client that connects with prior knowledge,
+    used for testing and benchmarking the server. '''
+
+    def __init__(self, host, port, timeout=60, window_size=MAX_WINDOW_SIZE):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.encoder, self.decoder = Encoder(), Decoder()
+        self.next_stream_id = 1
+        self.buf = bytearray()
+        self.responses = {}
+        self.settings = {}
+        # By default, use the largest possible flow control windows, so that
+        # the server is never blocked by flow control
+        self.window_size = window_size
+        self.unacknowledged = defaultdict(int)
+        preface = PREFACE + frame(SETTINGS, 0, 0, pack('!HI', SETTINGS_INITIAL_WINDOW_SIZE, window_size))
+        if window_size > DEFAULT_WINDOW_SIZE:
+            preface += frame(WINDOW_UPDATE, 0, 0, pack('!I', window_size - DEFAULT_WINDOW_SIZE))
+        self.socket.sendall(preface)
+
+    def close(self):
+        self.socket.close()
+
+    def request(self, path, method='GET', headers=None, body=None, send=True):
+        ''' Start a request, returning the id of its stream. body must be a
+        bytestring no larger than the initial flow control window of the
+        server. Use send=False to only return the frames for the request. '''
+        stream_id = self.next_stream_id
+        self.next_stream_id += 2
+        hlist = [(b':method', method.encode('ascii')), (b':scheme', b'http'), (b':path', path.encode('utf-8')), (b':authority', b'localhost')]
+        for k, v in iteritems(headers or {}):
+            hlist.append((k.lower().encode('ascii'), v.encode('utf-8')))
+        ans = frame(HEADERS, END_HEADERS | (0 if body else END_STREAM), stream_id, self.encoder.encode(hlist))
+        if body:
+            for i in range(0, len(body), DEFAULT_MAX_FRAME_SIZE):
+                chunk = body[i:i + DEFAULT_MAX_FRAME_SIZE]
+                ans += frame(DATA, END_STREAM if i + len(chunk) >= len(body) else 0, stream_id, chunk)
+        self.responses[stream_id] = {'status': None, 'headers': {}, 'body': [], 'complete': False}
+        if send:
+            self.socket.sendall(ans)
+            return stream_id
+        return stream_id, ans
+
+    def read_frame(self):
+        while True:
+            if len(self.buf) >= 9:
+                size = (self.buf[0] << 16) | (self.buf[1] << 8) | self.buf[2]
+                if len(self.buf) >= size + 9:
+                    ftype, flags = self.buf[3], self.buf[4]
+                    stream_id = unpack_from('!I', self.buf, 5)[0] & 0x7fffffff
+                    payload = bytes(self.buf[9:size + 9])
+                    del self.buf[:size + 9]
+                    return ftype, flags, stream_id, payload
+            data = self.socket.recv(DESIRED_SEND_BUFFER_SIZE)
+            if not data:
+                raise EOFError('Connection closed by server')
+            self.buf += data
+
+    def read_responses(self, *stream_ids):
+        ''' Wait for the responses for the specified streams to be received,
+        returning a list of (status, headers, body) for them. A status of None
+        indicates the stream was reset. '''
+        block = bytearray()
+        while not all(self.responses[s]['complete'] for s in stream_ids):
+            ftype, flags, stream_id, payload = self.read_frame()
+            r = self.responses.get(stream_id)
+            if ftype == SETTINGS:
+                if not flags & ACK:
+                    self.settings.update(unpack_from('!HI', payload, i) for i in range(0, len(payload), 6))
+                    self.socket.sendall(frame(SETTINGS, ACK, 0))
+            elif ftype == PING:
+                if not flags & ACK:
+                    self.socket.sendall(frame(PING, ACK, 0, payload))
+            elif ftype == GOAWAY:
+                raise EOFError('Server sent GOAWAY with error code: %d' % unpack_from('!I', payload, 4)[0])
+            elif ftype in (HEADERS, CONTINUATION):
+                payload = strip_padding(flags, payload)
+                if flags & PRIORITY_FLAG:
+                    payload = payload[5:]
+                block += payload
+                if flags & END_HEADERS:
+                    for k, v in self.decoder.decode(block):
+                        k, v = k.decode('ascii'), v.decode('utf-8')
+                        if k == ':status':
+                            r['status'] = int(v)
+                        else:
+                            r['headers'][k] = (r['headers'][k] + '\n' + v) if k in r['headers'] else v
+                    del block[:]
+            elif ftype == DATA:
+                r['body'].append(strip_padding(flags, payload))
+                if flags & END_STREAM:
+                    self.unacknowledged.pop(stream_id, None)
+                for sid in ((0,) if flags & END_STREAM else (0, stream_id)):
+                    self.unacknowledged[sid] += len(payload)
+                    if self.unacknowledged[sid] >= self.window_size // 2:
+                        self.socket.sendall(frame(WINDOW_UPDATE, 0, sid, pack('!I', self.unacknowledged.pop(sid))))
+            elif ftype == RST_STREAM:
+                r['status'], r['complete'] = None, True
+            if r is not None and flags & END_STREAM and ftype in (HEADERS, DATA):
+                r['complete'] = True
+        ans = []
+        for s in stream_ids:
+            r = self.responses.pop(s)
+            ans.append((r['status'], r['headers'], b''.join(r['body'])))
+        return ans
+
+    def get(self, *paths, **kw):
+        ''' Fetch the specified paths concurrently, returning a list of (status,
+        headers, body) '''
+        return self.read_responses(*[self.request(p, headers=kw.get('headers')) for p in paths])
@@ -125,6 +125,64 @@ def normalize_header_name(name):
     return '-'.join(parts)
 
 
+header_name_cache = {}
+
+
+def safe_decode(hname, value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        if hname in decoded_headers:
+            raise
+    return value
+
+
+def add_header(hdict, line):
+    k, v = line.partition(b':')[::2]
+    add_header_field(hdict, k, v.strip(), line)
+
+
+def add_header_field(hdict, k, v, line=None):
+    # Add the header named k with the value v, both bytestrings, to hdict
+    key = header_name_cache.get(k)
+    if key is None:
+        key = normalize_header_name(k.strip().decode('ascii'))
+        if len(header_name_cache) < 1024:
+            header_name_cache[k] = key
+    val = safe_decode(key, v)
+    if not key or not val:
+        raise ValueError('Malformed header line: %s' % reprlib.repr(line or (k + b': ' + v)))
+    if key in comma_separated_headers:
+        existing = hdict.pop(key)
+        if existing is not None:
+            val = existing + ', ' + val
+    hdict[key] = val
+
+
+def parse_header_block(lines):
+    '''
+    Parse a complete block of header lines, without line terminators, in a
+    single pass. Equivalent to, but faster than, feeding the lines to
+    :class:`HTTPHeaderParser` one at a time. Can raise ValueError for
+    malformed headers.
+    '''
+    hdict = MultiDict()
+    current = None
+    for line in lines:
+        if line[:1] in (b' ', b'\t'):
+            # It's a continuation line.
+            if current is None:
+                raise ValueError('Orphaned continuation line')
+            current.append(line.lstrip())
+            continue
+        if current is not None:
+            add_header(hdict, b' '.join(current))
+        current = [line]
+    if current is not None:
+        add_header(hdict, b' '.join(current))
+    return hdict
+
+
 class HTTPHeaderParser(object):
 
     '''
@@ -149,30 +207,12 @@ class HTTPHeaderParser(object):
     def __call__(self, line):
         'Process a single line'
 
-        def safe_decode(hname, value):
-            try:
-                return value.decode('utf-8')
-            except UnicodeDecodeError:
-                if hname in decoded_headers:
-                    raise
-            return value
-
         def commit():
             if not self.lines:
                 return
             line = b' '.join(self.lines)
             del self.lines[:]
-
-            k, v = line.partition(b':')[::2]
-            key = normalize_header_name(k.strip().decode('ascii'))
-            val = safe_decode(key, v.strip())
-            if not key or not val:
-                raise ValueError('Malformed header line: %s' % reprlib.repr(line))
-            if key in comma_separated_headers:
-                existing = self.hdict.pop(key)
-                if existing is not None:
-                    val = existing + ', ' + val
-            self.hdict[key] = val
+            add_header(self.hdict, line)
 
         if self.finished:
             raise ValueError('Header block already terminated')
@@ -206,6 +246,7 @@ class HTTPRequest(Connection):
     request_handler = None
     static_cache = None
     translator_cache = None
+    use_fast_header_parsing = True
 
     def __init__(self, *args, **kwargs):
         Connection.__init__(self, *args, **kwargs)
@@ -254,6 +295,17 @@ class HTTPRequest(Connection):
         self.set_state(READ, self.parse_request_line, Accumulator(), first=True)
 
     def parse_request_line(self, buf, event, first=False):  # {{{
+        if self.use_fast_header_parsing and not buf.total_length:
+            # Fast path: when the complete header block has already been
+            # received, it is parsed in one pass, falling back to parsing line
+            # by line only for partially received headers
+            if not self.read_buffer.has_data:
+                self.fill_read_buffer()
+                if not self.read_buffer.has_data:
+                    return
+            block = self.read_buffer.read_until(b'\r\n\r\n')
+            if block is not None:
+                return self.parse_header_block(block, first)
         line = self.readline(buf)
         if line is None:
             return
@@ -263,7 +315,36 @@ class HTTPRequest(Connection):
             if first:
                 return self.set_state(READ, self.parse_request_line, Accumulator())
             return self.simple_response(http_client.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+        if self.process_request_line(line):
+            self.set_state(READ, self.parse_header_line, HTTPHeaderParser(), Accumulator())
+
+    def parse_header_block(self, block, first):
+        if block.count(b'\n') != block.count(b'\r\n'):
+            return self.simple_response(http_client.BAD_REQUEST, 'HTTP requires CRLF line terminators')
+        if first and block.startswith(b'\r\n'):
+            # Ignore a single leading empty line, as per RFC 2616 sec 4.1
+            block = block[2:]
+        if block.startswith(b'\r\n'):
+            return self.simple_response(http_client.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+        lines = block[:-4].split(b'\r\n')
+        self.request_line = lines[0]
+        if len(lines[0]) + 2 > self.max_header_line_size:
+            return self.simple_response(http_client.REQUEST_URI_TOO_LONG)
+        if not self.process_request_line(lines[0]):
+            return
+        del lines[0]
+        for line in lines:
+            if len(line) + 2 > self.max_header_line_size:
+                return self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE)
+        try:
+            hdict = parse_header_block(lines)
+        except ValueError:
+            return self.simple_response(http_client.BAD_REQUEST, 'Failed to parse header line')
+        self.finalize_headers(hdict)
 
+    def process_request_line(self, line):
+        # Returns True if the request line is valid, otherwise sends an error
+        # response
         try:
             method, uri, req_protocol = line.strip().split(b' ', 2)
             req_protocol = req_protocol.decode('ascii')
@@ -284,9 +365,10 @@ class HTTPRequest(Connection):
         try:
             self.scheme, self.path, self.query = parse_uri(uri)
         except HTTPSimpleResponse as e:
-            return self.simple_response(e.http_code, error_message(e), close_after_response=False)
+            self.simple_response(e.http_code, error_message(e), close_after_response=False)
+            return False
         self.header_line_too_long_error_code = http_client.REQUEST_ENTITY_TOO_LARGE
-        self.set_state(READ, self.parse_header_line, HTTPHeaderParser(), Accumulator())
+        return True
     # }}}
 
     @property
@@ -17,6 +17,7 @@ from polyglot.builtins import iteritems, itervalues, reraise, map, unicode_type,
 from calibre import guess_type, force_unicode
 from calibre.constants import __version__
 from calibre.srv.loop import WRITE
+from calibre.srv.pool import FAST, SLOW
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.sendfile import file_metadata, sendfile_to_socket_async, CannotSendfile, SendfileInterrupted
@@ -32,7 +33,17 @@ Range = namedtuple('Range', 'start stop size')
 MULTIPART_SEPARATOR = uuid.uuid4().hex
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
-COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/x-ndjson', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+# Requests for these paths typically need a lot of work (searching, sorting,
+# rendering) and are processed in the slow lane of the worker thread pool, a
+# path matches if it starts with all the components of an entry
+SLOW_PATHS = (
+    ('ajax', 'books'), ('ajax', 'books_in'), ('ajax', 'categories'), ('ajax', 'category'), ('ajax', 'search'),
+    ('book-manifest',), ('browse',), ('cdb',), ('conversion',), ('get', 'bundle'), ('interface-data', 'books-init'),
+    ('interface-data', 'bulk-metadata'), ('interface-data', 'get-books'), ('interface-data', 'init'), ('interface-data', 'more-books'),
+    ('interface-data', 'tag-browser'), ('mobile',), ('opds',), ('stanza',),
+)
 import zlib
 from itertools import zip_longest
 
@@ -43,6 +54,19 @@ def header_list_to_file(buf):  # {{{
 # }}}
 
 
+def request_lane(path, url_prefix=None):
+    ''' Return the lane of the worker thread pool a request for path (a tuple
+    of path components) should be processed in. '''
+    if url_prefix:
+        prefix = tuple(url_prefix.strip('/').split('/'))
+        if path[:len(prefix)] == prefix:
+            path = path[len(prefix):]
+    for q in SLOW_PATHS:
+        if path[:len(q)] == q:
+            return SLOW
+    return FAST
+
+
 def parse_multipart_byterange(buf, content_type):  # {{{
     sep = (content_type.rsplit('=', 1)[-1]).encode('utf-8')
     ans = []
@@ -213,7 +237,7 @@ class RequestData(object):  # {{{
 
     def __init__(self, method, path, query, inheaders, request_body_file, outheaders, response_protocol,
                  static_cache, opts, remote_addr, remote_port, is_trusted_ip, translator_cache,
-                 tdir, forwarded_for, request_original_uri=None):
+                 tdir, forwarded_for, request_original_uri=None, is_ssl=False):
 
         (self.method, self.path, self.query, self.inheaders, self.request_body_file, self.outheaders,
          self.response_protocol, self.static_cache, self.translator_cache) = (
@@ -224,6 +248,7 @@ class RequestData(object):  # {{{
         self.remote_addr, self.remote_port, self.is_trusted_ip = remote_addr, remote_port, is_trusted_ip
         self.forwarded_for = forwarded_for
         self.request_original_uri = request_original_uri
+        self.is_ssl = is_ssl
         self.opts = opts
         self.status_code = http_client.OK
         self.outcookie = Cookie()
@@ -249,7 +274,8 @@ class RequestData(object):  # {{{
         return ETaggedFile(output, etag_as_hexencoded_string)
 
     def etagged_dynamic_response(self, etag, func, content_type='text/html; charset=UTF-8'):
-        ' A response that is generated only if the etag does not match '
+        ''' A response that is generated only if the etag does not match. func
+        must return bytes, a unicode string or a file like object. '''
         ct = self.outheaders.get('Content-Type')
         if not ct:
             self.outheaders.set('Content-Type', content_type, replace_all=True)
@@ -363,6 +389,7 @@ class StaticOutput(object):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    bytes_sent = 0
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -396,6 +423,7 @@ class HTTPConnection(HTTPRequest):
         else:
             data = buf.read(min(limit, self.send_bufsize))
             sent = self.send(data)
+        self.bytes_sent += sent
         buf.seek(pos + sent)
         return buf.tell() >= end
 
@@ -440,11 +468,23 @@ class HTTPConnection(HTTPRequest):
             self.method, self.path, self.query, inheaders, request_body_file,
             outheaders, self.response_protocol, self.static_cache, self.opts,
             self.remote_addr, self.remote_port, self.is_trusted_ip,
-            self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
+            self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri,
+            self.ssl_context is not None
         )
-        self.queue_job(self.run_request_handler, data)
-
-    def run_request_handler(self, data):
+        self.queue_job(self.run_request_handler, data, monotonic(), lane=request_lane(self.path, self.opts.url_prefix), client=self.client_id)
+
+    @property
+    def client_id(self):
+        # The client on whose behalf requests are made, for limiting the
+        # number of simultaneous requests per client
+        client = self.remote_addr
+        if self.forwarded_for and getattr(self.parsed_remote_addr, 'is_loopback', False):
+            client = self.forwarded_for.partition(',')[0].strip() or client
+        return client
+
+    def run_request_handler(self, data, queued_at):
+        if self.metrics is not None:
+            self.metrics.observe('calibre_server_queue_wait_seconds', monotonic() - queued_at)
         result = self.request_handler(data)
         return data, result
 
@@ -495,9 +535,15 @@ class HTTPConnection(HTTPRequest):
         if output is None:
             return
         outheaders = data.outheaders
-
         outheaders.set('Date', http_date(), replace_all=True)
         outheaders.set('Server', 'calibre %s' % __version__, replace_all=True)
+        ct = outheaders.get('Content-Type', '')
+        if ct.startswith('text/') and 'charset=' not in ct:
+            outheaders.set('Content-Type', ct + '; charset=UTF-8', replace_all=True)
+        self.send_response(data, output)
+
+    def send_response(self, data, output):
+        outheaders = data.outheaders
         keep_alive = not self.close_after_response and self.opts.timeout > 0
         if keep_alive:
             outheaders.set('Keep-Alive', 'timeout=%d' % int(self.opts.timeout))
@@ -509,10 +555,6 @@ class HTTPConnection(HTTPRequest):
                 if not self.close_after_response:
                     outheaders.set('Connection', 'Keep-Alive')
 
-        ct = outheaders.get('Content-Type', '')
-        if ct.startswith('text/') and 'charset=' not in ct:
-            outheaders.set('Content-Type', ct + '; charset=UTF-8', replace_all=True)
-
         buf = [HTTP11 + (' %d ' % data.status_code) + http_client.responses[data.status_code]]
         for header, value in sorted(iteritems(outheaders), key=itemgetter(0)):
             buf.append('%s: %s' % (header, value))
@@ -622,6 +664,9 @@ class HTTPConnection(HTTPRequest):
 
     def reset_state(self):
         ready = not self.close_after_response
+        if self.metrics is not None and self.bytes_sent:
+            self.metrics.inc('calibre_server_bytes_sent_total', self.bytes_sent)
+        self.bytes_sent = 0
         self.end_send_optimization()
         self.connection_ready()
         self.ready = ready
@@ -659,11 +704,15 @@ class HTTPConnection(HTTPRequest):
         elif isinstance(output, string_or_bytes):
             output = dynamic_output(output, outheaders)
         elif hasattr(output, 'read'):
-            output = ReadableOutput(output)
+            output = ReadableOutput(output, etag=getattr(output, 'etag', None))
         elif isinstance(output, StaticOutput):
             output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
         elif isinstance(output, ETaggedDynamicOutput):
-            output = dynamic_output(output(), outheaders, etag=output.etag)
+            etag, output = output.etag, output()
+            if hasattr(output, 'read'):
+                output = ReadableOutput(output, etag=etag)
+            else:
+                output = dynamic_output(output, outheaders, etag=etag)
         else:
             output = GeneratedOutput(output)
         ct = outheaders.get('Content-Type', '').partition(';')[0]
@@ -726,7 +775,7 @@ class HTTPConnection(HTTPRequest):
 
 
 def create_http_handler(handler=None, websocket_handler=None):
-    from calibre.srv.web_socket import WebSocketConnection
+    from calibre.srv.http2 import HTTP2Connection
     static_cache = {}
     translator_cache = {}
     if handler is None:
@@ -736,7 +785,7 @@ def create_http_handler(handler=None, websocket_handler=None):
 
     @wraps(handler)
     def wrapper(*args, **kwargs):
-        ans = WebSocketConnection(*args, **kwargs)
+        ans = HTTP2Connection(*args, **kwargs)
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
@@ -15,7 +15,7 @@ from calibre.utils.ipc.simple_worker import fork_job, WorkerError
 from polyglot.queue import Queue, Empty
 from polyglot.builtins import iteritems, itervalues
 
-StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
+StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data priority')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
 
 
@@ -33,6 +33,7 @@ class Job(Thread):
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
+        self.priority = start_event.priority
         self.start_time = monotonic()
         self.end_time = self.log_path = None
         self.wait_for_end = Event()
@@ -98,11 +99,15 @@ class JobsManager(object):
         self.job_id = count()
         self.waiting_job_ids = set()
         self.waiting_jobs = deque()
+        self.job_priorities = {}
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, priority=0):
+        ''' Queue a job for execution in a worker process. Waiting jobs with a
+        lower priority value are started before jobs with a higher one, jobs
+        with the same priority are started in the order they were queued. '''
         with self.lock:
             if self.shutting_down:
                 return None
@@ -111,10 +116,29 @@ class JobsManager(object):
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
-            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
+            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data, priority))
             self.waiting_job_ids.add(job_id)
+            self.job_priorities[job_id] = priority
             return job_id
 
+    def raise_priority(self, job_id, priority):
+        ' Change the priority of a job that has not yet started, if the new priority is more urgent '
+        with self.lock:
+            if job_id in self.waiting_job_ids and priority < self.job_priorities.get(job_id, priority + 1):
+                self.job_priorities[job_id] = priority
+                return True
+        return False
+
+    @property
+    def queue_depth(self):
+        with self.lock:
+            return len(self.waiting_job_ids)
+
+    @property
+    def num_running_jobs(self):
+        with self.lock:
+            return len(self.jobs)
+
     def job_status(self, job_id):
         with self.lock:
             if not self.shutting_down:
@@ -185,7 +209,9 @@ class JobsManager(object):
     def start_waiting_jobs(self):
         with self.lock:
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
-                ev = self.waiting_jobs.popleft()
+                ev = min(self.waiting_jobs, key=lambda ev: (self.job_priorities.get(ev.job_id, ev.priority), ev.job_id))
+                self.waiting_jobs.remove(ev)
+                self.job_priorities.pop(ev.job_id, None)
                 self.jobs[ev.job_id] = Job(ev, self.events)
                 self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
@@ -62,10 +62,46 @@ def library_id_from_path(path, existing=frozenset()):
     return make_library_id_unique(library_id, existing)
 
 
+def close_db(db):
+    getattr(db, 'close', lambda: None)()
+    getattr(db, 'break_cycles', lambda: None)()
+
+
+def estimated_memory_usage(library_path):
+    # The in-memory tables of a library are roughly proportional to the size
+    # of its metadata database
+    try:
+        return os.path.getsize(os.path.join(library_path, 'metadata.db'))
+    except EnvironmentError:
+        return 0
+
+
+PRUNE_INTERVAL = 60  # seconds
+# Libraries used within this many seconds are never unloaded, as their dbs may
+# still be used by code that did not acquire() them
+MIN_IDLE_TIME = 60  # seconds
+
+
 class LibraryBroker(object):
 
-    def __init__(self, libraries):
+    '''
+    Provides access to the libraries being served. Libraries are loaded on
+    first use. If idle_timeout (in seconds) is non-zero, libraries that have
+    not been used for that long are unloaded. If memory_budget (in bytes) is
+    non-zero, the least recently used libraries are unloaded when the
+    estimated memory used by all loaded libraries exceeds it. Libraries that
+    are in use, see :meth:`acquire`, are never unloaded. Unloaded libraries are
+    transparently reloaded when next used. '''
+
+    prune_on_access = True
+
+    def __init__(self, libraries, idle_timeout=0, memory_budget=0):
         self.lock = Lock()
+        self.idle_timeout, self.memory_budget = idle_timeout, memory_budget
+        self.last_used_times = defaultdict(lambda: float('-inf'))
+        self.users = defaultdict(int)
+        self.memory_usage = {}
+        self.last_prune = monotonic()
         self.lmap = OrderedDict()
         self.library_name_map = {}
         self.original_path_map = {}
@@ -87,13 +123,20 @@ class LibraryBroker(object):
             self.library_name_map[library_id] = basename(original_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        (self.category_caches, self.search_caches, self.tag_browser_caches, self.restriction_caches,
+         self.opds_entry_caches) = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+            defaultdict(OrderedDict), defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
         with self:
             library_id = library_id or self.default_library
+            now = monotonic()
+            if library_id in self.lmap:
+                self.last_used_times[library_id] = now
+            if self.prune_on_access and (self.idle_timeout or self.memory_budget) and now - self.last_prune > PRUNE_INTERVAL:
+                self.last_prune = now
+                self._prune_loaded_dbs()
             if library_id in self.loaded_dbs:
                 return self.loaded_dbs[library_id]
             path = self.lmap.get(library_id)
@@ -106,17 +149,92 @@ class LibraryBroker(object):
             except Exception:
                 self.loaded_dbs[library_id] = None
                 raise
+            self.memory_usage[library_id] = estimated_memory_usage(self.original_path_map.get(path, path))
+            if self.memory_budget:
+                self._enforce_memory_budget()
             return ans
 
+    def acquire(self, library_id=None):
+        ''' Like :meth:`get` but the library is marked as in use, and so is not
+        unloaded, until :meth:`release` is called with the server_library_id
+        of the returned db. '''
+        with self:
+            db = self.get(library_id)
+            if db is not None:
+                self.users[db.new_api.server_library_id] += 1
+            return db
+
+    def release(self, library_id):
+        with self:
+            self.users[library_id] -= 1
+            if self.users[library_id] < 1:
+                del self.users[library_id]
+            # The library is often still used briefly afterwards, for example,
+            # to generate the output of a request
+            self.last_used_times[library_id] = monotonic()
+
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
+    def is_pinned(self, library_id):
+        ''' Return True if the specified library must never be unloaded '''
+        return False
+
+    def can_unload(self, library_id):
+        # Must be called with lock held
+        return not self.is_pinned(library_id) and library_id not in self.users
+
+    def _unload(self, library_id):
+        # Must be called with lock held
+        db = self.loaded_dbs.pop(library_id, None)
+        self.memory_usage.pop(library_id, None)
+        for cache in (
+                self.category_caches, self.search_caches, self.tag_browser_caches, self.restriction_caches, self.opds_entry_caches):
+            cache.pop(library_id, None)
+        if db is not None:
+            close_db(db)
+
+    def _enforce_memory_budget(self):
+        # Must be called with lock held
+        total = sum(itervalues(self.memory_usage))
+        if total <= self.memory_budget:
+            return
+        now = monotonic()
+        for library_id in sorted(self.memory_usage, key=self.last_used_times.__getitem__):
+            if total <= self.memory_budget or now - self.last_used_times[library_id] < MIN_IDLE_TIME:
+                break
+            if self.can_unload(library_id):
+                total -= self.memory_usage[library_id]
+                self._unload(library_id)
+
+    def _prune_loaded_dbs(self):
+        # Must be called with lock held
+        if self.idle_timeout:
+            now = monotonic()
+            idle_timeout = max(self.idle_timeout, MIN_IDLE_TIME)
+            for library_id in tuple(self.loaded_dbs):
+                if self.can_unload(library_id) and now - self.last_used_times[library_id] > idle_timeout:
+                    self._unload(library_id)
+        if self.memory_budget:
+            self._enforce_memory_budget()
+
+    def prune_loaded_dbs(self):
+        with self:
+            self._prune_loaded_dbs()
+
     def close(self):
         with self:
             for db in itervalues(self.loaded_dbs):
                 getattr(db, 'close', lambda: None)()
-            self.lmap, self.loaded_dbs = OrderedDict(), {}
+            self.lmap, self.loaded_dbs, self.memory_usage = OrderedDict(), {}, {}
+
+    def library_id_for_path(self, library_path):
+        library_path = canonicalize_path(library_path)
+        with self:
+            for library_id, path in iteritems(self.lmap):
+                if canonicalize_path(path) == library_path:
+                    return library_id
 
     @property
     def default_library(self):
@@ -159,11 +277,14 @@ def path_for_db(db):
 
 class GuiLibraryBroker(LibraryBroker):
 
+    # Libraries returned by get_library() are used outside the broker, so only
+    # prune when explicitly asked to
+    prune_on_access = False
+
     def __init__(self, db):
         from calibre.gui2 import gprefs
-        self.last_used_times = defaultdict(lambda: -EXPIRED_AGE)
         self.gui_library_id = None
-        LibraryBroker.__init__(self, load_gui_libraries(gprefs))
+        LibraryBroker.__init__(self, load_gui_libraries(gprefs), idle_timeout=EXPIRED_AGE)
         self.gui_library_changed(db)
 
     def init_library(self, library_path, is_default_library):
@@ -171,10 +292,10 @@ class GuiLibraryBroker(LibraryBroker):
         return LibraryDatabase(library_path, is_second_db=True)
 
     def get(self, library_id=None):
-        try:
-            return getattr(LibraryBroker.get(self, library_id), 'new_api', None)
-        finally:
-            self.last_used_times[library_id or self.default_library] = monotonic()
+        return getattr(LibraryBroker.get(self, library_id), 'new_api', None)
+
+    def is_pinned(self, library_id):
+        return library_id == self.gui_library_id
 
     def get_library(self, original_library_path):
         library_path = canonicalize_path(original_library_path)
@@ -240,20 +361,6 @@ class GuiLibraryBroker(LibraryBroker):
                 return samefile(library_path, self.lmap[self.gui_library_id])
             return False
 
-    def _prune_loaded_dbs(self):
-        now = monotonic()
-        for library_id in tuple(self.loaded_dbs):
-            if library_id != self.gui_library_id and now - self.last_used_times[
-                library_id] > EXPIRED_AGE:
-                db = self.loaded_dbs.pop(library_id, None)
-                if db is not None:
-                    db.close()
-                    db.break_cycles()
-
-    def prune_loaded_dbs(self):
-        with self:
-            self._prune_loaded_dbs()
-
     def unload_library(self, library_path):
         with self:
             path = canonicalize_path(library_path)
@@ -262,10 +369,7 @@ class GuiLibraryBroker(LibraryBroker):
                     break
             else:
                 return
-            db = self.loaded_dbs.pop(library_id, None)
-            if db is not None:
-                db.close()
-                db.break_cycles()
+            self._unload(library_id)
 
     def remove_library(self, path):
         with self:
@@ -277,7 +381,4 @@ class GuiLibraryBroker(LibraryBroker):
                 return
             self.lmap.pop(library_id, None), self.library_name_map.pop(
                 library_id, None), self.original_path_map.pop(path, None)
-            db = self.loaded_dbs.pop(library_id, None)
-            if db is not None:
-                db.close()
-                db.break_cycles()
+            self._unload(library_id)
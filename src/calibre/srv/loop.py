@@ -19,7 +19,7 @@ from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
 from calibre.srv.opts import Options
-from calibre.srv.pool import PluginPool, ThreadPool
+from calibre.srv.pool import FAST, PluginPool, ThreadPool
 from calibre.srv.utils import (
     DESIRED_SEND_BUFFER_SIZE, HandleInterrupt, create_sock_pair, socket_errors_eintr,
     socket_errors_nonblocking, socket_errors_socket_closed, start_cork, stop_cork
@@ -88,7 +88,7 @@ class ReadBuffer(object):  # {{{
         else:
             num = socket.recv_into(self.buf[self.write_pos:])
             self.write_pos = (self.write_pos + num) % len(self.buf)
-        if self.write_pos == self.read_pos:
+        if num and self.write_pos == self.read_pos:
             self.full_state = READ
         return num
 
@@ -121,6 +121,41 @@ class ReadBuffer(object):  # {{{
                 if self.read_pos == self.write_pos:
                     self.full_state = WRITE
         return ans
+
+    def peek(self, size):
+        # Return up to size bytes from the start of the buffer, without
+        # removing them from the buffer
+        if self.read_pos == self.write_pos and self.full_state is WRITE:
+            return b''
+        if self.read_pos < self.write_pos:
+            return self.buf[self.read_pos:min(self.write_pos, self.read_pos + size)].tobytes()
+        ans = self.buf[self.read_pos:self.read_pos + size].tobytes()
+        if len(ans) < size:
+            ans += self.buf[:min(self.write_pos, size - len(ans))].tobytes()
+        return ans
+
+    def read_until(self, sep):
+        # Return everything in the buffer up to (and including) the first
+        # occurrence of sep. If sep is not present, returns None and leaves
+        # the buffer unchanged.
+        if self.read_pos == self.write_pos and self.full_state is WRITE:
+            return None
+        if self.read_pos < self.write_pos:
+            pos = self.ba.find(sep, self.read_pos, self.write_pos)
+            if pos < 0:
+                return None
+            end = pos + len(sep)
+            ans = self.buf[self.read_pos:end].tobytes()
+        else:
+            data = self.buf[self.read_pos:].tobytes() + self.buf[:self.write_pos].tobytes()
+            pos = data.find(sep)
+            if pos < 0:
+                return None
+            ans = data[:pos + len(sep)]
+        self.read_pos = (self.read_pos + len(ans)) % len(self.buf)
+        if self.read_pos == self.write_pos:
+            self.full_state = WRITE
+        return ans
     # }}}
 
 
@@ -153,6 +188,8 @@ def is_ip_trusted(remote_addr, trusted_ips):
 
 class Connection(object):  # {{{
 
+    metrics = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -330,11 +367,14 @@ class Connection(object):  # {{{
         except socket.error:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, **kw):
+        ''' Run func(*args) in the worker thread pool. The keyword arguments
+        lane and client control the scheduling of the job, see
+        :class:`calibre.srv.pool.ThreadPool`. '''
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, lane=kw.get('lane', FAST), client=kw.get('client'))
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -401,6 +441,8 @@ class ServerLoop(object):
             self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self.ssl_context.load_cert_chain(certfile=self.opts.ssl_certfile, keyfile=self.opts.ssl_keyfile)
             self.ssl_context.set_servername_callback(self.on_ssl_servername)
+            if self.opts.use_http2:
+                self.ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
 
         self.pre_activated_socket = None
         if self.opts.allow_socket_preallocation:
@@ -411,8 +453,15 @@ class ServerLoop(object):
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(
+            self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count,
+            per_client_limit=self.opts.max_requests_per_client)
         self.plugin_pool = PluginPool(self, plugins)
+        self.metrics = None
+        if self.opts.metrics:
+            from calibre.srv.metrics import create_server_metrics, loop_gauges
+            self.metrics = create_server_metrics()
+            loop_gauges(self.metrics, self)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
         c = self.connection_map.get(socket.fileno())
@@ -608,6 +657,8 @@ class ServerLoop(object):
                     self.close(s, conn)
             except JobQueueFull:
                 self.log.exception('Server busy handling request: %s' % conn.state_description)
+                if self.metrics is not None:
+                    self.metrics.inc('calibre_server_busy_responses_total')
                 if conn.ready:
                     if conn.response_started:
                         self.close(s, conn)
@@ -667,6 +718,7 @@ class ServerLoop(object):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.metrics = self.metrics
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
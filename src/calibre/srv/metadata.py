@@ -5,10 +5,11 @@
 
 import os
 from copy import copy
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime, time
 from functools import partial
 from threading import Lock
+from weakref import WeakKeyDictionary
 
 from calibre.constants import config_dir
 from calibre.db.categories import Tag
@@ -21,6 +22,8 @@ from calibre.utils.icu import collation_order
 from calibre.utils.localization import calibre_langcode_to_name
 from calibre.library.comments import comments_to_html, markdown
 from calibre.library.field_metadata import category_icon_map
+from calibre.srv.utils import RawJSON
+from calibre.utils.serialize import json_dumps
 from polyglot.builtins import iteritems, itervalues, range, filter, unicode_type
 from polyglot.urllib import quote
 
@@ -91,6 +94,53 @@ def book_as_json(db, book_id):
     return ans
 
 
+BOOK_JSON_CACHE_SIZE = 5000
+book_json_caches = WeakKeyDictionary()
+book_json_caches_lock = Lock()
+
+
+def serialized_book_as_json(db, book_id):
+    ''' Return the result of :func:`book_as_json` serialized as UTF-8 encoded
+    JSON. Results are cached per library until the book is next modified or
+    any write to the library, such as renaming or removing items, clears the
+    search caches. '''
+    db = db.new_api
+    with db.safe_read_lock:
+        state = db._field_for('last_modified', book_id), db.clear_search_cache_count
+        with book_json_caches_lock:
+            cache = book_json_caches.get(db)
+            if cache is None:
+                cache = book_json_caches[db] = OrderedDict()
+            cached = cache.pop(book_id, None)
+            if cached is not None and cached[0] == state:
+                cache[book_id] = cached
+                return cached[1]
+        data = book_as_json(db, book_id)
+        if data is None:
+            return
+        data = json_dumps(data)
+        with book_json_caches_lock:
+            cache[book_id] = state, data
+            if len(cache) > BOOK_JSON_CACHE_SIZE:
+                cache.popitem(last=False)
+    return data
+
+
+def books_as_json(db, book_ids):
+    ''' Return a mapping of book id to the result of :func:`book_as_json` for
+    the specified books, as :class:`RawJSON` assembled from the serialized
+    metadata of the individual books. Books that do not exist are omitted. '''
+    parts = []
+    seen = set()
+    for book_id in book_ids:
+        if book_id not in seen:
+            seen.add(book_id)
+            data = serialized_book_as_json(db, book_id)
+            if data is not None:
+                parts.append(b'"%d": ' % book_id + data)
+    return RawJSON(b'{' + b', '.join(parts) + b'}')
+
+
 _include_fields = frozenset(Tag.__slots__) - frozenset({
     'state', 'is_editable', 'is_searchable', 'original_name', 'use_sort_as_name', 'is_hierarchical'
 })
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+
+from calibre.srv.errors import HTTPForbidden, HTTPNotFound
+from calibre.srv.routes import endpoint
+from polyglot.builtins import iteritems
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_MIME = 'text/plain; version=0.0.4; charset=UTF-8'
+
+
+def escape_label_value(x):
+    return '{}'.format(x).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, escape_label_value(v)) for k, v in labels) + '}'
+
+
+def format_value(x):
+    if isinstance(x, float):
+        if x != x:
+            return 'NaN'
+        if x in (float('inf'), float('-inf')):
+            return '+Inf' if x > 0 else '-Inf'
+        return repr(x)
+    return '%d' % x
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, val):
+        self.counts[bisect_left(self.buckets, val)] += 1
+        self.total += val
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for le, c in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += c
+            yield '%s_bucket%s %d' % (name, format_labels(labels + (('le', format_value(float(le))),)), cumulative)
+        yield '%s_sum%s %s' % (name, format_labels(labels), format_value(self.total))
+        yield '%s_count%s %d' % (name, format_labels(labels), self.count)
+
+
+class Metrics(object):
+
+    '''
+    Thread safe collection of counters, histograms and gauges describing the
+    operation of the server. Counters and histograms are updated as requests
+    are processed, gauges are functions that are called only when the metrics
+    are exported. Labels are passed as keyword arguments. '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.descriptions = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.gauges = OrderedDict()
+
+    def describe(self, name, mtype, help_text):
+        self.descriptions[name] = mtype, help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = name, tuple(sorted(iteritems(labels)))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = name, tuple(sorted(iteritems(labels)))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram(buckets)
+            h.observe(value)
+
+    def add_gauge(self, name, help_text, func):
+        ''' Add a gauge whose value is obtained by calling func(). func() must
+        return either a number or an iterable of (labels dict, number) pairs. '''
+        self.describe(name, 'gauge', help_text)
+        self.gauges[name] = func
+
+    def as_prometheus_text(self, extra_gauges=()):
+        ''' Return all metrics in the Prometheus text exposition format. extra_gauges
+        is an iterable of (name, help_text, func) that are exported in addition
+        to the registered gauges. '''
+        series = OrderedDict()
+
+        def add(name, lines):
+            series.setdefault(name, []).extend(lines)
+
+        with self.lock:
+            for (name, labels), val in iteritems(self.counters):
+                add(name, ('%s%s %s' % (name, format_labels(labels), format_value(val)),))
+            for (name, labels), h in iteritems(self.histograms):
+                add(name, h.lines(name, labels))
+            gauges = list(iteritems(self.gauges))
+        descriptions = self.descriptions.copy()
+        for name, help_text, func in extra_gauges:
+            descriptions[name] = 'gauge', help_text
+            gauges.append((name, func))
+        for name, func in gauges:
+            try:
+                val = func()
+            except Exception:
+                continue
+            if isinstance(val, (int, float)):
+                val = (({}, val),)
+            add(name, ('%s%s %s' % (name, format_labels(tuple(sorted(iteritems(labels)))), format_value(v)) for labels, v in val))
+        ans = []
+        for name, lines in iteritems(series):
+            mtype, help_text = descriptions.get(name, ('untyped', None))
+            if help_text:
+                ans.append('# HELP %s %s' % (name, help_text.replace('\\', r'\\').replace('\n', r'\n')))
+            ans.append('# TYPE %s %s' % (name, mtype))
+            ans.extend(lines)
+        ans.append('')
+        return '\n'.join(ans)
+
+
+def create_server_metrics():
+    ans = Metrics()
+    d = ans.describe
+    d('calibre_server_requests_total', 'counter', 'Number of HTTP requests processed, by route and status code')
+    d('calibre_server_request_duration_seconds', 'histogram', 'Time taken to process HTTP requests, by route')
+    d('calibre_server_queue_wait_seconds', 'histogram', 'Time HTTP requests spent waiting for a free worker thread')
+    d('calibre_server_bytes_sent_total', 'counter', 'Number of bytes sent in HTTP responses')
+    d('calibre_server_busy_responses_total', 'counter', 'Number of requests rejected because the server was busy')
+    d('calibre_server_cache_requests_total', 'counter', 'Number of lookups in the server caches, by cache and result')
+    return ans
+
+
+def library_gauges(ctx):
+    from calibre.srv.books import get_render_stats
+    from calibre.srv.convert import get_conversion_stats
+    broker = ctx.library_broker
+
+    def loaded_dbs():
+        with broker:
+            return [(library_id, db) for library_id, db in iteritems(broker.loaded_dbs) if db is not None]
+
+    def lock_wait(idx):
+        return [({'library': library_id}, db.lock_wait_stats()[idx]) for library_id, db in loaded_dbs()]
+
+    def render_stat(name):
+        return lambda: get_render_stats(ctx)[name]
+
+    def conversion_stat(name):
+        return lambda: get_conversion_stats(ctx)[name]
+
+    yield 'calibre_server_libraries_loaded', 'Number of libraries currently loaded in memory', lambda: len(loaded_dbs())
+    yield 'calibre_db_lock_waits', 'Number of times a thread had to wait for the library database lock', lambda: lock_wait(0)
+    yield 'calibre_db_lock_wait_seconds', 'Total time threads spent waiting for the library database lock', lambda: lock_wait(1)
+    for name, help_text in (
+        ('renders', 'Number of books prepared for viewing in the browser'),
+        ('failed_renders', 'Number of books that could not be prepared for viewing in the browser'),
+        ('render_time', 'Total time spent preparing books for viewing in the browser'),
+        ('cache_hits', 'Number of times a book opened for viewing was already prepared'),
+        ('cache_misses', 'Number of times a book opened for viewing had to be prepared'),
+        ('cache_size', 'Size in bytes of the cache of books prepared for viewing'),
+        ('queued_renders', 'Number of books waiting to be prepared for viewing'),
+    ):
+        yield 'calibre_render_' + name, help_text, render_stat(name)
+    for name, help_text in (
+        ('conversions', 'Number of conversions run in worker processes'),
+        ('deduplicated', 'Number of conversion requests that waited for an identical running conversion'),
+        ('running_conversions', 'Number of conversions currently running'),
+        ('cache_hits', 'Number of conversion requests whose result was found in the cache'),
+        ('cache_misses', 'Number of conversion requests whose result was not found in the cache'),
+        ('cache_size', 'Size in bytes of the cache of converted books'),
+    ):
+        yield 'calibre_conversion_' + name, help_text, conversion_stat(name)
+
+
+@endpoint('/metrics', cache_control='no-cache')
+def metrics(ctx, rd):
+    '''
+    Return server performance metrics in the Prometheus text format. Only
+    available if the server was started with metrics enabled. Anonymous access
+    is only allowed from trusted IP addresses.
+    '''
+    if ctx.metrics is None:
+        raise HTTPNotFound('Metrics collection is not enabled')
+    if not rd.username and not rd.is_trusted_ip:
+        raise HTTPForbidden('Anonymous access to server metrics is not allowed')
+    rd.outheaders.set('Content-Type', PROMETHEUS_MIME, replace_all=True)
+    return ctx.metrics.as_prometheus_text(library_gauges(ctx)).encode('utf-8')
+
+
+def loop_gauges(metrics, loop):
+    metrics.add_gauge('calibre_server_workers_busy', 'Number of worker threads processing requests', lambda: loop.pool.busy)
+    metrics.add_gauge('calibre_server_workers_idle', 'Number of idle worker threads', lambda: loop.pool.idle)
+    metrics.add_gauge('calibre_server_request_queue_depth', 'Number of requests waiting for a worker thread', lambda: loop.pool.queue_depth)
+    metrics.add_gauge('calibre_server_connections', 'Number of open connections', lambda: loop.num_active_connections)
+    metrics.add_gauge('calibre_server_jobs_waiting', 'Number of jobs waiting for a worker process', lambda: loop.jobs_manager.queue_depth)
+    metrics.add_gauge('calibre_server_jobs_running', 'Number of jobs running in worker processes', lambda: loop.jobs_manager.num_running_jobs)
+
@@ -9,6 +9,7 @@ __docformat__ = 'restructuredtext en'
 import hashlib
 from collections import OrderedDict, namedtuple
 from functools import partial
+from itertools import chain
 from html5_parser import parse
 from lxml import etree
 from lxml.builder import ElementMaker
@@ -20,30 +21,43 @@ from calibre.ebooks.metadata import authors_to_string, fmt_sidx, rating_to_stars
 from calibre.library.comments import comments_to_html
 from calibre.srv.errors import HTTPInternalServerError, HTTPNotFound
 from calibre.srv.http_request import parse_uri
+from calibre.srv.http_response import ETaggedDynamicOutput, parse_if_none_match
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import Offsets, get_library_data, http_date
 from calibre.utils.config import prefs
 from calibre.utils.date import as_utc, is_date_undefined, timestampfromdt
 from calibre.utils.icu import sort_key
 from calibre.utils.search_query_parser import ParseException
+from calibre.utils.serialize import json_dumps
 from calibre.utils.xml_parse import safe_xml_fromstring
 from polyglot.binary import as_hex_unicode, from_hex_unicode
 from polyglot.builtins import as_bytes, filter, iteritems, unicode_type
 from polyglot.urllib import unquote_plus, urlencode
 
 
-def atom(ctx, rd, endpoint, output):
-    rd.outheaders.set('Content-Type', 'application/atom+xml; charset=UTF-8', replace_all=True)
-    rd.outheaders.set('Calibre-Instance-Id', force_unicode(prefs['installation_uuid'], 'utf-8'), replace_all=True)
+ATOM_MIME = 'application/atom+xml; charset=UTF-8'
+
+
+def serialize_feed(output):
     if isinstance(output, bytes):
         ans = output  # Assume output is already UTF-8 XML
     elif isinstance(output, unicode_type):
         ans = output.encode('utf-8')
+    elif isinstance(output, Feed):
+        ans = output.serialize()
     else:
         ans = etree.tostring(output, encoding='utf-8', xml_declaration=True, pretty_print=True)
     return ans
 
 
+def atom(ctx, rd, endpoint, output):
+    rd.outheaders.set('Content-Type', ATOM_MIME, replace_all=True)
+    rd.outheaders.set('Calibre-Instance-Id', force_unicode(prefs['installation_uuid'], 'utf-8'), replace_all=True)
+    if isinstance(output, ETaggedDynamicOutput):
+        return output
+    return serialize_feed(output)
+
+
 def format_tag_string(tags, sep, joinval=', '):
     if tags:
         tlist = tags if sep is None else [t.strip() for t in tags.split(sep)]
@@ -239,6 +253,30 @@ def ACQUISITION_ENTRY(book_id, updated, request_context):
     return ans
 
 
+def acquisition_entry(book_id, request_context):
+    ''' Return the serialized acquisition entry for the specified book. Entries
+    are cached until the book is next modified or any write to the library,
+    such as renaming or removing items, clears the search caches. '''
+    ctx, db = request_context.ctx, request_context.db
+    last_modified = db.field_for('last_modified', book_id)
+    state = last_modified, db.clear_search_cache_count
+    cache = ctx.library_broker.opds_entry_caches[db.server_library_id]
+    with ctx.lock:
+        cached = cache.pop(book_id, None)
+        hit = cached is not None and cached[0] == state
+        if hit:
+            cache[book_id] = cached
+    ctx.cache_lookup('opds_entry', hit)
+    if hit:
+        return cached[1]
+    ans = etree.tostring(ACQUISITION_ENTRY(book_id, last_modified, request_context), encoding='utf-8', pretty_print=True)
+    with ctx.lock:
+        cache[book_id] = state, ans
+        if len(cache) > ctx.OPDS_ENTRY_CACHE_SIZE:
+            cache.popitem(last=False)
+    return ans
+
+
 # }}}
 
 default_feed_title = __appname__ + ' ' + _('Library')
@@ -251,6 +289,7 @@ class Feed(object):  # {{{
             up_link=None, first_link=None, last_link=None,
             next_link=None, previous_link=None):
         self.base_href = request_context.url_for('/opds')
+        self.entries = []
 
         self.root = \
             FEED(
@@ -275,6 +314,15 @@ class Feed(object):  # {{{
         if subtitle:
             self.root.insert(1, SUBTITLE(subtitle))
 
+    def serialize(self):
+        ''' Serialize the feed, with the already serialized entries in
+        self.entries placed after the entries in self.root '''
+        ans = etree.tostring(self.root, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        if self.entries:
+            idx = ans.rindex(b'</feed>')
+            ans = b''.join(chain((ans[:idx],), self.entries, (ans[idx:],)))
+        return ans
+
     # }}}
 
 
@@ -328,8 +376,7 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+        self.entries = [acquisition_entry(book_id, request_context) for book_id in items]
 
 
 class CategoryFeed(NavFeed):
@@ -386,6 +433,22 @@ class RequestContext(object):
     def search(self, query):
         return self.ctx.search(self.rd, self.db, query)
 
+    def etagged_feed(self, generate, *args, **kwargs):
+        ''' Return the feed created by generate(*args, **kwargs) with an ETag
+        derived from the state of the library, the user and the requested URL,
+        so that clients that already have the current feed get a Not Modified
+        response without the feed being generated. '''
+        rd = self.rd
+        etag = json_dumps([
+            self.last_modified().isoformat(), self.db.clear_search_cache_count, rd.username,
+            self.library_id, force_unicode(rd.request_original_uri or '', 'utf-8')])
+        etag = '"%s"' % hashlib.sha1(etag).hexdigest()
+        if etag in parse_if_none_match(rd.inheaders.get('If-None-Match', '')):
+            data = b''
+        else:
+            data = serialize_feed(generate(*args, **kwargs))
+        return rd.etagged_dynamic_response(etag, lambda: data, content_type=ATOM_MIME)
+
 
 def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         sort_by='title', ascending=True, feed_title=None):
@@ -399,7 +462,7 @@ def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         items = items[offsets.offset:offsets.offset+max_items]
         lm = rc.last_modified()
         rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title)
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
@@ -462,13 +525,17 @@ def get_navcatalog(request_context, which, page_url, up_url, offset=0):
 
     request_context.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return ans.root
+    return ans
 
 
 @endpoint('/opds', postprocess=atom)
 def opds(ctx, rd):
     rc = RequestContext(ctx, rd)
-    db = rc.db
+    return rc.etagged_feed(get_top_level, rc)
+
+
+def get_top_level(rc):
+    db, rd = rc.db, rc.rd
     try:
         categories = rc.get_categories(report_parse_errors=True)
     except ParseException as p:
@@ -500,7 +567,7 @@ def opds(ctx, rd):
         cats.append((meta['name'], meta['name'], 'N'+category))
     last_modified = db.last_modified()
     rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return TopLevel(last_modified, cats, rc).root
+    return TopLevel(last_modified, cats, rc)
 
 
 @endpoint('/opds/navcatalog/{which}', postprocess=atom)
@@ -517,9 +584,9 @@ def opds_navcatalog(ctx, rd, which):
     type_ = which[0]
     which = which[1:]
     if type_ == 'O':
-        return get_all_books(rc, which, page_url, up_url, offset=offset)
+        return rc.etagged_feed(get_all_books, rc, which, page_url, up_url, offset=offset)
     elif type_ == 'N':
-        return get_navcatalog(rc, which, page_url, up_url, offset=offset)
+        return rc.etagged_feed(get_navcatalog, rc, which, page_url, up_url, offset=offset)
     raise HTTPNotFound('Not found')
 
 
@@ -533,6 +600,10 @@ def opds_category(ctx, rd, category, which):
     if not which or not category:
         raise HTTPNotFound('Not found')
     rc = RequestContext(ctx, rd)
+    return rc.etagged_feed(get_category_feed, rc, category, which, offset)
+
+
+def get_category_feed(rc, category, which, offset):
     page_url = rc.url_for('/opds/category', which=which, category=category)
     up_url = rc.url_for('/opds/navcatalog', which=category)
 
@@ -585,6 +656,10 @@ def opds_categorygroup(ctx, rd, category, which):
         raise HTTPNotFound('Not found')
 
     rc = RequestContext(ctx, rd)
+    return rc.etagged_feed(get_category_group_feed, rc, category, which, offset)
+
+
+def get_category_group_feed(rc, category, which, offset):
     categories = rc.get_categories()
     page_url = rc.url_for('/opds/categorygroup', category=category, which=which)
 
@@ -615,7 +690,7 @@ def opds_categorygroup(ctx, rd, category, which):
 
     rc.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title).root
+    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title)
 
 
 @endpoint('/opds/search/{query=""}', postprocess=atom)
@@ -631,6 +706,10 @@ def opds_search(ctx, rd, query):
         query = path[-1]
         if isinstance(query, bytes):
             query = query.decode('utf-8')
+    return rc.etagged_feed(get_search_feed, rc, query, offset)
+
+
+def get_search_feed(rc, query, offset):
     try:
         ids = rc.search(query)
     except Exception:
@@ -68,6 +68,20 @@ raw_options = (
     'worker_count', 10,
     None,
 
+    _('Maximum number of worker threads used to process requests'),
+    'max_worker_count', 20,
+    _('When all worker threads are busy, extra threads are started, up to this'
+      ' number, and stopped again once the load drops. Set to a number no larger'
+      ' than the number of worker threads to use a fixed number of threads.'),
+
+    _('Maximum number of simultaneous requests per client'),
+    'max_requests_per_client', 0,
+    _('Requests from a single client (IP address) beyond this number are'
+      ' processed only after its earlier requests complete, so that one'
+      ' client cannot monopolize the server. Zero means no limit. For'
+      ' connections from a reverse proxy on the same computer, the'
+      ' X-Forwarded-For header is used to identify the client.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -80,6 +94,47 @@ raw_options = (
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Max. size of the cache of books prepared for viewing (in MB)'),
+    'render_cache_size', 1024,
+    _('Books are prepared for reading in the browser the first time they are'
+      ' opened and kept in a cache. When the cache becomes larger than this size,'
+      ' the least recently read books are removed from it. Set to zero for no limit.'),
+
+    _('Max. size of the cache of converted books (in MB)'),
+    'conversion_cache_size', 256,
+    _('The results of conversions are kept in a cache, so that converting the same'
+      ' book again with the same settings is instant. When the cache becomes larger'
+      ' than this size, the least recently used results are removed from it. Set to'
+      ' zero to disable the cache.'),
+
+    _('Max. size of the cache of parsed input files for conversions (in MB)'),
+    'conversion_input_cache_size', 0,
+    _('The result of reading and parsing the book being converted is kept in a'
+      ' cache, so that converting the same book again to a different format or'
+      ' with different output settings is faster. When the cache becomes larger'
+      ' than this size, the least recently used books are removed from it. The'
+      ' default of zero means no cache is used.'),
+
+    _('Number of books to prepare for reading in advance'),
+    'prerender_books', 0,
+    _('Prepare this many of the most recently added and most read books for'
+      ' reading in the browser in advance, in the background, so that users do'
+      ' not have to wait when opening them. Books opened by users are always'
+      ' prepared first. Set to zero to disable.'),
+
+    _('Unload libraries that have not been used for (in minutes)'),
+    'library_idle_timeout', 0,
+    _('Libraries that have not been accessed for this long are removed from'
+      ' memory and loaded again when next needed. Useful when serving many'
+      ' libraries. Set to zero to keep all libraries in memory.'),
+
+    _('Max. memory for loaded libraries (in MB)'),
+    'max_library_memory', 0,
+    _('When the estimated memory used by the loaded libraries exceeds this'
+      ' amount, the least recently used libraries are removed from memory. The'
+      ' estimate is based on the size of the library databases. Set to zero for'
+      ' no limit.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
@@ -125,11 +180,32 @@ raw_options = (
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Use HTTP/2 when the browser supports it'),
+    'use_http2', False,
+    _('HTTP/2 allows browsers to make many requests to the server at the same time'
+    ' over a single connection, which makes pages that need many resources,'
+    ' such as the book list with its covers, load faster. HTTP/2 is only used'
+    ' over SSL connections, when the browser selects it during the SSL handshake,'
+    ' so you must also set the SSL certificate and key files.'),
+
+    _('Allow HTTP/2 without SSL'),
+    'use_h2c', False,
+    _('Allow clients that know in advance that the server supports HTTP/2 to use it'
+    ' over connections without SSL. Browsers never do this, it is only useful for'
+    ' other programs that connect to the server, such as reverse proxies.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
     ' than this size, it is automatically rotated. Set to zero to disable log rotation.'),
 
+    _('Collect performance metrics'),
+    'metrics', False,
+    _('Record request latencies per URL, worker thread and job queue usage, database'
+      ' lock contention, cache hit rates and bytes sent. The metrics are available'
+      ' in the Prometheus text format at the /metrics URL, to logged in users or'
+      ' to anonymous users connecting from trusted IP addresses.'),
+
     _('Log HTTP 404 (Not Found) requests'),
     'log_not_found', True,
     _('Normally, the server logs all HTTP requests for resources that are not found.'
@@ -181,6 +257,12 @@ raw_options = (
     _('Number of login failures for ban'), 'ban_after', 5,
     _('The number of login failures after which an IP address is banned'),
 
+    _('Lifetime of login sessions'), 'session_lifetime', 0,
+    _('The number of minutes for which a user stays logged in after a successful login.'
+      ' During this time, requests are authenticated using a signed session cookie,'
+      ' instead of checking the password on every request, which is faster.'
+      ' If set to zero, the password is checked on every request.'),
+
     _('Ignored user-defined metadata fields'),
     'ignored_fields', None,
     _('Comma separated list of user-defined metadata fields that will not be displayed'
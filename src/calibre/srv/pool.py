@@ -6,76 +6,188 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
-from threading import Thread
+from collections import Counter, defaultdict, deque, namedtuple
+from itertools import count as counter
+from threading import Condition, Thread
 
 from calibre.utils.monotonic import monotonic
 from polyglot.builtins import range
 from polyglot.queue import Queue, Full
 
+FAST, SLOW = 'fast', 'slow'
+# Jobs in the slow lane that have waited longer than this many seconds are
+# run before jobs in the fast lane, so that a steady stream of cheap requests
+# cannot starve expensive ones completely
+MAX_SLOW_LANE_WAIT = 1.0
+Job = namedtuple('Job', 'job_id func lane client queued_at')
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
-        self.notify_server = notify_server
-        self.log = log
+    def __init__(self, pool, num):
+        self.pool = pool
         self.working = False
+        self.starting = True
         Thread.__init__(self, name='ServerWorker%d' % num)
 
     def run(self):
+        pool = self.pool
         while True:
-            x = self.request_queue.get()
-            if x is None:
+            job = pool.get_job(self)
+            if job is None:
                 break
-            job_id, func = x
             self.working = True
             try:
-                result = func()
+                result = job.func()
             except Exception:
-                self.handle_error(job_id)  # must be a separate function to avoid reference cycles with sys.exc_info()
+                self.handle_error(job.job_id)  # must be a separate function to avoid reference cycles with sys.exc_info()
             else:
-                self.result_queue.put((job_id, True, result))
+                pool.result_queue.put((job.job_id, True, result))
             finally:
                 self.working = False
+                pool.job_finished(job)
             try:
-                self.notify_server()
+                pool.notify_server()
             except Exception:
-                self.log.exception('ServerWorker failed to notify server on job completion')
+                pool.log.exception('ServerWorker failed to notify server on job completion')
 
     def handle_error(self, job_id):
-        self.result_queue.put((job_id, False, sys.exc_info()))
+        self.pool.result_queue.put((job_id, False, sys.exc_info()))
 
 
 class ThreadPool(object):
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    '''
+    A pool of worker threads that starts with count threads and grows up to
+    max_count threads when requests would otherwise have to wait for a free
+    thread. Threads in excess of count exit after being idle for idle_timeout
+    seconds.
+
+    Requests are queued in one of two lanes. Requests in the slow lane are
+    never allowed to occupy more than three quarters of max_count threads, and
+    requests in the fast lane are preferred, so that cheap requests are
+    served promptly even when the server is busy with expensive ones.
+
+    If per_client_limit is non-zero, requests from a single client beyond
+    that many concurrent requests are held back until one of its earlier
+    requests completes, so that one client cannot monopolize the server. '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=0, per_client_limit=0, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.min_count = max(1, count)
+        self.max_count = max(self.min_count, max_count)
+        self.slow_limit = max(1, self.max_count - max(1, self.max_count // 4))
+        self.queue_size, self.per_client_limit, self.idle_timeout = queue_size, per_client_limit, idle_timeout
+        self.result_queue = Queue()
+        self.job_available = Condition()
+        self.lanes = {FAST: deque(), SLOW: deque()}
+        self.running = {FAST: 0, SLOW: 0}
+        self.held, self.num_held = defaultdict(deque), 0
+        self.active_per_client = Counter()
+        self.num_waiting = self.num_starting = 0
+        self.workers = []
+        self.worker_num = counter()
+        self.started = self.shutting_down = False
 
     def start(self):
-        for w in self.workers:
-            w.start()
+        with self.job_available:
+            self.started = True
+            for i in range(self.min_count):
+                self.spawn_worker()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def spawn_worker(self):
+        w = Worker(self, next(self.worker_num))
+        self.workers.append(w)
+        self.num_starting += 1
+        w.start()
+
+    @property
+    def runnable(self):
+        ans = len(self.lanes[FAST])
+        if self.running[SLOW] < self.slow_limit:
+            ans += len(self.lanes[SLOW])
+        return ans
+
+    def enqueue(self, job):
+        self.lanes[job.lane].append(job)
+        if self.started and not self.shutting_down and self.runnable > self.num_waiting + self.num_starting and len(self.workers) < self.max_count:
+            self.spawn_worker()
+        self.job_available.notify()
+
+    def put_nowait(self, job_id, func, lane=FAST, client=None):
+        job = Job(job_id, func, lane, client, monotonic())
+        with self.job_available:
+            if len(self.lanes[FAST]) + len(self.lanes[SLOW]) + self.num_held >= self.queue_size:
+                raise Full()
+            if client is not None and self.per_client_limit > 0:
+                if self.active_per_client[client] >= self.per_client_limit:
+                    self.held[client].append(job)
+                    self.num_held += 1
+                    return
+                self.active_per_client[client] += 1
+            self.enqueue(job)
+
+    def next_job(self):
+        fast, slow = self.lanes[FAST], self.lanes[SLOW]
+        if slow and self.running[SLOW] < self.slow_limit and (not fast or monotonic() - slow[0].queued_at > MAX_SLOW_LANE_WAIT):
+            return slow.popleft()
+        if fast:
+            return fast.popleft()
+
+    def get_job(self, worker):
+        with self.job_available:
+            if worker.starting:
+                worker.starting = False
+                self.num_starting -= 1
+            timed_out = False
+            while not self.shutting_down:
+                job = self.next_job()
+                if job is not None:
+                    self.running[job.lane] += 1
+                    return job
+                if timed_out and len(self.workers) > self.min_count:
+                    self.workers.remove(worker)
+                    return
+                self.num_waiting += 1
+                try:
+                    timed_out = not self.job_available.wait(self.idle_timeout)
+                finally:
+                    self.num_waiting -= 1
+
+    def job_finished(self, job):
+        with self.job_available:
+            self.running[job.lane] -= 1
+            client = job.client
+            if client is not None and self.per_client_limit > 0:
+                held = self.held.get(client)
+                if held:
+                    self.num_held -= 1
+                    self.enqueue(held.popleft())
+                    if not held:
+                        del self.held[client]
+                else:
+                    self.active_per_client[client] -= 1
+                    if self.active_per_client[client] < 1:
+                        del self.active_per_client[client]
+            if self.lanes[SLOW]:
+                self.job_available.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.job_available:
+            self.shutting_down = True
+            self.job_available.notify_all()
+            workers = list(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        self.workers = [w for w in workers if w.is_alive()]
 
     @property
     def busy(self):
@@ -85,6 +197,11 @@ class ThreadPool(object):
     def idle(self):
         return sum(int(not w.working) for w in self.workers)
 
+    @property
+    def queue_depth(self):
+        with self.job_available:
+            return len(self.lanes[FAST]) + len(self.lanes[SLOW]) + self.num_held
+
 
 class PluginPool(object):
 
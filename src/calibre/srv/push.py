@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+import json
+import os
+from collections import defaultdict, namedtuple
+from threading import Condition, Thread
+
+from calibre.srv.changes import (
+    BooksAdded, BooksDeleted, FormatsAdded, FormatsRemoved, MetadataChanged,
+    SavedSearchesChanged
+)
+from calibre.srv.routes import endpoint, json as json_output
+from calibre.srv.utils import get_db
+from calibre.srv.web_socket import POLICY_VIOLATION
+from calibre.utils.monotonic import monotonic
+from calibre.utils.search_query_parser import ParseException
+from polyglot.binary import as_hex_unicode
+from polyglot.builtins import iteritems, itervalues
+
+COALESCE_DELAY = 0.5
+TOKEN_LIFETIME = 60
+SUBSCRIBE_TIMEOUT = 10
+MAX_MESSAGE_SIZE = 4096
+Subscriber = namedtuple('Subscriber', 'username')
+
+
+class PendingChanges(object):
+
+    ''' All changes to a library since notifications were last sent, with
+    redundant changes merged. '''
+
+    def __init__(self):
+        self.added, self.deleted, self.metadata = set(), set(), set()
+        self.formats_added, self.formats_removed = defaultdict(set), defaultdict(set)
+        self.saved_searches_changed = False
+
+    def merge(self, event):
+        if isinstance(event, BooksAdded):
+            self.added |= event.book_ids
+            self.deleted -= event.book_ids
+        elif isinstance(event, BooksDeleted):
+            # Books that were both added and deleted are of no interest to clients
+            self.deleted |= event.book_ids - self.added
+            self.added -= event.book_ids
+            self.metadata -= event.book_ids
+            for book_id in event.book_ids:
+                self.formats_added.pop(book_id, None), self.formats_removed.pop(book_id, None)
+        elif isinstance(event, MetadataChanged):
+            self.metadata |= event.book_ids
+        elif isinstance(event, FormatsAdded):
+            for book_id, fmts in iteritems(event.formats_map):
+                fmts = {x.upper() for x in fmts}
+                self.formats_added[book_id] |= fmts
+                self.formats_removed[book_id] -= fmts
+        elif isinstance(event, FormatsRemoved):
+            for book_id, fmts in iteritems(event.formats_map):
+                fmts = {x.upper() for x in fmts}
+                self.formats_removed[book_id] |= fmts
+                self.formats_added[book_id] -= fmts
+        elif isinstance(event, SavedSearchesChanged):
+            self.saved_searches_changed = True
+
+    def as_dict(self, library_id, allowed_book_ids=None):
+        ''' The changes as a JSON serializable dict, with books not in
+        allowed_book_ids, if specified, removed. Deleted books are not
+        filtered as they are no longer in the library. '''
+        def ids(x):
+            if allowed_book_ids is not None:
+                x = x & allowed_book_ids
+            return sorted(x)
+
+        def fmap(x):
+            return {str(book_id): sorted(fmts) for book_id, fmts in iteritems(x) if fmts and (
+                allowed_book_ids is None or book_id in allowed_book_ids)}
+
+        ans = {
+            'library_id': library_id, 'books_added': ids(self.added), 'books_deleted': sorted(self.deleted),
+            'metadata_changed': ids(self.metadata - self.added), 'formats_added': fmap(self.formats_added),
+            'formats_removed': fmap(self.formats_removed), 'saved_searches_changed': self.saved_searches_changed,
+        }
+        if ans['books_added'] or ans['books_deleted'] or ans['metadata_changed'] or ans['formats_added'] or (
+                ans['formats_removed'] or ans['saved_searches_changed']):
+            return ans
+
+
+class Subscription(object):
+
+    def __init__(self, connection_ref):
+        self.connection_ref = connection_ref
+        self.username = self.library_id = None
+        self.buf = []
+        self.created_at = monotonic()
+
+    @property
+    def connection(self):
+        ans = self.connection_ref()
+        if ans is not None and ans.ready:
+            return ans
+
+
+class ChangeNotifier(Thread):
+
+    '''
+    Pushes changes to libraries, as reported via Context.notify_changes(), to
+    clients over WebSockets. A client first gets a token from the
+    /changes/token endpoint, which authenticates it, then sends the token as
+    the first message on the WebSocket. Connections that send an invalid token
+    or do not subscribe within SUBSCRIBE_TIMEOUT seconds are closed. Changes
+    are coalesced for COALESCE_DELAY seconds and sent as a single JSON message,
+    containing only the books the user is allowed to see. Used as the
+    WebSocket handler of the server.
+    '''
+
+    daemon = True
+
+    def __init__(self, ctx, delay=COALESCE_DELAY, subscribe_timeout=SUBSCRIBE_TIMEOUT):
+        Thread.__init__(self, name='ChangeNotifier')
+        self.ctx, self.delay, self.subscribe_timeout = ctx, delay, subscribe_timeout
+        self.lock = Condition()
+        self.subscriptions = {}
+        self.tokens = {}
+        self.pending = {}
+        self.keep_going = True
+
+    # Internal API {{{
+    def run(self):
+        while True:
+            with self.lock:
+                expired, timeout = self.expire_subscriptions()
+                while self.keep_going and not self.pending and not expired:
+                    self.lock.wait(timeout)
+                    expired, timeout = self.expire_subscriptions()
+                if not self.keep_going:
+                    break
+                if self.pending:
+                    # Wait for more changes, so that bursts result in a single
+                    # message
+                    self.lock.wait(self.delay)
+                    if not self.keep_going:
+                        break
+                pending, self.pending = self.pending, {}
+                subscriptions = tuple(itervalues(self.subscriptions))
+            self.close_unsubscribed(expired)
+            for library_id, changes in iteritems(pending):
+                try:
+                    self.send_changes(library_id, changes, [s for s in subscriptions if s.library_id == library_id])
+                except Exception:
+                    if self.ctx.log is not None:
+                        self.ctx.log.exception('Failed to send change notifications')
+
+    def expire_subscriptions(self):
+        ''' Remove the subscriptions whose connections have not subscribed
+        within subscribe_timeout seconds. Returns them and the time until the
+        next one expires, if any. Must be called with the lock held. '''
+        now, expired, timeout = monotonic(), [], None
+        for connection_id, s in tuple(iteritems(self.subscriptions)):
+            if s.library_id is None:
+                remaining = s.created_at + self.subscribe_timeout - now
+                if remaining <= 0:
+                    expired.append(self.subscriptions.pop(connection_id))
+                elif timeout is None or remaining < timeout:
+                    timeout = remaining
+        return expired, timeout
+
+    def close_unsubscribed(self, subscriptions):
+        for s in subscriptions:
+            conn = s.connection_ref()
+            if conn is not None:
+                conn.websocket_close(POLICY_VIOLATION, 'No token received')
+                conn.wakeup()
+
+    def allowed_book_ids(self, db, username):
+        try:
+            return self.ctx.get_allowed_book_ids_from_restriction(Subscriber(username), db)
+        except ParseException:
+            return frozenset()
+
+    def send_changes(self, library_id, changes, subscriptions):
+        db = self.ctx.library_broker.get(library_id)
+        if db is None:
+            return
+        messages = {}
+        for s in subscriptions:
+            conn = s.connection
+            if conn is None:
+                continue
+            msg = messages.get(s.username, False)
+            if msg is False:
+                msg = changes.as_dict(library_id, self.allowed_book_ids(db, s.username))
+                messages[s.username] = msg = None if msg is None else json.dumps(msg)
+            if msg is not None:
+                conn.send_websocket_message(msg)
+
+    def subscribe(self, connection_id, token):
+        now = monotonic()
+        with self.lock:
+            for t, (username, library_id, expires_at) in tuple(iteritems(self.tokens)):
+                if expires_at < now:
+                    del self.tokens[t]
+            s = self.subscriptions.get(connection_id)
+            if s is None or token not in self.tokens:
+                return
+            s.username, s.library_id = self.tokens.pop(token)[:2]
+            return s
+    # }}}
+
+    def create_token(self, username, library_id):
+        ''' Create a token that can be used, once, to subscribe to changes in
+        the specified library as the specified user. '''
+        token = as_hex_unicode(os.urandom(16))
+        with self.lock:
+            self.tokens[token] = username, library_id, monotonic() + TOKEN_LIFETIME
+        return token
+
+    def notify(self, library_path, change_event):
+        library_id = self.ctx.library_broker.library_id_for_path(library_path)
+        if library_id is None:
+            return
+        with self.lock:
+            if not any(s.library_id == library_id for s in itervalues(self.subscriptions)):
+                return
+            changes = self.pending.get(library_id)
+            if changes is None:
+                changes = self.pending[library_id] = PendingChanges()
+                self.lock.notify()
+            changes.merge(change_event)
+
+    def stop(self):
+        with self.lock:
+            self.keep_going = False
+            self.lock.notify()
+
+    # WebSocket handler API {{{
+    def handle_websocket_upgrade(self, connection_id, connection_ref, inheaders):
+        with self.lock:
+            self.subscriptions[connection_id] = Subscription(connection_ref)
+            if not self.is_alive() and self.keep_going:
+                self.start()
+            # Wake up the thread so that it closes the connection if it does
+            # not subscribe in time
+            self.lock.notify()
+
+    def handle_websocket_data(self, connection_id, data, message_starting, message_finished):
+        with self.lock:
+            s = self.subscriptions.get(connection_id)
+            if s is None:
+                return
+            if isinstance(data, memoryview):
+                data = data.tobytes().decode('utf-8', 'replace')
+            s.buf.append(data)
+            size = sum(map(len, s.buf))
+            if not message_finished and size <= MAX_MESSAGE_SIZE:
+                return
+            msg, s.buf = ''.join(s.buf), []
+        conn = s.connection
+        if conn is None:
+            return
+        if size > MAX_MESSAGE_SIZE:
+            return conn.websocket_close(POLICY_VIOLATION, 'Message too large')
+        try:
+            token = json.loads(msg)['token']
+        except Exception:
+            token = None
+        if s.library_id is not None:
+            return
+        if not token or self.subscribe(connection_id, token) is None:
+            return conn.websocket_close(POLICY_VIOLATION, 'Invalid or expired token')
+        conn.send_websocket_message(json.dumps({'subscribed': s.library_id}))
+
+    def handle_websocket_pong(self, connection_id, data):
+        pass
+
+    def handle_websocket_close(self, connection_id):
+        with self.lock:
+            self.subscriptions.pop(connection_id, None)
+    # }}}
+
+
+@endpoint('/changes/token/{library_id=None}', postprocess=json_output, cache_control='no-cache')
+def changes_token(ctx, rd, library_id):
+    '''
+    Return a token that can be used to subscribe to notifications of changes to
+    the specified library, over a WebSocket connection to the server. Send the
+    token as the first message on the connection, in the form:
+    {"token": token}. Tokens are valid for a single use within one minute.
+    '''
+    db = get_db(ctx, rd, library_id)
+    library_id = db.server_library_id
+    return {'token': ctx.change_notifier.create_token(rd.username, library_id), 'library_id': library_id}
+
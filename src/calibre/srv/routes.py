@@ -9,7 +9,8 @@ import sys, inspect, re, time, numbers, json as jsonlib, textwrap
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
-from calibre.srv.utils import http_date
+from calibre.srv.utils import http_date, RawJSON
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 from polyglot.builtins import iteritems, itervalues, unicode_type, range, zip, filter
 from polyglot import http_client
@@ -18,10 +19,24 @@ from polyglot.urllib import quote as urlquote
 default_methods = frozenset(('HEAD', 'GET'))
 
 
+def json_dumps_with_raw(output):
+    raw = [(k, v) for k, v in iteritems(output) if isinstance(v, RawJSON)]
+    ans = json_dumps({k: v for k, v in iteritems(output) if not isinstance(v, RawJSON)})
+    parts = [ans[:-1]]
+    for k, v in raw:
+        if len(parts) > 1 or ans != b'{}':
+            parts.append(b', ')
+        parts.extend((json_dumps(k), b': ', v.data))
+    parts.append(b'}')
+    return b''.join(parts)
+
+
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
     if isinstance(output, bytes) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
+    elif isinstance(output, dict) and any(isinstance(v, RawJSON) for v in itervalues(output)):
+        ans = json_dumps_with_raw(output)
     else:
         ans = json_dumps(output)
     return ans
@@ -231,6 +246,7 @@ class Router(object):
         self.auth_controller = auth_controller
         self.init_session = getattr(ctx, 'init_session', lambda ep, data:None)
         self.finalize_session = getattr(ctx, 'finalize_session', lambda ep, data, output:None)
+        self.end_session = getattr(ctx, 'end_session', lambda ep, data:None)
         self.endpoints = set()
         if endpoints is not None:
             self.load_routes(endpoints)
@@ -295,7 +311,26 @@ class Router(object):
                         c[k] = v.strip('"')
 
     def dispatch(self, data):
+        metrics = getattr(self.ctx, 'metrics', None)
+        if metrics is None:
+            return self._dispatch(data)
+        st = monotonic()
+        route, status = 'unmatched', http_client.INTERNAL_SERVER_ERROR
+        try:
+            ans = self._dispatch(data)
+            status = data.status_code
+            return ans
+        except HTTPSimpleResponse as e:
+            status = e.http_code
+            raise
+        finally:
+            route = getattr(data, 'endpoint_route', route)
+            metrics.inc('calibre_server_requests_total', route=route, status=status)
+            metrics.observe('calibre_server_request_duration_seconds', monotonic() - st, route=route)
+
+    def _dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
+        data.endpoint_route = endpoint_.route
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http_client.METHOD_NOT_ALLOWED)
 
@@ -308,10 +343,13 @@ class Router(object):
             data.status_code = endpoint_.ok_code
 
         self.init_session(endpoint_, data)
-        if endpoint_.needs_db_write:
-            self.ctx.check_for_write_access(data)
-        ans = endpoint_(self.ctx, data, *args)
-        self.finalize_session(endpoint_, data, ans)
+        try:
+            if endpoint_.needs_db_write:
+                self.ctx.check_for_write_access(data)
+            ans = endpoint_(self.ctx, data, *args)
+            self.finalize_session(endpoint_, data, ans)
+        finally:
+            self.end_session(endpoint_, data)
         outheaders = data.outheaders
 
         pp = endpoint_.postprocess
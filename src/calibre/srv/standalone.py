@@ -77,13 +77,14 @@ class Server(object):
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, websocket_handler=self.handler.ctx.change_notifier),
             opts=opts,
             log=log,
             access_log=access_log,
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
+        self.handler.set_metrics(self.loop.metrics)
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -5,7 +5,7 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import zlib, json, os
+import zlib, json, os, shutil, time
 from io import BytesIO
 from functools import partial
 
@@ -155,9 +155,369 @@ class ContentTest(LibraryBaseTest):
             ok(url_for('/get', what='thumb', book_id=1))
             nf(url_for('/get', what='thumb', book_id=3))
 
+            # Restrictions are evaluated once per change to the library, not once per request
+            searches = []
+            orig_search = db.search
+            db.search = lambda *a, **kw: searches.append(kw.get('restriction')) or orig_search(*a, **kw)
+            server.handler.ctx.library_broker.restriction_caches.clear()
+            try:
+                for i in range(3):
+                    ok(url_for('/get', what='thumb', book_id=1))
+                    ok(url_for('/ajax/book', book_id=2))
+                ae(sum(1 for x in searches if x), 1)
+                db.set_field('tags', {2: ['changed']})
+                ok(url_for('/get', what='thumb', book_id=2))
+                nf(url_for('/get', what='thumb', book_id=3))
+                ae(sum(1 for x in searches if x), 2)
+            finally:
+                del db.search
+
             # Not going test legacy and opds as they are too painful
     # }}}
 
+    def test_srv_metrics(self):  # {{{
+        'Test the /metrics endpoint'
+        with self.create_server() as server:
+            conn = server.connect()
+            r, data = make_request(conn, '/metrics', prefix='')
+            self.ae(r.status, NOT_FOUND)
+        with self.create_server(metrics=True, auth=True, auth_mode='basic') as server:
+            server.handler.ctx.user_manager.add_user('12', 'test')
+            conn = server.connect()
+            r, data = make_request(conn, '/ajax/book/1', prefix='', username='12', password='test')
+            self.ae(r.status, OK)
+            r, data = make_request(conn, '/metrics', prefix='', headers={})
+            self.ae(r.status, 401)
+            r, data = make_request(conn, '/metrics', prefix='', username='12', password='test')
+            self.ae(r.status, OK)
+            self.assertTrue(r.getheader('Content-Type').startswith('text/plain; version=0.0.4'))
+            data = data.decode('utf-8')
+            self.assertIn('calibre_server_requests_total{route="/ajax/book/{book_id}/{library_id=None}",status="200"} 1', data)
+            self.assertIn('calibre_server_request_duration_seconds_count{route="/ajax/book/{book_id}/{library_id=None}"} 1', data)
+            self.assertIn('calibre_server_workers_busy 1', data)
+            self.assertIn('calibre_db_lock_waits{library=', data)
+            self.assertIn('# TYPE calibre_server_bytes_sent_total counter', data)
+    # }}}
+
+    def test_library_unloading(self):  # {{{
+        'Test unloading of idle libraries'
+        from calibre.srv.library_broker import LibraryBroker
+        other_path = self.mkdtemp()
+        self.create_db(other_path)
+        broker = LibraryBroker((self.library_path, other_path), idle_timeout=300)
+        try:
+            lids = tuple(broker.lmap)
+            db = broker.get(lids[1])
+            broker.search_caches[lids[1]]['x'] = 1
+            broker.prune_loaded_dbs()
+            self.assertIs(broker.get(lids[1]), db)
+            broker.last_used_times[lids[1]] -= 301
+            broker.prune_loaded_dbs()
+            self.assertNotIn(lids[1], broker.loaded_dbs)
+            self.assertNotIn(lids[1], broker.search_caches)
+            db = broker.get(lids[1])
+            self.ae(db.field_for('title', 1), 'Title Two')
+            # Libraries that are in use are never unloaded
+            self.assertIs(broker.acquire(lids[1]), db)
+            broker.last_used_times[lids[1]] -= 301
+            broker.prune_loaded_dbs()
+            self.assertIs(broker.loaded_dbs[lids[1]], db)
+            # Releasing a library counts as using it
+            broker.release(lids[1])
+            broker.prune_loaded_dbs()
+            self.assertIs(broker.loaded_dbs[lids[1]], db)
+            broker.last_used_times[lids[1]] -= 301
+            broker.prune_loaded_dbs()
+            self.assertNotIn(lids[1], broker.loaded_dbs)
+            db = broker.get(lids[1])
+            broker.idle_timeout, broker.memory_budget = 0, 1
+            broker.acquire(lids[0])
+            broker.prune_loaded_dbs()
+            # Recently used libraries are not unloaded
+            self.ae(set(broker.loaded_dbs), set(lids))
+            broker.last_used_times[lids[0]] -= 120
+            broker.last_used_times[lids[1]] -= 100
+            broker.prune_loaded_dbs()
+            self.ae(set(broker.loaded_dbs), {lids[0]})
+            broker.release(lids[0])
+            broker.last_used_times[lids[0]] -= 120
+            broker.prune_loaded_dbs()
+            self.ae(set(broker.loaded_dbs), set())
+        finally:
+            broker.close()
+
+        # Libraries are in use until the requests using them are finished
+        with self.create_server() as server:
+            ctx, conn = server.handler.ctx, server.connect()
+            broker = ctx.library_broker
+
+            class RD(object):
+                username = None
+
+            rd = RD()
+            ctx.init_session(None, rd)
+            db = ctx.get_library(rd)
+            self.ae(dict(broker.users), {db.server_library_id: 1})
+            ctx.end_session(None, rd)
+            self.ae(dict(broker.users), {})
+            r, data = make_request(conn, '/book/1')
+            self.ae(r.status, OK)
+            self.ae(dict(broker.users), {})
+    # }}}
+
+    def test_book_json_cache(self):  # {{{
+        'Test caching of serialized book metadata'
+        from calibre.srv.metadata import book_as_json, books_as_json, book_json_caches
+        from calibre.srv.routes import json_dumps_with_raw
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            raw = books_as_json(db, (2, 1, 2, 1000))
+            data = json.loads(raw.data)
+            self.ae(list(data), ['2', '1'])
+            self.ae(data['1'], json.loads(json.dumps(book_as_json(db, 1))))
+            cache = book_json_caches[db]
+            self.ae(set(cache), {1, 2})
+            cached = cache[1][1]
+            books_as_json(db, (1,))
+            self.assertIs(cache[1][1], cached)
+            db.set_field('title', {1: 'changed'})
+            self.ae(json.loads(books_as_json(db, (1,)).data)['1']['title'], 'changed')
+            tags = db.field_for('tags', 1)
+            self.assertTrue(tags)
+            tag_id = db.get_item_id('tags', tags[0])
+            db.rename_items('tags', {tag_id: 'renamed tag'})
+            self.assertIn('renamed tag', json.loads(books_as_json(db, (1,)).data)['1']['tags'])
+            db.remove_items('tags', (tag_id,))
+            self.assertNotIn('renamed tag', json.loads(books_as_json(db, (1,)).data)['1']['tags'])
+            self.ae(json.loads(json_dumps_with_raw({'a': 1, 'metadata': raw})), {'a': 1, 'metadata': data})
+            self.ae(json.loads(json_dumps_with_raw({'metadata': raw})), {'metadata': data})
+            conn = server.connect()
+            r, data = make_request(conn, '/interface-data/get-books?num=2', prefix='')
+            self.ae(r.status, OK)
+            self.ae(set(data['metadata']), {'%d' % x for x in data['search_result']['book_ids']})
+    # }}}
+
+    def test_book_render_cache(self):  # {{{
+        'Test queueing of book renders and eviction of rendered books'
+        from calibre.srv import books
+        cache_dir = self.mkdtemp()
+        for x in 'sf':
+            os.mkdir(os.path.join(cache_dir, x))
+        orig = books._books_cache_dir, books._final_cache_sizes, books.render_stats.copy()
+        books._books_cache_dir, books._final_cache_sizes = cache_dir, None
+        books.queued_jobs.clear(), books.failed_jobs.clear(), books.background_jobs.clear()
+        try:
+            with self.create_server() as server:
+                ctx = server.handler.router.ctx
+                db = ctx.library_broker.get(None)
+                library_id = db.server_library_id
+                started, raised = [], []
+
+                def start_job(name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, priority=0):
+                    started.append(priority)
+                    return len(started)
+
+                ctx.start_job, ctx.job_status = start_job, lambda job_id: ('waiting', None, None, False)
+                ctx.raise_job_priority = lambda job_id, priority: raised.append((job_id, priority))
+                conn = server.connect()
+
+                def manifest(book_id=1):
+                    r, data = make_request(conn, '/book-manifest/%d/EPUB' % book_id, prefix='')
+                    self.ae(r.status, OK)
+                    return data
+
+                # Polling for a book that is being rendered does not queue
+                # another job or count as another read
+                misses, reads = books.render_stats['cache_misses'], books.read_counts[library_id][1]
+                for i in range(3):
+                    self.ae(manifest()['job_id'], 1)
+                self.ae(started, [0])
+                self.ae(books.render_stats['cache_misses'], misses + 1)
+                self.ae(books.read_counts[library_id][1], reads + 1)
+
+                # Opening a book that is being prerendered raises the
+                # priority of the background job
+                books.queued_jobs.clear()
+                fm = db.format_metadata(1, 'EPUB', allow_cache=False)
+                size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+                bhash = books.book_hash(db.library_id, 1, 'EPUB', size, mtime)
+                job_id = books.queue_job(ctx, lambda f: None, bhash, 'EPUB', 1, size, mtime, priority=books.RENDER_PRIORITY_BACKGROUND)
+                self.ae(started, [0, books.RENDER_PRIORITY_BACKGROUND])
+                self.ae(manifest()['job_id'], job_id)
+                manifest()
+                self.ae(raised, [(job_id, books.RENDER_PRIORITY_INTERACTIVE)])
+                self.ae(len(started), 2)
+                self.assertNotIn(bhash, books.background_jobs)
+                self.ae(books.render_stats['cache_misses'], misses + 2)
+
+                # Rendered books are served from the cache
+                books.queued_jobs.clear()
+                os.mkdir(os.path.join(cache_dir, 'f', bhash))
+                with open(os.path.join(cache_dir, 'f', bhash, 'calibre-book-manifest.json'), 'w') as f:
+                    json.dump({'spine': []}, f)
+                hits = books.render_stats['cache_hits']
+                data = manifest()
+                self.ae(data['spine'], [])
+                self.ae(data['metadata']['title'], db.field_for('title', 1))
+                self.ae(books.render_stats['cache_hits'], hits + 1)
+                self.ae(len(started), 2)
+        finally:
+            books._books_cache_dir, books._final_cache_sizes = orig[:2]
+            books.render_stats.update(orig[2])
+            books.queued_jobs.clear(), books.failed_jobs.clear(), books.background_jobs.clear()
+
+        # Least recently used books are evicted first
+        books._books_cache_dir, books._final_cache_sizes = cache_dir, None
+        try:
+            now = time.time()
+            shutil.rmtree(os.path.join(cache_dir, 'f'))
+            os.mkdir(os.path.join(cache_dir, 'f'))
+            for i, bhash in enumerate('abcd'):
+                os.mkdir(os.path.join(cache_dir, 'f', bhash))
+                mpath = os.path.join(cache_dir, 'f', bhash, 'calibre-book-manifest.json')
+                with open(mpath, 'wb') as f:
+                    f.write(b'x' * 100)
+                atime = now - (10 - i) * 60
+                os.utime(mpath, (atime, atime))
+            os.utime(os.path.join(cache_dir, 'f', 'a', 'calibre-book-manifest.json'), None)
+            evictions = books.render_stats['evictions']
+            books.clean_final(250)
+            self.ae(set(os.listdir(os.path.join(cache_dir, 'f'))), {'a', 'd'})
+            self.ae(books.final_cache_sizes(), {'a': 100, 'd': 100})
+            self.ae(books.render_stats['evictions'], evictions + 2)
+            books.clean_final(max_age=60)
+            self.ae(set(os.listdir(os.path.join(cache_dir, 'f'))), {'a'})
+        finally:
+            books._books_cache_dir, books._final_cache_sizes = orig[:2]
+            books.render_stats.update(orig[2])
+    # }}}
+
+    def test_bulk_metadata(self):  # {{{
+        'Test fetching metadata for many books at once'
+        from calibre.srv.metadata import book_as_json
+        from calibre.utils.date import isoformat, utcnow
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def request(query='', method='GET', data=None, headers={}):
+                # The output is newline delimited JSON, so it is not decoded
+                # by make_request()
+                conn.request(method, '/interface-data/bulk-metadata' + query, headers=headers, body=data)
+                r = conn.getresponse()
+                return r, r.read()
+
+            def bulk(query='', **kw):
+                r, data = request(query, **kw)
+                self.ae(r.status, OK)
+                self.ae(r.getheader('Content-Type'), 'application/x-ndjson; charset=UTF-8')
+                if r.getheader('Content-Encoding') == 'gzip':
+                    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                lines = [json.loads(x) for x in data.decode('utf-8').splitlines()]
+                return lines[0], {x['id']: x for x in lines[1:]}
+
+            header, books = bulk()
+            all_ids = sorted(db.all_book_ids())
+            self.ae(header['book_ids'], all_ids)
+            self.ae(sorted(books), all_ids)
+            self.ae(books[1]['metadata'], json.loads(json.dumps(book_as_json(db, 1))))
+            self.assertNotIn('thumbnail', books[1])
+            self.ae(sorted(bulk('?ids=2,1,1000')[1]), [1, 2])
+            self.ae(sorted(bulk(method='POST', data=json.dumps({'ids': [2]}))[1]), [2])
+            header, books = bulk('?ids=1,2&thumbnail=60x80', headers={'Accept-Encoding': 'gzip'})
+            self.ae(set(books), {1, 2})
+            for book_id, x in books.items():
+                self.ae('thumbnail' in x, db.new_api.cover_last_modified(book_id) is not None)
+            # Incremental sync
+            since = header['timestamp']
+            self.ae(bulk('?since=' + quote(since))[1], {})
+            db.new_api.set_field('title', {2: 'changed'})
+            header, books = bulk('?since=' + quote(since))
+            self.ae(list(books), [2])
+            self.ae(books[2]['metadata']['title'], 'changed')
+            self.ae(bulk('?since=' + quote(isoformat(utcnow())))[1], {})
+            self.ae(request('?since=xxx')[0].status, 400)
+            # Unchanged results are not generated again
+            from calibre.srv import code
+            r, data = request('?ids=1,2')
+            etag = r.getheader('ETag')
+            self.assertTrue(etag)
+            orig, serialized = code.serialized_book_as_json, []
+            code.serialized_book_as_json = lambda db, book_id: serialized.append(book_id) or orig(db, book_id)
+            try:
+                self.ae(request('?ids=1,2', headers={'If-None-Match': etag})[0].status, 304)
+                self.ae(serialized, [])
+                db.new_api.set_field('title', {1: 'changed again'})
+                self.ae(request('?ids=1,2', headers={'If-None-Match': etag})[0].status, OK)
+                self.ae(serialized, [1, 2])
+            finally:
+                code.serialized_book_as_json = orig
+    # }}}
+
+    def test_change_notifications(self):  # {{{
+        'Test pushing of library changes to clients over WebSockets'
+        from calibre.srv.changes import books_added, books_deleted, formats_added, metadata
+        from calibre.srv.tests.web_sockets import WSClient
+        from calibre.srv.web_socket import CLOSE
+        with self.create_server(auth=True, auth_mode='basic') as server:
+            ctx = server.handler.ctx
+            db = ctx.library_broker.get(None)
+            library_path = db.backend.library_path
+            ctx.user_manager.add_user('all', 'test')
+            ctx.user_manager.add_user('12', 'test', restriction={
+                'library_restrictions':{os.path.basename(library_path): 'id:1 or id:2'}})
+            ctx.change_notifier.delay = 0.1
+            ctx.change_notifier.subscribe_timeout = 1
+            conn = server.connect()
+
+            def next_message(client):
+                return json.loads(client.read_frame().payload.decode('utf-8'))
+
+            def subscribe(username):
+                r, data = make_request(conn, '/changes/token', prefix='', username=username, password='test')
+                self.ae(r.status, OK)
+                client = WSClient(server.address[1])
+                client.write_message(json.dumps({'token': data['token']}))
+                self.ae(next_message(client), {'subscribed': db.server_library_id})
+                return client, data['token']
+
+            c1, token = subscribe('all')
+            c2 = subscribe('12')[0]
+            # Tokens can only be used once
+            c3 = WSClient(server.address[1])
+            c3.write_message(json.dumps({'token': token}))
+            self.ae(c3.read_frame().opcode, CLOSE)
+            # Connections that send a message without a token are closed
+            c4 = WSClient(server.address[1])
+            c4.write_message('not a token')
+            self.ae(c4.read_frame().opcode, CLOSE)
+            # As are connections that do not subscribe in time
+            c5 = WSClient(server.address[1])
+            st = time.monotonic()
+            self.ae(c5.read_frame().opcode, CLOSE)
+            self.assertGreaterEqual(time.monotonic() - st, 0.5)
+
+            # Changes made in quick succession are sent as a single message
+            with ctx.change_notifier.lock:
+                ctx.notify_changes(library_path, books_added((3, 4)))
+                ctx.notify_changes(library_path, metadata((1, 3)))
+                ctx.notify_changes(library_path, formats_added({1: ('epub',), 3: ('txt',)}))
+                ctx.notify_changes(library_path, books_deleted((2, 4)))
+            self.ae(next_message(c1), {
+                'library_id': db.server_library_id, 'books_added': [3], 'books_deleted': [2],
+                'metadata_changed': [1], 'formats_added': {'1': ['EPUB'], '3': ['TXT']},
+                'formats_removed': {}, 'saved_searches_changed': False})
+            # Only books matching the restriction are reported to restricted users
+            self.ae(next_message(c2), {
+                'library_id': db.server_library_id, 'books_added': [], 'books_deleted': [2],
+                'metadata_changed': [1], 'formats_added': {'1': ['EPUB']},
+                'formats_removed': {}, 'saved_searches_changed': False})
+            ctx.notify_changes(library_path, metadata((3,)))
+            self.ae(next_message(c1)['metadata_changed'], [3])
+            for c in (c1, c2, c3, c4, c5):
+                c.socket.close()
+    # }}}
+
     def test_srv_add_book(self):  # {{{
         with self.create_server(auth=True, auth_mode='basic') as server:
             server.handler.ctx.user_manager.add_user('12', 'test')
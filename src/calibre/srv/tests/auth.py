@@ -46,11 +46,11 @@ def android2(ctx, data):
     return 'android2'
 
 
-def router(prefer_basic_auth=False, ban_for=0, ban_after=5):
+def router(prefer_basic_auth=False, ban_for=0, ban_after=5, session_lifetime=0):
     from calibre.srv.auth import AuthController
     return Router(itervalues(globals()), auth_controller=AuthController(
         {'testuser':'testpw', '!@#$%^&*()-=_+':'!@#$%^&*()-=_+'},
-        ban_time_in_minutes=ban_for, ban_after=ban_after,
+        ban_time_in_minutes=ban_for, ban_after=ban_after, session_lifetime=session_lifetime,
         prefer_basic_auth=prefer_basic_auth, realm=REALM, max_age_seconds=1))
 
 
@@ -271,6 +271,55 @@ class TestAuth(BaseTest):
             self.ae((http_client.OK, b'closed'), request())
     # }}}
 
+    def test_session_cookie(self):  # {{{
+        'Test authentication with session cookies'
+        from calibre.srv.auth import create_session_token
+        from calibre.utils.monotonic import monotonic
+        r = router(prefer_basic_auth=True, session_lifetime=60)
+        with TestServer(r.dispatch) as server:
+            ac = r.auth_controller
+            ac.log = server.log
+            conn = server.connect()
+
+            def request(cookie=None, un='testuser', pw='testpw', auth=False):
+                headers = {}
+                if cookie is None or auth:
+                    headers['Authorization'] = b'Basic ' + as_base64_bytes('%s:%s' % (un, pw))
+                if cookie is not None:
+                    headers['Cookie'] = '%s=%s' % (ac.SESSION_COOKIE, cookie)
+                conn.request('GET', '/closed', headers=headers)
+                r = conn.getresponse()
+                return r.status, r.read(), r.getheader('Set-Cookie')
+
+            status, body, set_cookie = request()
+            self.ae((status, body), (http_client.OK, b'closed'))
+            self.assertIn('HttpOnly', set_cookie)
+            self.assertIn('Path=/;', set_cookie)
+            self.assertIn('SameSite=Strict', set_cookie)
+            # Only set for SSL connections
+            self.assertNotIn('Secure', set_cookie)
+            cookie = set_cookie.partition(';')[0].partition('=')[2].strip('"')
+            self.ae(request(cookie), (http_client.OK, b'closed', None))
+            # Credentials take precedence over the session cookie
+            self.ae(request(cookie, pw='wrong', auth=True)[0], http_client.UNAUTHORIZED)
+            self.ae(request('x' + cookie)[0], http_client.UNAUTHORIZED)
+            self.ae(request(cookie.replace(':', ':1', 1))[0], http_client.UNAUTHORIZED)
+            self.ae(request('')[0], http_client.UNAUTHORIZED)
+            self.ae(request(create_session_token(ac.secret, 'testuser', 'testpw', monotonic() - 1))[0], http_client.UNAUTHORIZED)
+            self.ae(request(create_session_token(ac.secret, 'testuser', 'testpw', monotonic() + 10))[0], http_client.OK)
+            self.ae(request(create_session_token('wrong secret', 'testuser', 'testpw', monotonic() + 10))[0], http_client.UNAUTHORIZED)
+            # Changing the password invalidates the session
+            ac.user_credentials['testuser'] = 'changed'
+            ac.credentials_cache.items.clear()
+            self.ae(request(cookie)[0], http_client.UNAUTHORIZED)
+            self.ae(request(pw='changed')[:2], (http_client.OK, b'closed'))
+            ac.user_credentials['testuser'] = 'testpw'
+            # No session cookies when sessions are disabled
+            ac.session_lifetime = 0
+            self.ae(request(), (http_client.OK, b'closed', None))
+            self.ae(request(cookie)[0], http_client.UNAUTHORIZED)
+    # }}}
+
     def test_android_auth_workaround(self):  # {{{
         'Test authentication workaround for Android'
         r = router()
@@ -140,12 +140,13 @@ class LibraryServer(TestServer):
         self.libraries = libraries or (library_path,)
         self.handler = Handler(self.libraries, opts, testing=True)
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, websocket_handler=self.handler.ctx.change_notifier),
             opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.WARN),
         )
         self.handler.set_log(self.loop.log)
+        self.handler.set_metrics(self.loop.metrics)
         specialize(self)
 
     def __exit__(self, *args):
@@ -226,6 +226,84 @@ class ContentTest(LibraryBaseTest):
 
     # }}}
 
+    def test_bundle(self):  # {{{
+        'Test downloading of books as a ZIP file'
+        from calibre.utils.zipfile import ZipFile
+        with self.create_server() as server:
+            conn = server.connect()
+
+            def get(url, status=http_client.OK, headers={}):
+                conn.request('GET', url, headers=headers)
+                r = conn.getresponse()
+                self.ae(r.status, status)
+                return r, r.read()
+
+            r, data = get('/get/bundle?ids=1,2,1000&fmt=FMT1')
+            self.ae(r.getheader('Content-Type'), 'application/zip')
+            self.ae(int(r.getheader('Content-Length')), len(data))
+            zf = ZipFile(BytesIO(data))
+            self.assertIsNone(zf.testzip())
+            self.ae(sorted(zf.read(n) for n in zf.namelist()), [b'book1fmt1', b'book2fmt1'])
+            etag = r.getheader('ETag')
+            get('/get/bundle?ids=1,2,1000&fmt=FMT1', status=http_client.NOT_MODIFIED, headers={'If-None-Match': etag})
+            r, part = get('/get/bundle?ids=1,2,1000&fmt=FMT1', status=http_client.PARTIAL_CONTENT, headers={'Range': 'bytes=10-99'})
+            self.ae(part, data[10:100])
+            r, data = get('/get/bundle?search=id:1&fmt=FMT2,FMT1')
+            zf = ZipFile(BytesIO(data))
+            self.ae([zf.read(n) for n in zf.namelist()], [b'book1fmt2'])
+            get('/get/bundle?ids=2&fmt=EPUB', status=http_client.NOT_FOUND)
+            get('/get/bundle?ids=1,x&fmt=FMT1', status=http_client.BAD_REQUEST)
+            # Books with the same file name are stored under different names
+            from calibre.srv import content
+            orig = content.book_filename
+            content.book_filename = lambda *a, **kw: 'Book.fmt1'
+            try:
+                r, data = get('/get/bundle?ids=1,2&fmt=FMT1')
+            finally:
+                content.book_filename = orig
+            self.ae(ZipFile(BytesIO(data)).namelist(), ['Book.fmt1', 'Book_2.fmt1'])
+    # }}}
+
+    def test_opds(self):  # {{{
+        'Test OPDS feed generation and caching'
+        from lxml import etree
+        from polyglot.binary import as_hex_unicode
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            cache = server.handler.router.ctx.library_broker.opds_entry_caches[db.server_library_id]
+            conn = server.connect()
+
+            def get(url, status=http_client.OK, headers={}):
+                conn.request('GET', url, headers=headers)
+                r = conn.getresponse()
+                self.ae(r.status, status)
+                return r, r.read()
+
+            r, data = get('/opds')
+            self.assertTrue(r.getheader('Content-Type').startswith('application/atom+xml'))
+            etag = r.getheader('ETag')
+            self.assertTrue(etag)
+            get('/opds', status=http_client.NOT_MODIFIED, headers={'If-None-Match': etag})
+
+            url = '/opds/navcatalog/' + as_hex_unicode('Otitle')
+            r, data = get(url)
+            root = etree.fromstring(data)
+            entries = root.findall('{http://www.w3.org/2005/Atom}entry')
+            self.ae(len(entries), len(db.all_book_ids()))
+            self.ae(set(cache), db.all_book_ids())
+            etag = r.getheader('ETag')
+            get(url, status=http_client.NOT_MODIFIED, headers={'If-None-Match': etag})
+            db.set_field('title', {1: 'Changed title'})
+            r, data = get(url, headers={'If-None-Match': etag})
+            self.assertNotEqual(r.getheader('ETag'), etag)
+            self.assertIn(b'Changed title', data)
+            self.ae(len(etree.fromstring(data).findall('{http://www.w3.org/2005/Atom}entry')), len(entries))
+            db.rename_items('tags', {db.get_item_id('tags', 'Tag One'): 'Renamed tag'})
+            r, data = get(url)
+            self.assertIn(b'TAGS: Renamed tag, Tag Two', data)
+            self.assertNotIn(b'TAGS: Tag One', data)
+    # }}}
+
     def test_char_count(self):  # {{{
         from calibre.srv.render_book import get_length
         from calibre.ebooks.oeb.parse_utils import html5_parse
@@ -23,13 +23,16 @@ class TestHTTP(BaseTest):
 
     def test_header_parsing(self):  # {{{
         'Test parsing of HTTP headers'
-        from calibre.srv.http_request import HTTPHeaderParser
+        from calibre.srv.http_request import HTTPHeaderParser, parse_header_block
 
         def test(name, *lines, **kwargs):
             p = HTTPHeaderParser()
             p.push(*lines)
             self.assertTrue(p.finished)
-            self.assertSetEqual(set(p.hdict.items()), {(k.replace('_', '-').title(), v) for k, v in iteritems(kwargs)}, name + ' failed')
+            expected = {(k.replace('_', '-').title(), v) for k, v in iteritems(kwargs)}
+            self.assertSetEqual(set(p.hdict.items()), expected, name + ' failed')
+            hdict = parse_header_block([x.rstrip(b'\r\n') for x in lines[:-1]])
+            self.assertSetEqual(set(hdict.items()), expected, name + ' failed with parse_header_block')
 
         test('Continuation line parsing',
              b'a: one',
@@ -49,6 +52,7 @@ class TestHTTP(BaseTest):
 
         def parse(*lines):
             lines = list(lines)
+            self.assertRaises(ValueError, parse_header_block, [x.rstrip(b'\r\n') for x in lines])
             lines.append(b'\r\n')
             self.assertRaises(ValueError, HTTPHeaderParser().push, *lines)
 
@@ -446,3 +450,68 @@ class TestHTTP(BaseTest):
                 r = conn.getresponse()
                 self.assertEqual(data, r.read())
     # }}}
+
+    def test_http2(self):  # {{{
+        'Test HTTP/2 connections'
+        from calibre.srv.errors import HTTPNotFound
+        import socket
+        from calibre.srv.http2 import PREFACE, HTTP2Client
+        big = os.urandom(200 * 1024)
+
+        def handler(data):
+            if data.path[0] == 'big':
+                data.outheaders['Content-Type'] = 'application/octet-stream'
+                return big
+            if data.path[0] == 'echo':
+                return data.read()
+            if data.path[0] == 'missing':
+                raise HTTPNotFound('not here')
+            if data.path[0] == 'cookie':
+                data.outcookie['x'] = 'y'
+                return data.inheaders.get('Cookie', '')
+            return '/'.join(data.path)
+
+        # HTTP/2 without SSL is only used when explicitly enabled
+        with TestServer(handler, timeout=5) as server:
+            s = socket.create_connection(server.address, timeout=5)
+            try:
+                s.sendall(PREFACE)
+                self.assertTrue(s.recv(1024).startswith(b'HTTP/1.0 400 '))
+            finally:
+                s.close()
+
+        with TestServer(handler, timeout=5, use_h2c=True) as server:
+            client = HTTP2Client(*server.address)
+            try:
+                paths = ['/p/%d' % i for i in range(30)]
+                responses = client.get(*paths)
+                self.ae([r[0] for r in responses], [http_client.OK] * len(paths))
+                self.ae([r[2] for r in responses], [p[1:].encode('ascii') for p in paths])
+                status, headers, body = client.get('/missing')[0]
+                self.ae(status, http_client.NOT_FOUND)
+                self.ae(body, b'not here')
+                status, headers, body = client.read_responses(client.request('/echo', method='POST', body=b'abc' * 1000))[0]
+                self.ae(body, b'abc' * 1000)
+                status, headers, body = client.get('/cookie', headers={'Cookie': 'a=1'})[0]
+                self.ae(body, b'a=1')
+                self.assertIn('x=y', headers['set-cookie'])
+                status, headers, body = client.read_responses(client.request('/big', method='HEAD'))[0]
+                self.ae((status, body, headers['content-length']), (http_client.OK, b'', str(len(big))))
+            finally:
+                client.close()
+
+            # Flow control, with several large responses being sent at the
+            # same time
+            client = HTTP2Client(*server.address, window_size=1024)
+            try:
+                responses = client.get('/big', '/big', '/small')
+                self.ae([r[2] for r in responses], [big, big, b'small'])
+            finally:
+                client.close()
+
+            # HTTP/1 requests still work on the same server
+            conn = server.connect()
+            conn.request('GET', '/one')
+            r = conn.getresponse()
+            self.ae(r.read(), b'one')
+    # }}}
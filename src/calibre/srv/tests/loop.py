@@ -101,6 +101,49 @@ class LoopTest(BaseTest):
             server.join()
             self.ae(1, sum(int(w.is_alive()) for w in pool.workers))
 
+    def test_thread_pool(self):
+        ' Test the adaptive worker thread pool '
+        from calibre.srv.pool import ThreadPool, FAST, SLOW
+        from calibre.srv.http_response import request_lane
+        self.ae(request_lane(('opds', 'search')), SLOW)
+        self.ae(request_lane(('static', 'x.js')), FAST)
+        self.ae(request_lane(('calibre', 'interface-data', 'init'), '/calibre/'), SLOW)
+        self.ae(request_lane(('interface-data', 'book-metadata', '1')), FAST)
+
+        def wait_for(condition, timeout=2):
+            end = monotonic() + timeout
+            while not condition() and monotonic() < end:
+                time.sleep(0.01)
+            self.assertTrue(condition())
+
+        block = Event()
+        pool = ThreadPool(None, lambda: None, count=1, max_count=4, per_client_limit=1, idle_timeout=0.05)
+        pool.start()
+        try:
+            for i in range(3):
+                pool.put_nowait(i, block.wait, lane=SLOW, client=i)
+            wait_for(lambda: pool.busy == 3)
+            self.ae(len(pool.workers), 3)
+            # The slow lane may not use all threads
+            pool.put_nowait(3, block.wait, lane=SLOW, client=3)
+            time.sleep(0.05)
+            self.ae(pool.busy, 3)
+            self.ae(pool.queue_depth, 1)
+            pool.put_nowait(4, lambda: 'fast', client=4)
+            wait_for(lambda: pool.queue_depth == 1 and not pool.result_queue.empty())
+            self.ae(pool.get_nowait(), (4, True, 'fast'))
+            # Requests beyond the per client limit are held back
+            pool.put_nowait(5, lambda: 'held', client=0)
+            self.ae(pool.queue_depth, 2)
+            block.set()
+            results = set()
+            wait_for(lambda: results.update(x[0] for x in iter(lambda: None if pool.result_queue.empty() else pool.get_nowait(), None)) or len(results) == 5)
+            # Extra threads exit when idle
+            wait_for(lambda: len(pool.workers) == 1)
+        finally:
+            pool.stop(monotonic() + 1)
+        self.ae(pool.workers, [])
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         def specialize(server):
@@ -193,6 +236,29 @@ class LoopTest(BaseTest):
         self.ae(buf.readline(), b'451\n')
         set(b'123456\n7', 4, 2, READ)
         self.ae(buf.readline(), b'56\n')
+        set(b'a\r\n\r\nbc', 0, 7, READ)
+        self.ae(buf.read_until(b'\r\n\r\n'), b'a\r\n\r\n')
+        self.ae(buf.read_until(b'\r\n\r\n'), None)
+        self.ae(buf.read(10), b'bc')
+        self.ae(buf.read_until(b'\r\n\r\n'), None)
+        set(b'\n\r\nxx\r\n\r', 5, 3, READ)
+        self.ae(buf.read_until(b'\r\n\r\n'), b'\r\n\r\n')
+        self.ae(buf.read_pos, 1)
+        self.ae(buf.read_until(b'x'), None)
+        self.ae(buf.read(10), b'\r\n')
+        self.ae(buf.full_state, WRITE)
+        set(b'\n\r\nxx\r\n\r', 5, 5, READ)
+        self.ae(buf.read_until(b'\r\n\r\n'), b'\r\n\r\n')
+        self.ae(buf.read_pos, 1)
+        set(b'123456', 4, 2, READ)
+        self.ae(buf.peek(3), b'561')
+        self.ae(buf.peek(10), b'5612')
+        self.ae(buf.read(10), b'5612')
+        self.ae(buf.peek(10), b'')
+        # A closed connection must not leave the buffer looking full
+        set(b'123456', 2, 2, WRITE)
+        self.ae(write(b''), 0)
+        self.assertFalse(buf.has_data)
 
     def test_ssl(self):
         'Test serving over SSL'
@@ -301,6 +367,26 @@ class LoopTest(BaseTest):
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+        # Priorities
+        jm = JobsManager(O(1, 5), FakeLog())
+        job_id1 = jm.start_job('blocker', 'calibre.srv.jobs', 'sleep_test', args=(0.5,))
+        job_id2 = jm.start_job('background', 'calibre.srv.jobs', 'sleep_test', args=(0.1,), priority=10)
+        job_id3 = jm.start_job('interactive', 'calibre.srv.jobs', 'sleep_test', args=(0.1,))
+        job_id4 = jm.start_job('raised', 'calibre.srv.jobs', 'sleep_test', args=(0.1,), priority=10)
+        self.assertTrue(jm.raise_priority(job_id4, 5))
+        self.assertFalse(jm.raise_priority(job_id4, 7))
+        while job_status(job_id1) != 'finished':
+            time.sleep(0.01)
+        while job_status(job_id3) != 'finished':
+            self.assertEqual(job_status(job_id2), 'waiting')
+            self.assertEqual(job_status(job_id4), 'waiting')
+            time.sleep(0.01)
+        while job_status(job_id4) != 'finished':
+            self.assertEqual(job_status(job_id2), 'waiting')
+            time.sleep(0.01)
+        self.assertIn(job_status(job_id2), ('running', 'finished'))
+        jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
 
 def find_tests():
     import unittest
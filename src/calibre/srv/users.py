@@ -127,6 +127,9 @@ class UserManager(object):
         self._conn = None
         self._restrictions = {}
         self._readonly = {}
+        # Incremented whenever users or their passwords change, used to
+        # invalidate caches of user data
+        self.generation = 0
 
     def get_session_data(self, username):
         with self.lock:
@@ -175,6 +178,7 @@ class UserManager(object):
     def remove_user(self, username):
         with self.lock:
             self.conn.cursor().execute('DELETE FROM users WHERE name=?', (username,))
+            self.generation += 1
             return self.conn.changes() > 0
 
     @property
@@ -212,6 +216,7 @@ class UserManager(object):
     def refresh(self):
         self._restrictions.clear()
         self._readonly.clear()
+        self.generation += 1
 
     def is_readonly(self, username):
         with self.lock:
@@ -238,6 +243,7 @@ class UserManager(object):
                 raise ValueError(msg)
             self.conn.cursor().execute(
                 'UPDATE users SET pw=? WHERE name=?', (pw, username))
+            self.generation += 1
 
     def restrictions(self, username):
         with self.lock:
@@ -19,7 +19,7 @@ from calibre.utils.logging import ThreadSafeLog
 from calibre.utils.shared_file import share_open, raise_winerror
 from polyglot.builtins import iteritems, map, range
 from polyglot import reprlib
-from polyglot.http_cookie import SimpleCookie
+from polyglot.http_cookie import Morsel as BaseMorsel, SimpleCookie
 from polyglot.builtins import unicode_type, as_unicode
 from polyglot.urllib import parse_qs, quote as urlquote
 from polyglot.binary import as_hex_unicode as encode_name, from_hex_unicode as decode_name
@@ -34,6 +34,18 @@ def http_date(timeval=None):
     return unicode_type(formatdate(timeval=timeval, usegmt=True))
 
 
+class RawJSON(object):
+
+    ''' Already serialized, UTF-8 encoded JSON. When used as a value in the
+    dict returned by an endpoint using the json postprocessor, it is embedded
+    in the response verbatim. '''
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
 class MultiDict(dict):  # {{{
 
     def __setitem__(self, key, val):
@@ -287,10 +299,17 @@ def encode_path(*components):
     return '/' + '/'.join(urlquote(x.encode('utf-8'), '') for x in components)
 
 
+class Morsel(BaseMorsel):
+    # The SameSite attribute is only known to python >= 3.8
+    _reserved = dict(BaseMorsel._reserved, samesite='SameSite')
+
+
 class Cookie(SimpleCookie):
 
     def _BaseCookie__set(self, key, real_value, coded_value):
-        return SimpleCookie._BaseCookie__set(self, key, real_value, coded_value)
+        M = self.get(key, Morsel())
+        M.set(key, real_value, coded_value)
+        dict.__setitem__(self, key, M)
 
 
 def custom_fields_to_display(db):
@@ -9,6 +9,7 @@ __docformat__ = 'restructuredtext en'
 # Note that the code for creating a BMP table (cmap format 4) is taken with
 # thanks from the fonttools project (BSD licensed).
 
+from bisect import bisect_left
 from struct import unpack_from, calcsize, pack
 from collections import OrderedDict
 
@@ -129,23 +130,32 @@ class BMPTable(object):
                 read_bmp_prefix(raw, 0)
 
     def get_glyph_ids(self, codes):
+        end_count, start_count = self.end_count, self.start_count
+        # The segments are required to be sorted and not to overlap, which
+        # allows the segment for a code to be found with a binary search, but
+        # some broken fonts do not follow that
+        is_sorted = all(end_count[i] < start_count[i+1] and start_count[i] <= end_count[i] for i in range(len(end_count) - 1))
         for code in codes:
+            if is_sorted:
+                i = bisect_left(end_count, code)
+                candidates = (i,) if i < len(end_count) else ()
+            else:
+                candidates = (i for i, ec in enumerate(end_count) if ec >= code)
             found = False
-            for i, ec in enumerate(self.end_count):
-                if ec >= code:
-                    sc = self.start_count[i]
-                    if sc <= code:
-                        found = True
-                        ro = self.range_offset[i]
-                        if ro == 0:
-                            glyph_id = self.id_delta[i] + code
-                        else:
-                            idx = ro//2 + (code - sc) + i - self.array_len
-                            glyph_id = self.glyph_id_map[idx]
-                            if glyph_id != 0:
-                                glyph_id += self.id_delta[i]
-                        yield glyph_id % 0x10000
-                        break
+            for i in candidates:
+                sc = start_count[i]
+                if sc <= code:
+                    found = True
+                    ro = self.range_offset[i]
+                    if ro == 0:
+                        glyph_id = self.id_delta[i] + code
+                    else:
+                        idx = ro//2 + (code - sc) + i - self.array_len
+                        glyph_id = self.glyph_id_map[idx]
+                        if glyph_id != 0:
+                            glyph_id += self.id_delta[i]
+                    yield glyph_id % 0x10000
+                    break
             if not found:
                 yield 0
 
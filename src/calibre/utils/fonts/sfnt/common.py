@@ -6,6 +6,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2012, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+from bisect import bisect_right
 from struct import unpack_from, calcsize
 from collections import OrderedDict, namedtuple
 
@@ -190,6 +191,11 @@ class Coverage(object):
             for i in range(count):
                 start, end, start_coverage_index = ranges[i*3:(i+1)*3]
                 self.ranges.append(CoverageRange(start, end, start_coverage_index))
+            # Use a binary search to find the range for a glyph, unless the
+            # ranges are not sorted or overlap, as in some broken fonts
+            r = self.ranges
+            self.range_starts = [x.start for x in r] if all(
+                r[i].start <= r[i].end < r[i+1].start for i in range(len(r) - 1)) else None
 
     def coverage_indices(self, glyph_ids):
         '''Return map of glyph_id -> coverage index. Map contains only those
@@ -201,6 +207,12 @@ class Coverage(object):
                 idx = self.glyph_ids_map.get(gid, None)
                 if idx is not None:
                     ans[gid] = idx
+            elif self.range_starts is not None:
+                i = bisect_right(self.range_starts, gid) - 1
+                if i > -1:
+                    start, end, start_coverage_index = self.ranges[i]
+                    if gid <= end:
+                        ans[gid] = start_coverage_index + (gid-start)
             else:
                 for start, end, start_coverage_index in self.ranges:
                     if start <= gid <= end:
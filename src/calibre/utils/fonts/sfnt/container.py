@@ -43,6 +43,9 @@ class Sfnt(object):
 
     def __init__(self, raw_or_get_table):
         self.tables = {}
+        # Map of table tag to the raw bytes of the table as read from the font
+        # and its checksum, used to avoid checksumming unmodified tables again
+        self.loaded_checksums = {}
         if isinstance(raw_or_get_table, bytes):
             raw = raw_or_get_table
             self.sfnt_version = raw[:4]
@@ -52,6 +55,8 @@ class Sfnt(object):
             for table_tag, table, table_index, table_offset, table_checksum in get_tables(raw):
                 self.tables[table_tag] = self.TABLE_MAP.get(
                     table_tag, UnknownTable)(table)
+                if table_tag != b'head':
+                    self.loaded_checksums[table_tag] = (table, table_checksum)
         else:
             for table_tag in {
                 b'cmap', b'hhea', b'head', b'hmtx', b'maxp', b'name', b'OS/2',
@@ -123,27 +128,37 @@ class Sfnt(object):
 
         # Write tables
         head_offset = None
-        table_data = []
+        table_data, checksums = [], []
         offset = stream.tell() + (calcsize(b'>4s3L') * num_tables)
         sizes = OrderedDict()
         for tag in self:
             table = self.tables[tag]
             raw = table()
             table_len = len(raw)
+            loaded = self.loaded_checksums.get(tag)
             if tag == b'head':
                 head_offset = offset
                 raw = raw[:8] + b'\0\0\0\0' + raw[12:]
-            raw = align_block(raw)
-            checksum = checksum_of_block(raw)
+            if loaded is not None and loaded[0] is raw:
+                # Tables that were not changed return the bytes they were
+                # loaded from, so the checksum from the font can be reused
+                raw, checksum = align_block(raw), loaded[1]
+            else:
+                raw = align_block(raw)
+                checksum = checksum_of_block(raw)
+            checksums.append(checksum)
             spack(b'>4s3L', tag, checksum, offset, table_len)
             offset += len(raw)
             table_data.append(raw)
             sizes[tag] = table_len
 
+        # The checksum of the font is the sum of the checksums of its header
+        # and of its tables, as they are all aligned to four bytes, so it is
+        # calculated without reading all the tables again
+        checksum = checksum_of_block(stream.getvalue())
         for x in table_data:
             stream.write(x)
-
-        checksum = checksum_of_block(stream.getvalue())
+        checksum = (checksum + sum(checksums)) & 0xffffffff
         q = (0xB1B0AFBA - checksum) & 0xffffffff
         stream.seek(head_offset + 8)
         spack(b'>L', q)
@@ -8,8 +8,10 @@ __docformat__ = 'restructuredtext en'
 
 import traceback
 from collections import OrderedDict
-from operator import itemgetter
 from functools import partial
+from hashlib import sha1
+from operator import itemgetter
+from threading import Lock
 
 from calibre.utils.icu import safe_chr, ord_string
 from calibre.utils.fonts.sfnt.container import Sfnt
@@ -112,6 +114,65 @@ def safe_ord(x):
     return ord_string(unicode_type(x))[0]
 
 
+# Starting worker processes takes a second or two, so fonts are only subset in
+# parallel if their total size is at least this many bytes
+MIN_PARALLEL_SIZE = 2 * 1024 * 1024
+# The glyphs needed for sets of characters from fonts, see glyph_closure()
+closure_cache = OrderedDict()
+closure_cache_lock = Lock()
+CLOSURE_CACHE_SIZE = 32
+
+
+def glyph_closure(sfnt, raw, chars, warn):
+    '''
+    Return the mapping of the character codes in chars to glyph ids in the
+    font and the set of the other glyphs that the GSUB table can substitute for
+    them. Decompiling the GSUB table of large fonts, such as CJK fonts, is slow,
+    so the result is cached, keyed by the hash of the font data raw and chars.
+    '''
+    key = sha1(raw).digest(), frozenset(chars)
+    with closure_cache_lock:
+        cached = closure_cache.get(key)
+        if cached is not None:
+            closure_cache.move_to_end(key)
+    if cached is not None:
+        character_map, extra_glyphs, messages = cached
+        for args in messages:
+            warn(*args)
+        return OrderedDict(character_map), set(extra_glyphs)
+
+    try:
+        cmap = sfnt[b'cmap']
+    except KeyError:
+        raise UnsupportedFont('This font has no cmap table')
+
+    # Get mapping of chars to glyph ids for all specified chars
+    character_map = cmap.get_character_map(chars)
+
+    extra_glyphs = set()
+    messages = []
+
+    if b'GSUB' in sfnt:
+        # Parse all substitution rules to ensure that glyphs that can be
+        # substituted for the specified set of glyphs are not removed
+        gsub = sfnt[b'GSUB']
+        try:
+            gsub.decompile()
+            extra_glyphs = gsub.all_substitutions(itervalues(character_map))
+        except UnsupportedFont as e:
+            messages.append(('Usupported GSUB table: %s'%e,))
+        except Exception:
+            messages.append(('Failed to decompile GSUB table:', traceback.format_exc()))
+    for args in messages:
+        warn(*args)
+
+    with closure_cache_lock:
+        closure_cache[key] = tuple(character_map.items()), frozenset(extra_glyphs), messages
+        while len(closure_cache) > CLOSURE_CACHE_SIZE:
+            closure_cache.popitem(last=False)
+    return character_map, extra_glyphs
+
+
 def subset(raw, individual_chars, ranges=(), warnings=None):
     warn = partial(do_warn, warnings)
 
@@ -146,27 +207,7 @@ def subset(raw, individual_chars, ranges=(), warnings=None):
         if tag not in core_tables:
             del sfnt[tag]
 
-    try:
-        cmap = sfnt[b'cmap']
-    except KeyError:
-        raise UnsupportedFont('This font has no cmap table')
-
-    # Get mapping of chars to glyph ids for all specified chars
-    character_map = cmap.get_character_map(chars)
-
-    extra_glyphs = set()
-
-    if b'GSUB' in sfnt:
-        # Parse all substitution rules to ensure that glyphs that can be
-        # substituted for the specified set of glyphs are not removed
-        gsub = sfnt[b'GSUB']
-        try:
-            gsub.decompile()
-            extra_glyphs = gsub.all_substitutions(itervalues(character_map))
-        except UnsupportedFont as e:
-            warn('Usupported GSUB table: %s'%e)
-        except Exception:
-            warn('Failed to decompile GSUB table:', traceback.format_exc())
+    character_map, extra_glyphs = glyph_closure(sfnt, raw, chars, warn)
 
     if b'loca' in sfnt and b'glyf' in sfnt:
         # TrueType Outlines
@@ -179,7 +220,7 @@ def subset(raw, individual_chars, ranges=(), warnings=None):
                 'or PostScript outlines')
 
     # Restrict the cmap table to only contain entries for the resolved glyphs
-    cmap.set_character_map(character_map)
+    sfnt[b'cmap'].set_character_map(character_map)
 
     if b'kern' in sfnt:
         try:
@@ -193,6 +234,43 @@ def subset(raw, individual_chars, ranges=(), warnings=None):
     raw, new_sizes = sfnt()
     return raw, old_sizes, new_sizes
 
+
+def subset_or_error(raw, individual_chars):
+    try:
+        return subset(raw, individual_chars)
+    except (NoGlyphs, UnsupportedFont) as e:
+        return e
+
+
+def subset_fonts(fonts, max_workers=1):
+    '''
+    Subset many fonts, specified as a list of (raw, individual_chars). Returns
+    a list of the results of :func:`subset` for them, in the same order. When
+    max_workers is more than one, the fonts are subset in that many worker
+    processes at once, as subsetting large fonts, such as CJK fonts, is slow.
+    NoGlyphs and UnsupportedFont errors are returned instead of raised.
+    '''
+    if max_workers < 2 or len(fonts) < 2 or sum(len(raw) for raw, chars in fonts) < MIN_PARALLEL_SIZE:
+        return [subset_or_error(raw, chars) for raw, chars in fonts]
+    from calibre.utils.ipc.pool import Failure, Pool
+    pool = Pool(max_workers=min(max_workers, len(fonts)), name='SubsetFonts')
+    results = {}
+    try:
+        for i, (raw, chars) in enumerate(fonts):
+            pool(i, __name__, 'subset_or_error', raw, tuple(chars))
+        pool.wait_for_tasks()
+        while not pool.results.empty():
+            r = pool.results.get()
+            if not r.is_terminal_failure and not r.result.err:
+                results[r.id] = r.result.value
+    except Failure:
+        pass
+    finally:
+        pool.shutdown()
+    # Fonts whose workers failed are subset in this process, so that any
+    # errors are reported in the usual way
+    return [results[i] if i in results else subset_or_error(raw, chars) for i, (raw, chars) in enumerate(fonts)]
+
 # CLI {{{
 
 
@@ -327,6 +405,12 @@ def test():
     sf, old_stats, new_stats = subset(raw, set(('a', 'b', 'c')), ())
     if len(sf) > 0.3 * len(raw):
         raise Exception('Subsetting failed')
+    # The glyphs are read from closure_cache the second time
+    if subset(raw, set(('a', 'b', 'c')), ())[0] != sf:
+        raise Exception('Subsetting with cached glyphs failed')
+    results = subset_fonts([(raw, 'abc'), (b'not a font', 'abc')])
+    if results[0][0] != sf or not isinstance(results[1], UnsupportedFont):
+        raise Exception('Subsetting many fonts failed')
 
 
 def all():
@@ -13,7 +13,9 @@ from itertools import chain
 from lxml import etree
 
 from css_selectors.errors import ExpressionError
-from css_selectors.parser import parse, ascii_lower, Element, FunctionalPseudoElement
+from css_selectors.parser import (
+    parse, ascii_lower, Class, CombinedSelector, Element, FunctionalPseudoElement, Hash, Pseudo
+)
 from css_selectors.ordered_set import OrderedSet
 
 from polyglot.builtins import iteritems, itervalues
@@ -193,6 +195,50 @@ class Select(object):
         for elem in self(selector, root=root):
             return True
         return False
+
+    def matcher(self, selector):
+        ''' Return a function that takes a tag from the tree and returns True
+        iff it matches selector. This is much faster than :meth:`__call__`
+        when a selector has to be tested against only a few tags, such as the
+        tags found via :meth:`index_keys`. Matching always uses the default
+        dispatch map, except for pseudo-classes. Raises :class:`SelectorError`
+        for invalid selectors. '''
+        matchers = tuple(matcher_for(self, parsed_selector) for parsed_selector in get_parsed_selector(selector))
+        if len(matchers) == 1:
+            return matchers[0]
+        return lambda elem: any(m(elem) for m in matchers)
+
+    def index_keys(self, selector):
+        ''' Return the keys that tags must have, as returned by
+        :meth:`element_index_keys`, to match selector. One key is returned for
+        every compound selector in selector, starting with the rightmost. Only
+        tags that have the first key can match selector and selector can only
+        match if, for every key, some tag in the tree has it. The key is the
+        most selective of the id, class and tag name in the compound
+        selector, or None if there is no such constraint. Returns an empty
+        tuple for groups of selectors. '''
+        parsed = get_parsed_selector(selector)
+        if len(parsed) != 1:
+            return ()
+        ans = []
+        node = parsed[0].parsed_tree
+        while isinstance(node, CombinedSelector):
+            ans.append(compound_index_key(node.subselector))
+            node = node.selector
+        ans.append(compound_index_key(node))
+        return tuple(ans)
+
+    def element_index_keys(self, elem):
+        ''' Return the keys, as used by :meth:`index_keys`, for the specified
+        tag. '''
+        ans = [('tag', self.map_tag_name(elem.tag))]
+        val = elem.get('id')
+        if val is not None:
+            ans.append(('id', ascii_lower(val)))
+        val = elem.get('class')
+        if val:
+            ans.extend(('class', cls) for cls in frozenset(ascii_lower(val).split()))
+        return ans
     # }}}
 
     def iterparsedselector(self, parsed_selector):
@@ -287,6 +333,15 @@ class Select(object):
     def iterchildren(self, tag=None):
         return (self.root if tag is None else tag).iterchildren('*')
 
+    def iterancestors(self, tag):
+        ''' Iterate over the ancestors of tag that are in the tree, nearest
+        first '''
+        if tag is not self.root:
+            for ancestor in tag.iterancestors('*'):
+                yield ancestor
+                if ancestor is self.root:
+                    break
+
     def itersiblings(self, tag=None, preceding=False):
         return (self.root if tag is None else tag).itersiblings('*', preceding=preceding)
 
@@ -683,6 +738,207 @@ def select_empty(cache, elem):
 
 # }}}
 
+# Matching of individual tags {{{
+# These functions mirror the select_* functions above, but instead of
+# selecting all matching tags in the tree, they return a function that tests
+# whether a single tag matches
+
+
+def matcher_for(cache, parsed_selector):
+    type_name = type(parsed_selector).__name__
+    try:
+        func = matcher_map[ascii_lower(type_name)]
+    except KeyError:
+        raise ExpressionError('%s is not supported' % type_name)
+    return func(cache, parsed_selector)
+
+
+def compound_index_key(node):
+    ans = None
+    while node is not None:
+        if isinstance(node, Hash):
+            return 'id', ascii_lower(node.id)
+        if isinstance(node, Class):
+            if ans is None or ans[0] == 'tag':
+                ans = 'class', ascii_lower(node.class_name)
+        elif isinstance(node, Element):
+            if ans is None and node.element and node.element != '*':
+                ans = 'tag', ascii_lower(node.element)
+            break
+        elif isinstance(node, Pseudo) and ascii_lower(node.ident) == 'root':
+            # :root ignores the selectors it is attached to
+            break
+        node = getattr(node, 'selector', None)
+    return ans
+
+
+def always_matches(elem):
+    return True
+
+
+def memoized(func):
+    # Used for matchers that are called repeatedly for the same tag, such as
+    # for the ancestors or siblings of tags. Relies on the tree not changing.
+    results = {}
+
+    def matches(elem):
+        try:
+            return results[elem]
+        except KeyError:
+            results[elem] = ans = func(elem)
+            return ans
+    return matches
+
+
+def match_selector(cache, selector):
+    match = matcher_for(cache, selector.parsed_tree)
+    if selector.pseudo_element is None:
+        return match
+    if isinstance(selector.pseudo_element, FunctionalPseudoElement):
+        raise ExpressionError(
+            "The pseudo-element ::%s is not supported" % selector.pseudo_element.name)
+    func = get_func_for_pseudo(cache, selector.pseudo_element)
+    return lambda elem: match(elem) and func(cache, elem)
+
+
+def match_combinedselector(cache, combined):
+    combinator = cache.combinator_mapping[combined.combinator]
+    left = memoized(matcher_for(cache, combined.selector))
+    right = matcher_for(cache, combined.subselector)
+    if combinator == 'descendant':
+        @memoized
+        def has_matching_ancestor(elem):
+            for parent in cache.iterancestors(elem):
+                return left(parent) or has_matching_ancestor(parent)
+            return False
+
+        def match(elem):
+            return right(elem) and has_matching_ancestor(elem)
+    elif combinator == 'child':
+        def match(elem):
+            if right(elem):
+                for parent in cache.iterancestors(elem):
+                    return left(parent)
+            return False
+    elif combinator == 'direct_adjacent':
+        def match(elem):
+            if right(elem) and elem is not cache.root:
+                for sibling in cache.itersiblings(elem, preceding=True):
+                    return left(sibling)
+            return False
+    else:
+        def match(elem):
+            return right(elem) and elem is not cache.root and any(
+                left(x) for x in cache.itersiblings(elem, preceding=True))
+    return match
+
+
+def match_element(cache, selector):
+    element = selector.element
+    if not element or element == '*':
+        return always_matches
+    element = ascii_lower(element)
+    map_tag_name = cache.map_tag_name
+    results = {}
+
+    def matches(elem):
+        tag = elem.tag
+        try:
+            return results[tag]
+        except KeyError:
+            results[tag] = ans = map_tag_name(tag) == element
+            return ans
+    return matches
+
+
+def match_hash(cache, selector):
+    match = matcher_for(cache, selector.selector)
+    val = ascii_lower(selector.id)
+
+    def matches(elem):
+        q = elem.get('id')
+        return q is not None and ascii_lower(q) == val and match(elem)
+    return matches
+
+
+def match_class(cache, selector):
+    match = matcher_for(cache, selector.selector)
+    val = ascii_lower(selector.class_name)
+
+    def matches(elem):
+        q = elem.get('class')
+        return q is not None and val in ascii_lower(q).split() and match(elem)
+    return matches
+
+
+def match_negation(cache, selector):
+    match, exclude = matcher_for(cache, selector.selector), matcher_for(cache, selector.subselector)
+    return lambda elem: match(elem) and not exclude(elem)
+
+
+def attrib_value_test(operator, value):
+    if operator == 'exists':
+        return always_matches
+    if operator == 'equals':
+        return lambda val: val == value
+    if operator == 'includes':
+        return (lambda val: value in val.split()) if is_non_whitespace(value) else None
+    if not value:
+        return None
+    if operator == 'dashmatch':
+        prefix = value + '-'
+        return lambda val: val == value or val.startswith(prefix)
+    if operator == 'prefixmatch':
+        return lambda val: val.startswith(value)
+    if operator == 'suffixmatch':
+        return lambda val: val.endswith(value)
+    return lambda val: value in val
+
+
+def match_attrib(cache, selector):
+    match = matcher_for(cache, selector.selector)
+    test = attrib_value_test(cache.attribute_operator_mapping[selector.operator], selector.value)
+    if test is None:
+        return lambda elem: False
+    attrib = ascii_lower(selector.attrib)
+    map_attrib_name = (lambda x: ascii_lower(x.rpartition('}')[2])) if '{' in cache.root.tag else ascii_lower
+
+    def matches(elem):
+        for name, val in iteritems(elem.attrib):
+            if map_attrib_name(name) == attrib and test(val):
+                return match(elem)
+        return False
+    return matches
+
+
+def match_function(cache, function):
+    fname = function.name.replace('-', '_')
+    try:
+        func = cache.dispatch_map[fname]
+    except KeyError:
+        raise ExpressionError(
+            "The pseudo-class :%s() is unknown" % function.name)
+    match = matcher_for(cache, function.selector)
+    if fname == 'lang':
+        items = frozenset(func(cache, function))
+        return lambda elem: elem in items and match(elem)
+    if fname.startswith('nth_'):
+        # Report invalid arguments now, rather than when matching
+        function.parsed_arguments
+    return lambda elem: match(elem) and func(cache, function, elem)
+
+
+def match_pseudo(cache, pseudo):
+    func = get_func_for_pseudo(cache, pseudo.ident)
+    if func is select_root:
+        return lambda elem: elem is cache.root
+    match = matcher_for(cache, pseudo.selector)
+    return lambda elem: match(elem) and func(cache, elem)
+
+
+matcher_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('match_') and callable(obj)}
+# }}}
+
 default_dispatch_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('select_') and callable(obj)}
 
 if __name__ == '__main__':
@@ -742,6 +742,43 @@ by William Shakespeare
         select = Select(document, ignore_inappropriate_pseudo_classes=True)
         self.assertGreater(len(tuple(select('p:hover'))), 0)
 
+    def test_matcher(self):  # {{{
+        document = etree.fromstring(self.HTML_IDS, parser=etree.XMLParser(recover=True, no_network=True, resolve_entities=False))
+        shakespeare = html.document_fromstring(self.HTML_SHAKESPEARE)
+        selectors = (
+            '*', 'div', 'DIV', 'div div', 'div, div div', 'a[name]', 'a[NAme]', 'a[rel="tag"]', 'a[href*="localhost"]',
+            'a[href*=""]', 'a[href^="http"]', 'a[href^=""]', 'a[href$="org"]', 'div[foobar~="bc"]', '[foobar~="ab bc"]',
+            '[foobar~=""]', '*[lang|="En"]', '*[lang|="e"]', ':lang("EN")', '*:lang(en-US)', 'li:nth-child(2n+4)',
+            'li:nth-last-child(2n)', 'ol:nth-of-type(2)', 'ol:nth-last-of-type(1)', 'span:only-child', 'div *:only-child',
+            'p *:only-of-type', 'a:empty', ':root', 'html:root', 'li:root', '* :root', '.c', 'ol *.c', 'li ~ li.c', 'ol > li.c',
+            '#first-li', 'li#first-li', 'div > div', 'div>.c', 'div + div', 'a ~ a', 'a[rel="tag"] ~ a', 'ol#first-ol *:last-child',
+            '#outer-div :first-child', ':not(*)', 'a:not([href])', 'ol :Not(li[class])', 'p:hover', 'p::first-line',
+            'div.dialog .dialog .direction', 'div#scene1 div.dialog div', 'div[class|=dialog]', 'div ~ div', 'div.scene.scene',
+        )
+        for root in (document, shakespeare):
+            select = Select(root, ignore_inappropriate_pseudo_classes=True)
+            for selector in selectors:
+                matches, keys = select.matcher(selector), select.index_keys(selector)
+                # select() does not always return tags in document order
+                expected = set(select(selector))
+                self.ae({elem for elem in select.itertag() if matches(elem)}, expected, selector)
+                if keys and keys[0] is not None:
+                    for elem in expected:
+                        self.assertIn(keys[0], select.element_index_keys(elem), selector)
+                if expected:
+                    all_keys = {k for elem in select.itertag() for k in select.element_index_keys(elem)}
+                    self.assertFalse({k for k in keys if k is not None} - all_keys, selector)
+        select = Select(document)
+        self.ae(select.index_keys('div .a.b'), (('class', 'b'), ('tag', 'div')))
+        self.ae(select.index_keys('li.a#X'), (('id', 'x'),))
+        self.ae(select.index_keys('div > LI:first-child'), (('tag', 'li'), ('tag', 'div')))
+        self.ae(select.index_keys('.a *'), (None, ('class', 'a')))
+        self.ae(select.index_keys('li:root'), (None,))
+        self.ae(select.index_keys('li, a'), ())
+        self.assertRaises(ExpressionError, select.matcher, 'body:nth-child')
+        self.assertRaises(ExpressionError, select.matcher, 'p:hover')
+    # }}}
+
     def test_select_shakespeare(self):
         document = html.document_fromstring(self.HTML_SHAKESPEARE)
         select = Select(document)
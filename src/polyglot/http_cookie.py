@@ -2,5 +2,5 @@
 # vim:fileencoding=utf-8
 # License: GPL v3 Copyright: 2019, Eli Schwartz <eschwartz@archlinux.org>
 
-from http.cookies import SimpleCookie    # noqa
+from http.cookies import SimpleCookie, Morsel    # noqa
 from http.cookiejar import CookieJar, Cookie  # noqa